@@ -0,0 +1 @@
+from vecpy.loader import load
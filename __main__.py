@@ -0,0 +1,115 @@
+"""
+Command-line interface: python -m vecpy <command> ...
+"""
+
+
+import argparse
+import importlib.util
+import os
+import sys
+from vecpy.compiler_constants import Architecture, Binding, DataType
+from vecpy.distributed import Worker
+from vecpy.loader import load
+from vecpy.runtime import build_package, map_files
+from vecpy.server import Server, default_path, stop
+
+#Parses name=value pairs
+def get_pairs(items, convert=str):
+  pairs = {}
+  for item in items:
+    if '=' not in item:
+      raise Exception('Expected name=value (%s)'%(item))
+    (name, value) = item.split('=', 1)
+    pairs[name] = convert(value)
+  return pairs
+
+#Imports the kernel from its compiled module (vecpy_<name>, or a prebuilt package)
+def get_kernel(name):
+  return load(name)
+
+#Returns the Python function named by module.py:kernel
+def get_function(spec):
+  if ':' not in spec:
+    raise Exception('Expected module.py:kernel (%s)'%(spec))
+  (file_name, name) = spec.rsplit(':', 1)
+  module_name = os.path.splitext(os.path.basename(file_name))[0]
+  module_spec = importlib.util.spec_from_file_location(module_name, file_name)
+  if module_spec is None:
+    raise Exception('Can\'t import %s'%(file_name))
+  module = importlib.util.module_from_spec(module_spec)
+  module_spec.loader.exec_module(module)
+  if not hasattr(module, name):
+    raise Exception('No kernel %s in %s'%(name, file_name))
+  return getattr(module, name)
+
+#Runs a compiled kernel over raw binary files
+def run_map(args):
+  convert = float if args.type == 'f' else int
+  kernel = get_kernel(args.kernel)
+  count = map_files(kernel, get_pairs(args.input), get_pairs(args.output), get_pairs(args.uniform, convert), args.type, args.window)
+  print('Processed %d elements'%(count))
+
+#Builds kernels ahead of time into a package for vecpy.load
+def run_build(args):
+  funcs = [get_function(spec) for spec in args.kernel]
+  archs = [getattr(Architecture, arch) for arch in args.arch]
+  timing = build_package(funcs, archs, getattr(DataType, args.type), args.output, tuple(args.binding or (Binding.python,)), args.threads, args.jobs)
+  for (arch, kernels) in timing.items():
+    for (name, stages) in kernels.items():
+      print('%s (%s): %s'%(name, arch, ', '.join('%s %.2fs'%(stage, seconds) for (stage, seconds) in stages.items())))
+  print('Built %d kernel(s) for %s into %s'%(len(funcs), ', '.join(args.arch), args.output))
+
+#Serves a compiled kernel to distributed coordinators
+def run_worker(args):
+  Worker(args.kernel, args.address).serve()
+
+#Serves compiled kernels to local client processes
+def run_server(args):
+  Server(args.kernel, args.path, args.jobs).serve()
+
+#Stops a kernel server
+def run_stop(args):
+  stop(args.path)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m vecpy', description='VecPy command-line interface')
+  commands = parser.add_subparsers(dest='command', required=True)
+  #map
+  command = commands.add_parser('map', help='run a compiled kernel over raw float32/uint32 files')
+  command.add_argument('kernel', help='kernel name (imported from the vecpy_<kernel> module)')
+  command.add_argument('-i', '--input', action='append', default=[], metavar='NAME=FILE', help='input file for an argument')
+  command.add_argument('-o', '--output', action='append', default=[], metavar='NAME=FILE', help='output file for an argument')
+  command.add_argument('-u', '--uniform', action='append', default=[], metavar='NAME=VALUE', help='value of a uniform argument')
+  command.add_argument('-t', '--type', choices=('f', 'I'), default='f', help='element type: f (float32) or I (uint32)')
+  command.add_argument('-w', '--window', type=int, default=1 << 24, help='elements per window of the mappings')
+  command.set_defaults(run=run_map)
+  #build
+  command = commands.add_parser('build', help='build kernels ahead of time into a package for vecpy.load')
+  command.add_argument('kernel', nargs='+', help='module.py:kernel of each kernel to build')
+  command.add_argument('-a', '--arch', nargs='+', choices=('generic', 'sse4_2', 'avx2'), default=['generic', 'sse4_2', 'avx2'], help='architectures to build (the loader picks the best one the CPU supports)')
+  command.add_argument('-t', '--type', choices=('float', 'uint32'), default='float', help='kernel data type')
+  command.add_argument('-b', '--binding', action='append', choices=(Binding.cpp, Binding.python, Binding.java, Binding.numpy), help='language binding (default: python)')
+  command.add_argument('-o', '--output', default='vecpy_dist', help='package directory')
+  command.add_argument('-n', '--threads', type=int, help='threads per call (default: this machine\'s core count)')
+  command.add_argument('-j', '--jobs', type=int, help='kernels to build at once')
+  command.set_defaults(run=run_build)
+  #worker
+  command = commands.add_parser('worker', help='serve a compiled kernel to distributed coordinators')
+  command.add_argument('kernel', help='kernel name (imported from the vecpy_<kernel> module)')
+  command.add_argument('address', help='unix:/path/to/socket or host:port to listen on')
+  command.set_defaults(run=run_worker)
+  #serve
+  command = commands.add_parser('serve', help='serve compiled kernels to local clients on one thread pool')
+  command.add_argument('kernel', nargs='+', help='kernel names (imported from the vecpy_<kernel> modules)')
+  command.add_argument('-s', '--socket', dest='path', default=default_path, help='Unix socket to listen on (default: %(default)s)')
+  command.add_argument('-j', '--jobs', type=int, default=1, help='kernel calls that may run at once')
+  command.set_defaults(run=run_server)
+  #stop
+  command = commands.add_parser('stop', help='stop a kernel server')
+  command.add_argument('-s', '--socket', dest='path', default=default_path, help='Unix socket the server listens on (default: %(default)s)')
+  command.set_defaults(run=run_stop)
+  args = parser.parse_args(argv)
+  args.run(args)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,144 @@
+"""
+The Allocator provides aligned native memory for kernel arguments without
+first building the data as a list of Python objects.
+"""
+
+
+import ctypes
+import mmap
+import struct
+import weakref
+
+#Handle to the C library (posix_memalign, free, memset)
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.posix_memalign.argtypes = (ctypes.POINTER(ctypes.c_void_p), ctypes.c_size_t, ctypes.c_size_t)
+_libc.posix_memalign.restype = ctypes.c_int
+_libc.free.argtypes = (ctypes.c_void_p,)
+_libc.free.restype = None
+
+#Allocates, fills, and carves up aligned native buffers
+class Allocator:
+  #Allocation methods
+  malloc = 'posix_memalign'
+  mmap = 'mmap'
+  #Allocations at least this large default to mmap
+  mmap_threshold = 1 << 20
+  #Bytes per element for each supported type
+  sizes = {'f': 4, 'I': 4}
+
+  #Utility functions
+  def check_type(type):
+    if type not in Allocator.sizes:
+      raise Exception('Invalid type')
+  def check_align(align):
+    if align < 16 or (align & (align - 1)) != 0:
+      raise Exception('Alignment must be a power of 2, at least 16')
+  def round_up(size, align):
+    return (size + align - 1) // align * align
+  def get_address(view):
+    return ctypes.addressof(ctypes.c_char.from_buffer(view))
+
+  #Returns a writable, aligned memoryview of num_bytes bytes (zero-filled unless zero is False)
+  def allocate(num_bytes, align=32, method=None, huge_pages=False, zero=True):
+    Allocator.check_align(align)
+    if num_bytes <= 0:
+      raise Exception('Size must be positive')
+    if method is None:
+      method = Allocator.mmap if (huge_pages or num_bytes >= Allocator.mmap_threshold) else Allocator.malloc
+    if method == Allocator.malloc:
+      if huge_pages:
+        raise Exception('Huge pages require mmap')
+      ptr = ctypes.c_void_p()
+      result = _libc.posix_memalign(ctypes.byref(ptr), align, num_bytes)
+      if result != 0:
+        raise MemoryError('posix_memalign failed (%d)'%(result))
+      if zero:
+        ctypes.memset(ptr.value, 0, num_bytes)
+      #The buffer is freed once the last view of it is released
+      buffer = (ctypes.c_ubyte * num_bytes).from_address(ptr.value)
+      weakref.finalize(buffer, _libc.free, ptr.value)
+      return memoryview(buffer).cast('B')
+    elif method == Allocator.mmap:
+      #Anonymous mappings are page-aligned and already zero-filled
+      padding = max(align - mmap.PAGESIZE, 0)
+      mapping = mmap.mmap(-1, num_bytes + padding)
+      if huge_pages and hasattr(mmap, 'MADV_HUGEPAGE'):
+        mapping.madvise(mmap.MADV_HUGEPAGE)
+      view = memoryview(mapping)
+      offset = (align - (Allocator.get_address(view) % align)) % align
+      return view[offset:offset + num_bytes]
+    else:
+      raise Exception('Invalid allocation method (%s)'%(method))
+
+  #Fills a byte view with copies of a single element
+  def fill(view, type, value):
+    Allocator.check_type(type)
+    size = Allocator.sizes[type]
+    if value == 0:
+      ctypes.memset(Allocator.get_address(view), 0, len(view))
+      return
+    #Write one element, then double the filled region with memcpy until done
+    view[0:size] = struct.pack('=' + type, value)
+    filled = size
+    while filled < len(view):
+      count = min(filled, len(view) - filled)
+      view[filled:filled + count] = view[0:count]
+      filled += count
+
+  #Copies the bytes of src into dst (ctypes.memmove releases the GIL)
+  def copy(dst, src):
+    if len(dst) != len(src):
+      raise Exception('Size mismatch')
+    try:
+      address = Allocator.get_address(src)
+    except TypeError:
+      #Read-only sources are copied by the buffer protocol instead
+      dst[:] = src
+      return
+    ctypes.memmove(Allocator.get_address(dst), address, len(src))
+
+  #Returns an aligned array of the given type and length
+  #  Every element is set to value; with value=None the contents are left uninitialized.
+  def get_array(type, length, align=32, value=0, method=None, huge_pages=False):
+    Allocator.check_type(type)
+    if length <= 0:
+      raise Exception('Length must be positive')
+    view = Allocator.allocate(length * Allocator.sizes[type], align, method, huge_pages, value == 0)
+    if value is not None and value != 0:
+      Allocator.fill(view, type, value)
+    return view.cast(type)
+
+#Carves many aligned buffers out of a single mapping
+class Arena:
+  def __init__(self, num_bytes, align=32, huge_pages=False):
+    Allocator.check_align(align)
+    #Alignment of every buffer handed out by this arena
+    self.align = align
+    #The backing memory
+    self.view = Allocator.allocate(Allocator.round_up(num_bytes, align), align, Allocator.mmap, huge_pages)
+    #Offset of the next free byte
+    self.offset = 0
+
+  #Returns the number of bytes needed for the given arrays
+  def get_size(num, type, length, align=32):
+    Allocator.check_type(type)
+    return num * Allocator.round_up(length * Allocator.sizes[type], align)
+
+  #Returns the next aligned array from the arena (value=None leaves it as it is)
+  def get_array(self, type, length, value=0):
+    Allocator.check_type(type)
+    if length <= 0:
+      raise Exception('Length must be positive')
+    num_bytes = length * Allocator.sizes[type]
+    if self.offset + num_bytes > len(self.view):
+      raise MemoryError('Arena exhausted')
+    view = self.view[self.offset:self.offset + num_bytes]
+    self.offset += Allocator.round_up(num_bytes, self.align)
+    #The mapping starts out zero-filled, so only other values need a fill
+    if value is not None and value != 0:
+      Allocator.fill(view, type, value)
+    return view.cast(type)
+
+  #Returns several aligned arrays from the arena
+  def get_arrays(self, num, type, length, value=0):
+    return [self.get_array(type, length, value) for i in range(num)]
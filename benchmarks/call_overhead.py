@@ -0,0 +1,45 @@
+"""
+Measures the per-call overhead of a compiled kernel from Python:
+  python benchmarks/call_overhead.py [-a avx2] [-n 4] [-s 4 64 1024] [-c 100000]
+Two copies of y = a * x + z are built, one with the default parallel threshold
+and one with a threshold of 0 (every call starts its worker threads), and the
+time per call is printed for each input size.
+"""
+
+
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+from vecpy.compiler_constants import Architecture, Binding, DataType, Options
+from vecpy.runtime import get_array, get_call_time, vectorize
+
+#The benchmarked kernel, under two names (one module each)
+def axpy(a:'uniform', x, z, y):
+  y = a * x + z
+def axpy_threads(a:'uniform', x, z, y):
+  y = a * x + z
+
+def main():
+  parser = argparse.ArgumentParser(description='Measures the per-call overhead of a compiled kernel')
+  parser.add_argument('-a', '--arch', default='avx2', choices=['generic', 'sse4_2', 'avx2'], help='target architecture')
+  parser.add_argument('-n', '--threads', type=int, default=4, help='threads per call')
+  parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[4, 64, 1024, 16384], help='number of elements')
+  parser.add_argument('-c', '--calls', type=int, default=100000, help='calls per measurement')
+  args = parser.parse_args()
+  arch = getattr(Architecture, args.arch)
+  with tempfile.TemporaryDirectory() as path:
+    sys.path.insert(0, path)
+    for (func, threshold) in ((axpy, Options(arch, DataType.float).parallel_threshold), (axpy_threads, 0)):
+      options = Options(arch, DataType.float, bindings=(Binding.python,), threads=args.threads, parallel_threshold=threshold, build_dir=os.path.join(path, func.__name__), module_dir=path)
+      vectorize(func, options)
+    kernels = [getattr(importlib.import_module('vecpy_' + func.__name__), func.__name__) for func in (axpy, axpy_threads)]
+    print('%10s %18s %18s'%('N', 'default (us)', 'threshold 0 (us)'))
+    for N in args.sizes:
+      (x, z, y) = (get_array('f', N, value=1), get_array('f', N, value=2), get_array('f', N))
+      times = [get_call_time(kernel, (3.0, x, z, y), calls=args.calls) for kernel in kernels]
+      print('%10d %18.2f %18.2f'%(N, times[0] * 1e6, times[1] * 1e6))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,62 @@
+"""
+Measures the import time and size of kernels built as separate modules and as
+one library module (vectorize with a list of kernels):
+  python benchmarks/import_time.py [-a sse4_2] [-k 3] [-r 50]
+The same kernels are built both ways, then each set of modules is imported in
+fresh interpreters and the fastest and median times are printed, along with
+the size of the shared libraries on disk.
+"""
+
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from vecpy.compiler_constants import Architecture, Binding, DataType, Options
+from vecpy.runtime import vectorize
+
+#The benchmarked kernels
+def scale(a:'uniform', x, y):
+  y = a * x
+def offset(b:'uniform', x, y):
+  y = x + b
+def clamp(lo:'uniform', hi:'uniform', x, y):
+  y = min(max(x, lo), hi)
+def square(x, y):
+  y = x * x
+def mix(t:'uniform', x, z, y):
+  y = x + t * (z - x)
+def poly(x, y):
+  y = ((2 * x + 3) * x + 5) * x + 7
+kernels = [scale, offset, clamp, square, mix, poly]
+
+#Returns the seconds taken to import the modules in a fresh interpreter
+def get_import_time(path, modules):
+  code = 'import time\nstart = time.perf_counter()\n%s\nprint(time.perf_counter() - start)'%('\n'.join('import ' + module for module in modules))
+  output = subprocess.check_output([sys.executable, '-c', code], cwd=path)
+  return float(output)
+
+def main():
+  parser = argparse.ArgumentParser(description='Measures the import time of separate and library modules')
+  parser.add_argument('-a', '--arch', default='sse4_2', choices=['generic', 'sse4_2', 'avx2'], help='target architecture')
+  parser.add_argument('-k', '--kernels', type=int, default=3, choices=range(1, len(kernels) + 1), help='number of kernels')
+  parser.add_argument('-r', '--runs', type=int, default=50, help='imports per measurement')
+  args = parser.parse_args()
+  arch = getattr(Architecture, args.arch)
+  funcs = kernels[:args.kernels]
+  with tempfile.TemporaryDirectory() as path:
+    separate = os.path.join(path, 'separate')
+    library = os.path.join(path, 'library')
+    for func in funcs:
+      vectorize(func, Options(arch, DataType.float, bindings=(Binding.python,), build_dir=os.path.join(separate, func.__name__), module_dir=separate))
+    vectorize(funcs, Options(arch, DataType.float, bindings=(Binding.python,), build_dir=os.path.join(library, 'build'), module_dir=library), name='kernels')
+    print('%10s %12s %12s %12s'%('modules', 'min (ms)', 'median (ms)', 'size (KB)'))
+    for (name, directory, modules) in (('separate', separate, ['vecpy_' + func.__name__ for func in funcs]), ('library', library, ['vecpy_kernels'])):
+      times = [get_import_time(directory, modules) for i in range(args.runs)]
+      size = sum(os.path.getsize(os.path.join(directory, module + '.so')) for module in modules)
+      print('%10s %12.3f %12.3f %12.1f'%(name, min(times) * 1e3, statistics.median(times) * 1e3, size / 1024))
+
+if __name__ == '__main__':
+  main()
@@ -5,7 +5,14 @@ in particular as a native Python module.
 """
 
 
+import copy
+import hashlib
+import os
 import subprocess
+import sys
+import sysconfig
+import threading
+import time
 from vecpy.kernel import *
 from vecpy.compiler_constants import *
 from vecpy.compiler_generic import Compiler_Generic
@@ -13,22 +20,309 @@ from vecpy.compiler_intel import Compiler_Intel
 
 class Compiler:
 
+  #Elements per chunk of a cancellable (submitted) call
+  chunk_size = 65536
+  #The C++ compiler and its warning flags
+  cxx = 'g++'
+  warning_flags = ['-Wall', '-Wno-unused-variable', '-Wno-unused-but-set-variable']
+  #Build flags and precompiled headers, shared by concurrent builds
+  flag_cache = {}
+  cache_lock = threading.Lock()
+
   #Utility functions: output file names
   def get_python_file(k):
     return 'vecpy_%s_python.h'%(k.name)
 
+  def get_numpy_file(k):
+    return 'vecpy_%s_numpy.h'%(k.name)
+
   def get_java_file(k):
     return 'vecpy_%s_java.h'%(k.name)
 
+  #Returns the JNI symbol of a native method of the VecPy class (with a signature if overloaded)
+  def get_jni_name(options, method, signature=None):
+    def escape(name):
+      return name.replace('_', '_1').replace(';', '_2').replace('[', '_3').replace('/', '_')
+    name = 'VecPy/' + method
+    if options.java_package is not None:
+      name = '%s/%s'%(options.java_package.replace('.', '/'), name)
+    name = 'Java_' + escape(name)
+    if signature is not None:
+      name += '__' + escape(signature)
+    return name
+
   def get_cpp_file(k):
     return 'vecpy_%s_cpp.h'%(k.name)
 
+  def get_cpp_header_file(k):
+    return 'vecpy_%s.hpp'%(k.name)
+
   def get_kernel_file(k):
     return 'vecpy_%s_kernel.h'%(k.name)
 
   def get_core_file(k):
     return 'vecpy_%s_core.cpp'%(k.name)
 
+  def get_library_file(name):
+    return 'vecpy_%s_library.cpp'%(name)
+
+  #Name of the Python module (and shared library) that exports the kernel
+  def get_module_name(k, options):
+    return 'vecpy_' + (options.library if options.library is not None else k.name)
+
+  #Name of a Python type of the kernel's module (prefixed when kernels share a module)
+  def get_type_name(k, options, type_name):
+    if options.library is not None:
+      return '%s.%s_%s'%(Compiler.get_module_name(k, options), k.name, type_name)
+    return '%s.%s'%(Compiler.get_module_name(k, options), type_name)
+
+  #Number of elements per tile such that one tile of every array fits in cache
+  def get_tile_size(k, options):
+    vector_size = options.arch['size']
+    #Bytes touched per element, summed over all array (non-uniform) arguments
+    bytes_per_element = sum(4 * arg.stride for arg in k.get_arguments(uniform=False) if not arg.is_fuse)
+    #Leave half of the cache for the next tile's prefetched lines
+    elements = (options.cache_size // 2) // max(bytes_per_element, 1)
+    return max(vector_size, (elements // vector_size) * vector_size)
+
+  #Generates the threading and batch scaffolding, which doesn't depend on the kernel
+  #  Kernels describe themselves with a vecpyCore::Kernel and pass their KernelArgs as void*, so
+  #  a module that exports several kernels has a single copy of this code.
+  def compile_core_common(src):
+    src += '//Kernel-independent scaffolding: threads, batches and chunks'
+    src += 'namespace vecpyCore {'
+    src.indent()
+    src += '//What the scaffolding needs to know about a kernel (its KernelArgs are opaque)'
+    src += 'struct Kernel {'
+    src.indent()
+    src += 'size_t argsSize;'
+    src += 'uint64_t vectorSize;'
+    src += 'uint64_t maxThreads;'
+    src += '//Smaller calls run on the calling thread, where thread startup would dominate'
+    src += 'uint64_t parallelThreshold;'
+    src += '//Elements per chunk of a cancellable call'
+    src += 'uint64_t chunkSize;'
+    src += '//Number of elements of a call'
+    src += 'uint64_t (*getN)(const void* args);'
+    src += '//Copies a call into part, starting offset elements later and covering N elements'
+    src += 'void (*slice)(const void* args, void* part, uint64_t offset, uint64_t N);'
+    src += '//Whether the unit stride, aligned kernels can be used'
+    src += 'bool (*isContiguous)(const void* args);'
+    src += '//Vector (tiled if enabled) and scalar kernels, for unit stride and strided arguments'
+    src += 'void (*vector)(void* args);'
+    src += 'void (*vectorStrided)(void* args);'
+    src += 'void (*scalar)(void* args);'
+    src += 'void (*scalarStrided)(void* args);'
+    src.unindent()
+    src += '};'
+    src += '//A kernel function and its arguments, run on a thread'
+    src += 'struct Task {'
+    src.indent()
+    src += 'void (*func)(void*);'
+    src += 'void* args;'
+    src.unindent()
+    src += '};'
+    src += 'static void* threadStart(void* v) {'
+    src.indent()
+    src += 'Task* task = (Task*)v;'
+    src += 'task->func(task->args);'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += '//Runs a call on up to maxThreads threads (part is scratch space for one KernelArgs)'
+    src += 'static bool run(const Kernel* kernel, void* args, void* part) {'
+    src.indent()
+    src += '//Strided or unaligned arguments use the gather/scatter kernels'
+    src += 'const bool contiguous = kernel->isContiguous(args);'
+    src += 'const uint64_t N = kernel->getN(args);'
+    src += 'const uint64_t numThreads = (N < kernel->parallelThreshold) ? 1 : kernel->maxThreads;'
+    src += '//Division of labor'
+    src += 'const uint64_t elementsPerThread = N / (kernel->vectorSize * numThreads) * kernel->vectorSize;'
+    src += 'void (*vector)(void*) = contiguous ? kernel->vector : kernel->vectorStrided;'
+    src += 'uint64_t offset = 0;'
+    src += 'if(elementsPerThread > 0 && numThreads == 1) {'
+    src.indent()
+    src += '//Execute on the calling thread'
+    src += 'kernel->slice(args, part, 0, elementsPerThread);'
+    src += 'vector(part);'
+    src += 'offset = elementsPerThread;'
+    src.unindent()
+    src += '} else if(elementsPerThread > 0) {'
+    src.indent()
+    src += '//Execute on multiple threads'
+    src += 'pthread_t* threads = new pthread_t[numThreads];'
+    src += 'bool* started = new bool[numThreads];'
+    src += 'Task* tasks = new Task[numThreads];'
+    src += 'char* threadArgs = new char[numThreads * kernel->argsSize];'
+    src += 'for(uint64_t t = 0; t < numThreads; t++) {'
+    src.indent()
+    src += 'tasks[t].func = vector;'
+    src += 'tasks[t].args = &threadArgs[t * kernel->argsSize];'
+    src += 'kernel->slice(args, tasks[t].args, offset, elementsPerThread);'
+    src += 'offset += elementsPerThread;'
+    src += '//A slice whose thread can\'t be started runs on the calling thread'
+    src += 'started[t] = numThreads > 1 && pthread_create(&threads[t], NULL, threadStart, (void*)&tasks[t]) == 0;'
+    src += 'if(!started[t]) {'
+    src.indent()
+    src += 'threadStart((void*)&tasks[t]);'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += 'for(uint64_t t = 0; t < numThreads; t++) {'
+    src.indent()
+    src += 'if(started[t]) {'
+    src.indent()
+    src += 'pthread_join(threads[t], NULL);'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += 'delete [] threads;'
+    src += 'delete [] started;'
+    src += 'delete [] tasks;'
+    src += 'delete [] threadArgs;'
+    src.unindent()
+    src += '}'
+    src += '//Handle any remaining elements'
+    src += 'if(offset < N) {'
+    src.indent()
+    src += 'kernel->slice(args, part, offset, N - offset);'
+    src += '(contiguous ? kernel->scalar : kernel->scalarStrided)(part);'
+    src.unindent()
+    src += '}'
+    src += 'return true;'
+    src.unindent()
+    src += '}'
+    src += '//Runs one job entirely on the calling thread'
+    src += 'static void runLocal(const Kernel* kernel, void* args, void* part) {'
+    src.indent()
+    src += 'const bool contiguous = kernel->isContiguous(args);'
+    src += 'const uint64_t N = kernel->getN(args);'
+    src += 'const uint64_t vectorElements = N / kernel->vectorSize * kernel->vectorSize;'
+    src += 'if(vectorElements > 0) {'
+    src.indent()
+    src += 'kernel->slice(args, part, 0, vectorElements);'
+    src += '(contiguous ? kernel->vector : kernel->vectorStrided)(part);'
+    src.unindent()
+    src += '}'
+    src += 'if(vectorElements < N) {'
+    src.indent()
+    src += 'kernel->slice(args, part, vectorElements, N - vectorElements);'
+    src += '(contiguous ? kernel->scalar : kernel->scalarStrided)(part);'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += '//Shared state of a batch: workers take the next largest job until none are left'
+    src += 'struct BatchState {'
+    src.indent()
+    src += 'const Kernel* kernel;'
+    src += 'char* jobs;'
+    src += 'uint64_t* order;'
+    src += 'uint64_t numJobs;'
+    src += 'std::atomic<uint64_t> next;'
+    src += 'std::atomic<uint64_t> completed;'
+    src += '//Optional flag that stops workers from taking new jobs'
+    src += 'const std::atomic<bool>* cancel;'
+    src.unindent()
+    src += '};'
+    src += 'static void* batchWorker(void* v) {'
+    src.indent()
+    src += 'BatchState* state = (BatchState*)v;'
+    src += 'const uint64_t argsSize = state->kernel->argsSize;'
+    src += 'char* part = new char[argsSize];'
+    src += 'for(uint64_t i = state->next++; i < state->numJobs; i = state->next++) {'
+    src.indent()
+    src += 'if(state->cancel != NULL && *state->cancel) {'
+    src.indent()
+    src += 'break;'
+    src.unindent()
+    src += '}'
+    src += 'runLocal(state->kernel, &state->jobs[state->order[i] * argsSize], part);'
+    src += 'state->completed++;'
+    src.unindent()
+    src += '}'
+    src += 'delete [] part;'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += '//Runs many independent jobs in one dispatch; returns false if cancelled before all jobs ran'
+    src += 'static bool runBatch(const Kernel* kernel, void* jobs, uint64_t numJobs, const std::atomic<bool>* cancel) {'
+    src.indent()
+    src += 'if(numJobs == 0) {'
+    src.indent()
+    src += 'return true;'
+    src.unindent()
+    src += '}'
+    src += 'char* jobArgs = (char*)jobs;'
+    src += 'const uint64_t argsSize = kernel->argsSize;'
+    src += '//Balance load by handing out the largest jobs first'
+    src += 'uint64_t* order = new uint64_t[numJobs];'
+    src += 'uint64_t total = 0;'
+    src += 'for(uint64_t i = 0; i < numJobs; i++) {'
+    src.indent()
+    src += 'order[i] = i;'
+    src += 'total += kernel->getN(&jobArgs[i * argsSize]);'
+    src.unindent()
+    src += '}'
+    src += 'std::sort(order, order + numJobs, [kernel, jobArgs, argsSize](uint64_t a, uint64_t b) { return kernel->getN(&jobArgs[a * argsSize]) > kernel->getN(&jobArgs[b * argsSize]); });'
+    src += 'BatchState state;'
+    src += 'state.kernel = kernel;'
+    src += 'state.jobs = jobArgs;'
+    src += 'state.order = order;'
+    src += 'state.numJobs = numJobs;'
+    src += 'state.next = 0;'
+    src += 'state.completed = 0;'
+    src += 'state.cancel = cancel;'
+    src += '//The calling thread is one of the workers'
+    src += 'uint64_t numThreads = (total < kernel->parallelThreshold) ? 1 : kernel->maxThreads;'
+    src += 'if(numThreads > numJobs) {'
+    src.indent()
+    src += 'numThreads = numJobs;'
+    src.unindent()
+    src += '}'
+    src += 'pthread_t* threads = new pthread_t[numThreads];'
+    src += '//Jobs are taken from a shared queue, so if a thread can\'t be started the others take its share'
+    src += 'uint64_t numStarted = 1;'
+    src += 'while(numStarted < numThreads && pthread_create(&threads[numStarted], NULL, batchWorker, (void*)&state) == 0) {'
+    src.indent()
+    src += 'numStarted++;'
+    src.unindent()
+    src += '}'
+    src += 'batchWorker((void*)&state);'
+    src += 'for(uint64_t t = 1; t < numStarted; t++) {'
+    src.indent()
+    src += 'pthread_join(threads[t], NULL);'
+    src.unindent()
+    src += '}'
+    src += 'delete [] threads;'
+    src += 'delete [] order;'
+    src += 'return state.completed == numJobs;'
+    src.unindent()
+    src += '}'
+    src += '//Runs a single call as a batch of chunks, so that it can be cancelled between chunks'
+    src += 'static bool runChunked(const Kernel* kernel, void* args, const std::atomic<bool>* cancel) {'
+    src.indent()
+    src += 'const uint64_t N = kernel->getN(args);'
+    src += 'const uint64_t chunkSize = kernel->chunkSize;'
+    src += 'const uint64_t numChunks = (N + chunkSize - 1) / chunkSize;'
+    src += 'char* chunks = new char[(numChunks > 0 ? numChunks : 1) * kernel->argsSize];'
+    src += 'for(uint64_t c = 0; c < numChunks; c++) {'
+    src.indent()
+    src += 'const uint64_t offset = c * chunkSize;'
+    src += 'kernel->slice(args, &chunks[c * kernel->argsSize], offset, (N - offset < chunkSize) ? (N - offset) : chunkSize);'
+    src.unindent()
+    src += '}'
+    src += 'const bool result = runBatch(kernel, chunks, numChunks, cancel);'
+    src += 'delete [] chunks;'
+    src += 'return result;'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += ''
+
   #Generates the core file
   def compile_core(k, options, include_files):
     if Architecture.is_generic(options.arch):
@@ -43,14 +337,30 @@ class Compiler:
     src += '//Includes'
     src += '#include <pthread.h>'
     src += '#include <stdio.h>'
+    src += '#include <atomic>'
     src += '#include "%s"'%(Compiler.get_kernel_file(k))
     src += ''
-    #Utility functions
-    src += '//Utility functions'
-    src += 'static void* threadStart(void* v) {'
+    #The threading and batch scaffolding is shared by every kernel (see compile_core_common)
+    if options.library is None:
+      Compiler.compile_core_common(src)
+    #The kernel as seen by the scaffolding
+    src += '//The kernel, as seen by the shared scaffolding'
+    src += 'static uint64_t getN(const void* v) {'
     src.indent()
-    src += '%s_%s((KernelArgs*)v);'%(k.name, suffix)
-    src += 'return NULL;'
+    src += 'return ((const KernelArgs*)v)->N;'
+    src.unindent()
+    src += '}'
+    src += 'static void sliceArgs(const void* v, void* p, uint64_t offset, uint64_t N) {'
+    src.indent()
+    src += 'const KernelArgs* args = (const KernelArgs*)v;'
+    src += 'KernelArgs* part = (KernelArgs*)p;'
+    src += '*part = *args;'
+    for arg in k.get_arguments(uniform=False, fuse=False):
+      if arg.stride > 1:
+        src += 'part->%s = &args->%s[offset * %d];'%(arg.name, arg.name, arg.stride)
+      else:
+        src += 'part->%s = &args->%s[offset * args->%s_stride];'%(arg.name, arg.name, arg.name)
+    src += 'part->N = N;'
     src.unindent()
     src += '}'
     src += 'static bool isAligned(void* data) {'
@@ -58,87 +368,69 @@ class Compiler:
     src += 'return reinterpret_cast<uint64_t>(data) %% %dUL == 0UL;'%(options.arch['size'] * 4)
     src.unindent()
     src += '}'
-    src += 'static bool checkArgs(KernelArgs* args) {'
+    src += '//Whether the unit stride, aligned kernel can be used'
+    src += 'static bool isContiguous(const void* v) {'
     src.indent()
-    for arg in k.get_arguments(uniform=False):
-      src += 'if(!isAligned(args->%s)) {'%(arg.name)
+    src += 'const KernelArgs* args = (const KernelArgs*)v;'
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'if(args->%s_stride != 1 || !isAligned(args->%s)) {'%(arg.name, arg.name)
       src.indent()
-      src += 'printf("Array not aligned (%s)\\n");'%(arg.name)
       src += 'return false;'
       src.unindent()
       src += '}'
     src += 'return true;'
     src.unindent()
     src += '}'
-    src += ''
-    #Unified core for all programming interfaces
-    src += '//Unified core function'
-    src += 'static bool run(KernelArgs* args) {'
+    src += 'static void runVector(void* v) {'
     src.indent()
-    src += 'if(!checkArgs(args)) {'
-    src.indent()
-    src += 'printf("Arguments are invalid\\n");'
-    src += 'return false;'
+    if options.tiling:
+      #Walk this thread's slice one cache-sized tile at a time
+      src += 'KernelArgs* args = (KernelArgs*)v;'
+      src += 'const uint64_t tileSize = %d;'%(Compiler.get_tile_size(k, options))
+      src += 'KernelArgs tileArgs;'
+      src += 'for(uint64_t offset = 0; offset < args->N; offset += tileSize) {'
+      src.indent()
+      src += 'sliceArgs(args, &tileArgs, offset, (args->N - offset < tileSize) ? (args->N - offset) : tileSize);'
+      src += '%s_%s(&tileArgs);'%(k.name, suffix)
+      src.unindent()
+      src += '}'
+    else:
+      src += '%s_%s((KernelArgs*)v);'%(k.name, suffix)
     src.unindent()
     src += '}'
-    src += '//Compile-time constants'
-    src += 'const uint64_t vectorSize = %d;'%(options.arch['size'])
-    src += 'const uint64_t numThreads = %d;'%(options.threads)
-    src += '//Division of labor'
-    src += 'const uint64_t vectorsPerThread = args->N / (vectorSize * numThreads);'
-    src += 'const uint64_t elementsPerThread = vectorsPerThread * vectorSize;'
-    src += '//Execute on multiple threads'
-    src += 'uint64_t offset = 0;'
-    src += 'if(elementsPerThread > 0) {'
+    src += 'static void runVectorStrided(void* v) {'
     src.indent()
-    src += 'pthread_t* threads = new pthread_t[numThreads];'
-    src += 'KernelArgs* threadArgs = new KernelArgs[numThreads];'
-    src += 'for(uint64_t t = 0; t < numThreads; t++) {'
+    src += '%s_%s_strided((KernelArgs*)v);'%(k.name, suffix)
+    src.unindent()
+    src += '}'
+    src += 'static void runScalar(void* v) {'
     src.indent()
-    for arg in k.get_arguments():
-      if arg.is_uniform:
-        src += 'threadArgs[t].%s = args->%s;'%(arg.name, arg.name)
-      elif arg.is_fuse:
-        src += 'threadArgs[t].%s = &args->%s[0];'%(arg.name, arg.name)
-      else:
-        offset = 'offset'
-        if arg.stride > 1:
-          offset = '%s * %d'%(offset, arg.stride)
-        src += 'threadArgs[t].%s = &args->%s[%s];'%(arg.name, arg.name, offset)
-    src += 'threadArgs[t].N = elementsPerThread;'
-    src += 'offset += elementsPerThread;'
-    src += 'pthread_create(&threads[t], NULL, threadStart, (void*)&threadArgs[t]);'
+    src += '%s_scalar((KernelArgs*)v);'%(k.name)
     src.unindent()
     src += '}'
-    src += 'for(uint64_t t = 0; t < numThreads; t++) {'
+    src += 'static void runScalarStrided(void* v) {'
     src.indent()
-    src += ' pthread_join(threads[t], NULL); '
+    src += '%s_scalar_strided((KernelArgs*)v);'%(k.name)
     src.unindent()
     src += '}'
-    src += 'delete [] threads;'
-    src += 'delete [] threadArgs;'
+    src += 'static const vecpyCore::Kernel coreKernel = {sizeof(KernelArgs), %d, %d, %d, %d, getN, sliceArgs, isContiguous, runVector, runVectorStrided, runScalar, runScalarStrided};'%(options.arch['size'], options.threads, options.parallel_threshold, Compiler.chunk_size)
+    src += ''
+    #Entry points of the bindings
+    src += '//Unified core functions for all programming interfaces'
+    src += 'static bool run(KernelArgs* args) {'
+    src.indent()
+    src += 'KernelArgs part;'
+    src += 'return vecpyCore::run(&coreKernel, args, &part);'
     src.unindent()
     src += '}'
-    #src += 'printf("Vector: %dx%dx%d=%d | Scalar: %d\\n", vectorsPerThread, vectorSize, numThreads, offset, args->N - offset);'
-    src += '//Handle any remaining elements'
-    src += 'if(offset < args->N) {'
+    src += 'static bool runBatch(KernelArgs* jobs, uint64_t numJobs, const std::atomic<bool>* cancel = NULL) {'
     src.indent()
-    src += 'KernelArgs lastArgs;'
-    for arg in k.get_arguments():
-      if arg.is_uniform:
-        src += 'lastArgs.%s = args->%s;'%(arg.name, arg.name)
-      elif arg.is_fuse:
-        src += 'lastArgs.%s = &args->%s[0];'%(arg.name, arg.name)
-      else:
-        offset = 'offset'
-        if arg.stride > 1:
-          offset = '%s * %d'%(offset, arg.stride)
-        src += 'lastArgs.%s = &args->%s[%s];'%(arg.name, arg.name, offset)
-    src += 'lastArgs.N = args->N - offset;'
-    src += '%s_scalar(&lastArgs);'%(k.name)
+    src += 'return vecpyCore::runBatch(&coreKernel, jobs, numJobs, cancel);'
     src.unindent()
     src += '}'
-    src += 'return true;'
+    src += 'static bool runChunked(KernelArgs* args, const std::atomic<bool>* cancel) {'
+    src.indent()
+    src += 'return vecpyCore::runChunked(&coreKernel, args, cancel);'
     src.unindent()
     src += '}'
     src += ''
@@ -147,9 +439,12 @@ class Compiler:
     for file in include_files:
       src += '#include "%s"'%(file)
     src += ''
+    #A library's kernels are inlined into the library's core (see compile_library_core)
+    if options.library is not None:
+      return src.get_code()
     #Save code to file
     file_name = Compiler.get_core_file(k)
-    with open(file_name, 'w') as file:
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
       file.write(src.get_code())
     #print('Saved to file: %s'%(file_name))
 
@@ -168,154 +463,1650 @@ class Compiler:
     src += 'KernelArgs args;'
     for arg in k.get_arguments():
       src += 'args.%s = %s;'%(arg.name, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'args.%s_stride = 1;'%(arg.name)
     src += 'args.N = N;'
     src += 'return run(&args);'
     src.unindent()
     src += '}'
-    src += ''
+    src += ''
+    #Batched wrapper
+    arg_str = ''
+    for arg in k.get_arguments():
+      arg_str += '%s*%s %s, '%(options.type, '*' if not arg.is_uniform else '', arg.name)
+    src += '//Batched wrapper: one pointer (or uniform value) per job for each argument'
+    src += 'extern "C" bool %s_batch(%suint64_t* N, uint64_t numJobs) {'%(k.name, arg_str)
+    src.indent()
+    src += 'KernelArgs* jobs = new KernelArgs[numJobs];'
+    src += 'for(uint64_t j = 0; j < numJobs; j++) {'
+    src.indent()
+    for arg in k.get_arguments():
+      src += 'jobs[j].%s = %s[j];'%(arg.name, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'jobs[j].%s_stride = 1;'%(arg.name)
+    src += 'jobs[j].N = N[j];'
+    src.unindent()
+    src += '}'
+    src += 'bool result = runBatch(jobs, numJobs);'
+    src += 'delete [] jobs;'
+    src += 'return result;'
+    src.unindent()
+    src += '}'
+    src += ''
+    #Non-blocking wrapper
+    arg_str = ''
+    for arg in k.get_arguments():
+      arg_str += '%s%s %s, '%(options.type, '*' if not arg.is_uniform else '', arg.name)
+    src += '//State of a submitted call'
+    src += 'struct SubmitState {'
+    src.indent()
+    src += 'KernelArgs args;'
+    src += 'void (*done)(void*, bool);'
+    src += 'void* context;'
+    src.unindent()
+    src += '};'
+    src += 'static void* submitWorker(void* v) {'
+    src.indent()
+    src += 'SubmitState* state = (SubmitState*)v;'
+    src += 'const bool result = runChunked(&state->args, NULL);'
+    src += 'state->done(state->context, result);'
+    src += 'delete state;'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += '//Non-blocking wrapper: runs on the module\'s threads, then calls done(context, result)'
+    src += 'extern "C" bool %s_submit(%suint64_t N, void (*done)(void*, bool), void* context) {'%(k.name, arg_str)
+    src.indent()
+    src += 'SubmitState* state = new SubmitState;'
+    for arg in k.get_arguments():
+      src += 'state->args.%s = %s;'%(arg.name, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'state->args.%s_stride = 1;'%(arg.name)
+    src += 'state->args.N = N;'
+    src += 'state->done = done;'
+    src += 'state->context = context;'
+    src += 'pthread_t thread;'
+    src += 'if(pthread_create(&thread, NULL, submitWorker, (void*)state) != 0) {'
+    src.indent()
+    src += 'delete state;'
+    src += 'return false;'
+    src.unindent()
+    src += '}'
+    src += 'pthread_detach(thread);'
+    src += 'return true;'
+    src.unindent()
+    src += '}'
+    src += ''
+    #Save code to file
+    file_name = Compiler.get_cpp_file(k)
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
+      file.write(src.get_code())
+    #print('Saved to file: %s'%(file_name))
+
+  #Generates the header-only C++17 wrapper around the C++ entry points
+  def compile_cpp_header(k, options):
+    type = options.type
+    args = k.get_arguments()
+    #Outputs that aren't read can be allocated by the wrapper
+    optional = [arg for arg in args if arg.is_output and not arg.is_input]
+    candidates = [arg for arg in k.get_arguments(uniform=False, fuse=False) if arg not in optional]
+    def get_param(arg, pointer):
+      if arg.is_uniform:
+        return '%s %s'%(type, arg.name)
+      qualifier = '' if arg.is_output else 'const '
+      if pointer:
+        return '%s%s* %s'%(qualifier, type, arg.name)
+      return 'Span<%s%s> %s'%(qualifier, type, arg.name)
+    def get_value(arg):
+      if arg.is_uniform:
+        return arg.name
+      return 'const_cast<%s*>(%s.data())'%(type, arg.name)
+    def get_length(arg):
+      if arg.stride > 1:
+        return 'N * %d'%(arg.stride)
+      elif arg.is_fuse:
+        return '1'
+      return 'N'
+    #Emits the number of elements and the length checks
+    def check_lengths(src, args):
+      first = candidates[0]
+      src += 'const uint64_t N = %s.size()%s;'%(first.name, ' / %d'%(first.stride) if first.stride > 1 else '')
+      for arg in args:
+        #The first array sets N, so it's only checked for a whole number of strided elements
+        if not arg.is_uniform and not (arg is first and arg.stride == 1):
+          src += 'if(%s.size() != %s) {'%(arg.name, get_length(arg))
+          src.indent()
+          src += 'throw std::invalid_argument("Array sizes don\'t match (%s)");'%(arg.name)
+          src.unindent()
+          src += '}'
+    src = Formatter()
+    src.section('VecPy generated header: C++17 wrapper for %s'%(k.name))
+    src += '#pragma once'
+    src += '//Includes'
+    src += '#include <stdint.h>'
+    src += '#include <stdlib.h>'
+    src += '#include <future>'
+    src += '#include <new>'
+    src += '#include <stdexcept>'
+    src += '#include <utility>'
+    src += '#include <vector>'
+    src += '#if __cplusplus >= 202002L'
+    src += '#include <span>'
+    src += '#endif'
+    src += ''
+    #Entry points exported by the shared library
+    arg_str = ''.join('%s%s %s, '%(type, '*' if not arg.is_uniform else '', arg.name) for arg in args)
+    src += '//Entry points exported by %s.so'%(Compiler.get_module_name(k, options))
+    src += 'extern "C" bool %s(%suint64_t N);'%(k.name, arg_str)
+    src += 'extern "C" bool %s_submit(%suint64_t N, void (*done)(void*, bool), void* context);'%(k.name, arg_str)
+    src += ''
+    #Definitions shared by the headers of all kernels
+    src += '#ifndef VECPY_CPP_COMMON'
+    src += '#define VECPY_CPP_COMMON'
+    src += 'namespace vecpy {'
+    src.indent()
+    src += '//Allocator for std::vector that returns 64-byte aligned memory'
+    src += 'template<typename T> struct AlignedAllocator {'
+    src.indent()
+    src += 'typedef T value_type;'
+    src += 'AlignedAllocator() noexcept {}'
+    src += 'template<typename U> AlignedAllocator(const AlignedAllocator<U>&) noexcept {}'
+    src += 'T* allocate(size_t n) {'
+    src.indent()
+    src += 'void* data;'
+    src += 'if(posix_memalign(&data, 64, n * sizeof(T)) != 0) {'
+    src.indent()
+    src += 'throw std::bad_alloc();'
+    src.unindent()
+    src += '}'
+    src += 'return (T*)data;'
+    src.unindent()
+    src += '}'
+    src += 'void deallocate(T* data, size_t n) noexcept {'
+    src.indent()
+    src += 'free(data);'
+    src.unindent()
+    src += '}'
+    src += 'template<typename U> bool operator==(const AlignedAllocator<U>&) const noexcept { return true; }'
+    src += 'template<typename U> bool operator!=(const AlignedAllocator<U>&) const noexcept { return false; }'
+    src.unindent()
+    src += '};'
+    src += 'template<typename T> using AlignedVector = std::vector<T, AlignedAllocator<T>>;'
+    src += '//Contiguous view of an array (std::span where available)'
+    src += '#if __cplusplus >= 202002L'
+    src += 'template<typename T> using Span = std::span<T>;'
+    src += '#else'
+    src += 'template<typename T> class Span {'
+    src += 'public:'
+    src.indent()
+    src += 'Span(T* data, size_t size) : ptr(data), length(size) {}'
+    src += 'template<typename C, typename = decltype(std::declval<C&>().data())> Span(C& container) : ptr(container.data()), length(container.size()) {}'
+    src += 'T* data() const { return ptr; }'
+    src += 'size_t size() const { return length; }'
+    src.unindent()
+    src += 'private:'
+    src.indent()
+    src += 'T* ptr;'
+    src += 'size_t length;'
+    src.unindent()
+    src += '};'
+    src += '#endif'
+    src += '//Completes a promise from the callback of a submitted call'
+    src += 'template<typename T> struct Pending {'
+    src.indent()
+    src += 'T value;'
+    src += 'std::promise<T> promise;'
+    src += 'static void done(void* context, bool result) {'
+    src.indent()
+    src += 'Pending* pending = (Pending*)context;'
+    src += 'if(result) {'
+    src.indent()
+    src += 'pending->promise.set_value(std::move(pending->value));'
+    src.unindent()
+    src += '} else {'
+    src.indent()
+    src += 'pending->promise.set_exception(std::make_exception_ptr(std::runtime_error("Kernel reported failure")));'
+    src.unindent()
+    src += '}'
+    src += 'delete pending;'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '};'
+    src.unindent()
+    src += '}'
+    src += '#endif'
+    src += ''
+    #Kernel wrappers
+    src += 'namespace vecpy {'
+    src += 'namespace %s {'%(k.name)
+    src.indent()
+    #Pointer and length
+    src += '//Pointers and number of elements (no validation)'
+    src += 'inline bool run(%s, uint64_t N) {'%(', '.join(get_param(arg, True) for arg in args))
+    src.indent()
+    src += 'return ::%s(%sN);'%(k.name, ''.join(('const_cast<%s*>(%s), '%(type, arg.name) if not arg.is_uniform else '%s, '%(arg.name)) for arg in args))
+    src.unindent()
+    src += '}'
+    if len(candidates) > 0:
+      #Spans
+      src += '//Spans, with length validation'
+      src += 'inline bool run(%s) {'%(', '.join(get_param(arg, False) for arg in args))
+      src.indent()
+      check_lengths(src, args)
+      src += 'return ::%s(%sN);'%(k.name, ''.join('%s, '%(get_value(arg)) for arg in args))
+      src.unindent()
+      src += '}'
+      src += '//Non-blocking call on the module\'s threads; the arrays must outlive the future'
+      src += 'inline std::future<bool> runAsync(%s) {'%(', '.join(get_param(arg, False) for arg in args))
+      src.indent()
+      check_lengths(src, args)
+      src += 'Pending<bool>* pending = new Pending<bool>();'
+      src += 'pending->value = true;'
+      src += 'std::future<bool> future = pending->promise.get_future();'
+      src += 'if(!::%s_submit(%sN, Pending<bool>::done, pending)) {'%(k.name, ''.join('%s, '%(get_value(arg)) for arg in args))
+      src.indent()
+      src += 'delete pending;'
+      src += 'throw std::runtime_error("Unable to start a thread");'
+      src.unindent()
+      src += '}'
+      src += 'return future;'
+      src.unindent()
+      src += '}'
+    if len(optional) > 0 and len(candidates) > 0:
+      #Automatic output allocation
+      inputs = [arg for arg in args if arg not in optional]
+      src += '//Outputs allocated by the wrapper'
+      src += 'struct Outputs {'
+      src.indent()
+      for arg in optional:
+        src += 'AlignedVector<%s> %s;'%(type, arg.name)
+      src.unindent()
+      src += '};'
+      src += 'inline void allocate(Outputs& outputs, uint64_t N) {'
+      src.indent()
+      for arg in optional:
+        src += 'outputs.%s.resize(%s);'%(arg.name, get_length(arg))
+      src.unindent()
+      src += '}'
+      output_str = ''.join('%s, '%(get_value(arg)) if arg not in optional else 'outputs.%s.data(), '%(arg.name) for arg in args)
+      src += '//Allocates the outputs that aren\'t passed in'
+      src += 'inline Outputs run(%s) {'%(', '.join(get_param(arg, False) for arg in inputs))
+      src.indent()
+      check_lengths(src, inputs)
+      src += 'Outputs outputs;'
+      src += 'allocate(outputs, N);'
+      src += 'if(!::%s(%sN)) {'%(k.name, output_str)
+      src.indent()
+      src += 'throw std::runtime_error("Kernel reported failure");'
+      src.unindent()
+      src += '}'
+      src += 'return outputs;'
+      src.unindent()
+      src += '}'
+      output_str = output_str.replace('outputs.', 'pending->value.')
+      src += '//Non-blocking call that allocates the outputs; the inputs must outlive the future'
+      src += 'inline std::future<Outputs> runAsync(%s) {'%(', '.join(get_param(arg, False) for arg in inputs))
+      src.indent()
+      check_lengths(src, inputs)
+      src += 'Pending<Outputs>* pending = new Pending<Outputs>();'
+      src += 'allocate(pending->value, N);'
+      src += 'std::future<Outputs> future = pending->promise.get_future();'
+      src += 'if(!::%s_submit(%sN, Pending<Outputs>::done, pending)) {'%(k.name, output_str)
+      src.indent()
+      src += 'delete pending;'
+      src += 'throw std::runtime_error("Unable to start a thread");'
+      src.unindent()
+      src += '}'
+      src += 'return future;'
+      src.unindent()
+      src += '}'
+    src.unindent()
+    src += '}'
+    src += '}'
+    src += ''
+    #Save code to file
+    file_name = Compiler.get_cpp_header_file(k)
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
+      file.write(src.get_code())
+
+  #Generates the helpers that let native threads call into Python (shared by all kernels of a module)
+  def compile_python_attachment(src):
+    src += '//Lets a native thread run Python code in a given interpreter'
+    src += 'typedef struct {'
+    src.indent()
+    src += 'PyThreadState* thread;'
+    src += 'PyGILState_STATE gil;'
+    src.unindent()
+    src += '} Attachment;'
+    src += 'static Attachment attachThread(PyInterpreterState* interp) {'
+    src.indent()
+    src += 'Attachment attachment = {NULL, PyGILState_UNLOCKED};'
+    src += '#if PY_VERSION_HEX >= 0x030C0000'
+    src += '//Subinterpreters need a thread state of their own, unless this thread is already attached'
+    src += '#if PY_VERSION_HEX >= 0x030D0000'
+    src += 'if(PyThreadState_GetUnchecked() == NULL) {'
+    src += '#else'
+    src += 'if(_PyThreadState_UncheckedGet() == NULL) {'
+    src += '#endif'
+    src.indent()
+    src += 'attachment.thread = PyThreadState_New(interp);'
+    src += 'PyEval_RestoreThread(attachment.thread);'
+    src.unindent()
+    src += '}'
+    src += '#else'
+    src += '//Older versions share a single GIL, which the GIL state API handles'
+    src += 'attachment.gil = PyGILState_Ensure();'
+    src += '#endif'
+    src += 'return attachment;'
+    src.unindent()
+    src += '}'
+    src += 'static void detachThread(Attachment attachment) {'
+    src.indent()
+    src += '#if PY_VERSION_HEX >= 0x030C0000'
+    src += 'if(attachment.thread != NULL) {'
+    src.indent()
+    src += 'PyThreadState_Clear(attachment.thread);'
+    src += 'PyThreadState_DeleteCurrent();'
+    src.unindent()
+    src += '}'
+    src += '#else'
+    src += 'PyGILState_Release(attachment.gil);'
+    src += '#endif'
+    src.unindent()
+    src += '}'
+
+  #Generates the aligned buffer type used for outputs allocated by the Python binding
+  def compile_python_buffer(k, options, src):
+    type = options.type
+    if DataType.is_floating(type):
+      format, typestr, dl_code, to_py, from_py = 'f', '<f4', 2, 'PyFloat_FromDouble', 'PyFloat_AsDouble'
+    else:
+      format, typestr, dl_code, to_py, from_py = 'I', '<u4', 1, 'PyLong_FromUnsignedLong', 'PyLong_AsUnsignedLong'
+    src += '//Aligned buffer object: supports the buffer protocol, DLPack, and the array interface'
+    src += 'typedef struct {'
+    src.indent()
+    src += 'PyObject_HEAD'
+    src += 'void* data;'
+    src += 'Py_ssize_t length;'
+    src.unindent()
+    src += '} BufferObject;'
+    src += '//Per-module state (one per interpreter that imports the module)'
+    src += 'static const int poolCapacity = %d;'%(max(options.output_pool, 0))
+    src += 'typedef struct {'
+    src.indent()
+    src += 'PyTypeObject* BufferType;'
+    src += 'PyTypeObject* HandleType;'
+    src += '//Recently freed memory, reused for outputs of the same size'
+    src += 'pthread_mutex_t poolLock;'
+    src += 'void* poolData[%d];'%(max(options.output_pool, 1))
+    src += 'Py_ssize_t poolLength[%d];'%(max(options.output_pool, 1))
+    src += 'int poolSize;'
+    src.unindent()
+    src += '} ModuleState;'
+    if options.library is not None:
+      src += '//Kernels that share a module each have their state at an offset within the module\'s'
+      src += 'extern const Py_ssize_t stateOffset;'
+      src += 'static ModuleState* getState(void* moduleState) {'
+      src.indent()
+      src += 'return (ModuleState*)((char*)moduleState + stateOffset);'
+      src.unindent()
+      src += '}'
+    else:
+      src += 'static ModuleState* getState(void* moduleState) {'
+      src.indent()
+      src += 'return (ModuleState*)moduleState;'
+      src.unindent()
+      src += '}'
+    if options.library is None:
+      Compiler.compile_python_attachment(src)
+    src += 'static void Buffer_dealloc(BufferObject* self) {'
+    src.indent()
+    src += '//Heap types own a reference to the module, so its state outlives the buffer'
+    src += 'PyTypeObject* type = Py_TYPE(self);'
+    src += 'ModuleState* state = getState(PyType_GetModuleState(type));'
+    src += 'pthread_mutex_lock(&state->poolLock);'
+    src += 'if(state->poolSize < poolCapacity) {'
+    src.indent()
+    src += 'state->poolData[state->poolSize] = self->data;'
+    src += 'state->poolLength[state->poolSize] = self->length;'
+    src += 'state->poolSize++;'
+    src += 'self->data = NULL;'
+    src.unindent()
+    src += '}'
+    src += 'pthread_mutex_unlock(&state->poolLock);'
+    src += 'free(self->data);'
+    src += 'type->tp_free((PyObject*)self);'
+    src += 'Py_DECREF(type);'
+    src.unindent()
+    src += '}'
+    #Buffer protocol
+    src += 'static int Buffer_getbuffer(BufferObject* self, Py_buffer* view, int flags) {'
+    src.indent()
+    src += 'view->obj = (PyObject*)self;'
+    src += 'Py_INCREF(self);'
+    src += 'view->buf = self->data;'
+    src += 'view->len = self->length * sizeof(%s);'%(type)
+    src += 'view->readonly = 0;'
+    src += 'view->itemsize = sizeof(%s);'%(type)
+    src += 'view->format = (flags & PyBUF_FORMAT) ? (char*)"%s" : NULL;'%(format)
+    src += 'view->ndim = 1;'
+    src += 'view->shape = (flags & PyBUF_ND) ? &self->length : NULL;'
+    src += 'view->strides = (flags & PyBUF_STRIDES) ? &view->itemsize : NULL;'
+    src += 'view->suboffsets = NULL;'
+    src += 'view->internal = NULL;'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    #Sequence protocol
+    src += 'static Py_ssize_t Buffer_length(BufferObject* self) {'
+    src.indent()
+    src += 'return self->length;'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Buffer_item(BufferObject* self, Py_ssize_t i) {'
+    src.indent()
+    src += 'if(i < 0 || i >= self->length) {'
+    src.indent()
+    src += 'PyErr_SetString(PyExc_IndexError, "Index out of range");'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'return %s(((%s*)self->data)[i]);'%(to_py, type)
+    src.unindent()
+    src += '}'
+    src += 'static int Buffer_ass_item(BufferObject* self, Py_ssize_t i, PyObject* value) {'
+    src.indent()
+    src += 'if(value == NULL || i < 0 || i >= self->length) {'
+    src.indent()
+    src += 'PyErr_SetString(PyExc_IndexError, "Invalid assignment");'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += '%s x = (%s)%s(value);'%(type, type, from_py)
+    src += 'if(PyErr_Occurred()) {'
+    src.indent()
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += '((%s*)self->data)[i] = x;'%(type)
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    #DLPack export
+    src += '//DLPack export: the capsule keeps the buffer alive until the consumer is done'
+    src += 'typedef struct {'
+    src.indent()
+    src += 'DLManagedTensor managed;'
+    src += 'int64_t shape[1];'
+    src += 'PyInterpreterState* interp;'
+    src.unindent()
+    src += '} BufferExport;'
+    src += '//May be called from any thread'
+    src += 'static void Buffer_dlpackDeleter(DLManagedTensor* managed) {'
+    src.indent()
+    src += 'Attachment attachment = attachThread(((BufferExport*)managed)->interp);'
+    src += 'Py_DECREF((PyObject*)managed->manager_ctx);'
+    src += 'free(managed);'
+    src += 'detachThread(attachment);'
+    src.unindent()
+    src += '}'
+    src += 'static void Buffer_capsuleDestructor(PyObject* capsule) {'
+    src.indent()
+    src += '//Consumers rename the capsule and take over the deleter'
+    src += 'if(PyCapsule_IsValid(capsule, "dltensor")) {'
+    src.indent()
+    src += 'DLManagedTensor* managed = (DLManagedTensor*)PyCapsule_GetPointer(capsule, "dltensor");'
+    src += 'managed->deleter(managed);'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Buffer_dlpack(BufferObject* self, PyObject* args, PyObject* kwargs) {'
+    src.indent()
+    src += 'BufferExport* exported = (BufferExport*)malloc(sizeof(BufferExport));'
+    src += 'if(exported == NULL) {'
+    src.indent()
+    src += 'return PyErr_NoMemory();'
+    src.unindent()
+    src += '}'
+    src += 'exported->shape[0] = self->length;'
+    src += 'exported->interp = PyInterpreterState_Get();'
+    src += 'DLTensor* tensor = &exported->managed.dl_tensor;'
+    src += 'tensor->data = self->data;'
+    src += 'tensor->device.device_type = kDLCPU;'
+    src += 'tensor->device.device_id = 0;'
+    src += 'tensor->ndim = 1;'
+    src += 'tensor->dtype.code = %d;'%(dl_code)
+    src += 'tensor->dtype.bits = 32;'
+    src += 'tensor->dtype.lanes = 1;'
+    src += 'tensor->shape = exported->shape;'
+    src += 'tensor->strides = NULL;'
+    src += 'tensor->byte_offset = 0;'
+    src += 'Py_INCREF(self);'
+    src += 'exported->managed.manager_ctx = self;'
+    src += 'exported->managed.deleter = Buffer_dlpackDeleter;'
+    src += 'PyObject* capsule = PyCapsule_New(&exported->managed, "dltensor", Buffer_capsuleDestructor);'
+    src += 'if(capsule == NULL) {'
+    src.indent()
+    src += 'Buffer_dlpackDeleter(&exported->managed);'
+    src.unindent()
+    src += '}'
+    src += 'return capsule;'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Buffer_dlpackDevice(BufferObject* self, PyObject* unused) {'
+    src.indent()
+    src += 'return Py_BuildValue("(ii)", (int)kDLCPU, 0);'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Buffer_arrayInterface(BufferObject* self, void* unused) {'
+    src.indent()
+    src += 'return Py_BuildValue("{s:i,s:s,s:(n),s:(NO),s:O}", "version", 3, "typestr", "%s", "shape", self->length, "data", PyLong_FromVoidPtr(self->data), Py_False, "strides", Py_None);'%(typestr)
+    src.unindent()
+    src += '}'
+    src += 'static PyMethodDef Buffer_methods[] = {'
+    src.indent()
+    src += '{"__dlpack__", (PyCFunction)(void(*)(void))Buffer_dlpack, METH_VARARGS | METH_KEYWORDS, "Exports the buffer as a DLPack capsule"},'
+    src += '{"__dlpack_device__", (PyCFunction)Buffer_dlpackDevice, METH_NOARGS, "Returns the DLPack device (CPU)"},'
+    src += '{NULL, NULL, 0, NULL}'
+    src.unindent()
+    src += '};'
+    src += 'static PyGetSetDef Buffer_getset[] = {'
+    src.indent()
+    src += '{"__array_interface__", (getter)Buffer_arrayInterface, NULL, "NumPy array interface", NULL},'
+    src += '{NULL, NULL, NULL, NULL, NULL}'
+    src.unindent()
+    src += '};'
+    src += 'static PyType_Slot Buffer_slots[] = {'
+    src.indent()
+    src += '{Py_tp_dealloc, (void*)Buffer_dealloc},'
+    src += '{Py_bf_getbuffer, (void*)Buffer_getbuffer},'
+    src += '{Py_sq_length, (void*)Buffer_length},'
+    src += '{Py_sq_item, (void*)Buffer_item},'
+    src += '{Py_sq_ass_item, (void*)Buffer_ass_item},'
+    src += '{Py_tp_methods, (void*)Buffer_methods},'
+    src += '{Py_tp_getset, (void*)Buffer_getset},'
+    src += '{0, NULL}'
+    src.unindent()
+    src += '};'
+    src += 'static PyType_Spec Buffer_spec = {"%s", sizeof(BufferObject), 0, Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION, Buffer_slots};'%(Compiler.get_type_name(k, options, 'Buffer'))
+    #Only kernels with outputs that can be omitted allocate buffers (avoids -Wunused-function)
+    if any(arg.is_output and not arg.is_input for arg in k.get_arguments()):
+      src += '//Returns a new aligned buffer'
+      src += 'static PyObject* newBuffer(ModuleState* state, Py_ssize_t length) {'
+      src.indent()
+      src += 'void* data = NULL;'
+      src += 'pthread_mutex_lock(&state->poolLock);'
+      src += 'for(int i = 0; i < state->poolSize; i++) {'
+      src.indent()
+      src += 'if(state->poolLength[i] == length) {'
+      src.indent()
+      src += 'data = state->poolData[i];'
+      src += 'state->poolSize--;'
+      src += 'state->poolData[i] = state->poolData[state->poolSize];'
+      src += 'state->poolLength[i] = state->poolLength[state->poolSize];'
+      src += 'break;'
+      src.unindent()
+      src += '}'
+      src.unindent()
+      src += '}'
+      src += 'pthread_mutex_unlock(&state->poolLock);'
+      src += 'if(data == NULL && posix_memalign(&data, 64, length * sizeof(%s)) != 0) {'%(type)
+      src.indent()
+      src += 'return PyErr_NoMemory();'
+      src.unindent()
+      src += '}'
+      src += 'BufferObject* buffer = PyObject_New(BufferObject, state->BufferType);'
+      src += 'if(buffer == NULL) {'
+      src.indent()
+      src += 'free(data);'
+      src += 'return NULL;'
+      src.unindent()
+      src += '}'
+      src += 'buffer->data = data;'
+      src += 'buffer->length = length;'
+      src += 'return (PyObject*)buffer;'
+      src.unindent()
+      src += '}'
+      src += ''
+
+  #Generates the DLPack ABI declarations (shared by all kernels of a module)
+  def compile_python_dlpack(src):
+    src += '//DLPack ABI (see dlpack.h)'
+    src += 'enum { kDLCPU = 1 };'
+    src += 'typedef struct { int32_t device_type; int32_t device_id; } DLDevice;'
+    src += 'typedef struct { uint8_t code; uint8_t bits; uint16_t lanes; } DLDataType;'
+    src += 'typedef struct { void* data; DLDevice device; int32_t ndim; DLDataType dtype; int64_t* shape; int64_t* strides; uint64_t byte_offset; } DLTensor;'
+    src += 'typedef struct DLManagedTensor { DLTensor dl_tensor; void* manager_ctx; void (*deleter)(struct DLManagedTensor*); } DLManagedTensor;'
+
+  #Generates the code that extracts kernel arguments from Python objects
+  def compile_python_args(k, options, src):
+    type = options.type
+    if DataType.is_floating(type):
+      format, typestr, dl_code, type_name = 'f', '<f4', 2, 'float32'
+    else:
+      format, typestr, dl_code, type_name = 'I', '<u4', 1, 'uint32'
+    if options.library is None:
+      Compiler.compile_python_dlpack(src)
+    src += ''
+    src += '//An array argument extracted from a Python object'
+    src += 'typedef struct {'
+    src.indent()
+    src += '//First element, number of elements, and element stride'
+    src += 'char* buf;'
+    src += 'Py_ssize_t length;'
+    src += 'int64_t stride;'
+    src += '//Buffer protocol view, if one was acquired'
+    src += 'Py_buffer buffer;'
+    src += 'bool hasBuffer;'
+    src += '//DLPack capsule or array interface, kept alive while the kernel runs'
+    src += 'PyObject* owner;'
+    src.unindent()
+    src += '} ArgView;'
+    src += '//Releases an argument (safe to call on a zeroed view)'
+    src += 'static void releaseArg(ArgView* view) {'
+    src.indent()
+    src += 'if(view->hasBuffer) {'
+    src.indent()
+    src += 'PyBuffer_Release(&view->buffer);'
+    src += 'view->hasBuffer = false;'
+    src.unindent()
+    src += '}'
+    src += 'Py_CLEAR(view->owner);'
+    src.unindent()
+    src += '}'
+    src += '//Returns true if a buffer format (struct syntax, native or little-endian) is %s'%(type_name)
+    src += 'static bool isFormat(const char* format) {'
+    src.indent()
+    src += 'if(format == NULL) {'
+    src.indent()
+    src += 'return false;'
+    src.unindent()
+    src += '}'
+    src += 'if(format[0] == \'@\' || format[0] == \'=\' || format[0] == \'<\') {'
+    src.indent()
+    src += 'format++;'
+    src.unindent()
+    src += '}'
+    src += 'return format[0] == \'%s\' && format[1] == \'\\0\';'%(format)
+    src.unindent()
+    src += '}'
+    src += '//Extracts an argument from a buffer, a DLPack tensor, or an object with __array_interface__'
+    src += 'static int getArg(PyObject* obj, ArgView* view, bool writable, const char* name) {'
+    src.indent()
+    src += 'const Py_ssize_t size = sizeof(%s);'%(type)
+    src += 'view->stride = 1;'
+    src += '//Python buffer protocol'
+    src += 'if(PyObject_CheckBuffer(obj)) {'
+    src.indent()
+    src += 'if(PyObject_GetBuffer(obj, &view->buffer, PyBUF_STRIDES | PyBUF_FORMAT | (writable ? PyBUF_WRITABLE : 0)) != 0) {'
+    src.indent()
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'view->hasBuffer = true;'
+    src += 'if(view->buffer.itemsize != size || !isFormat(view->buffer.format)) {'
+    src.indent()
+    src += 'PyErr_Format(PyExc_TypeError, "Expected an array of %s (%%s)", name);'%(type_name)
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'view->buf = (char*)view->buffer.buf;'
+    src += 'view->length = view->buffer.len / size;'
+    src += 'if(!PyBuffer_IsContiguous(&view->buffer, \'C\')) {'
+    src.indent()
+    src += 'if(view->buffer.ndim != 1 || view->buffer.strides[0] % size != 0) {'
+    src.indent()
+    src += 'PyErr_Format(PyExc_ValueError, "Unsupported buffer layout (%s)", name);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'view->stride = view->buffer.strides[0] / size;'
+    src.unindent()
+    src += '}'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    src += '//DLPack capsule, or an object that exports one'
+    src += 'if(PyCapsule_IsValid(obj, "dltensor")) {'
+    src.indent()
+    src += 'Py_INCREF(obj);'
+    src += 'view->owner = obj;'
+    src.unindent()
+    src += '} else if(PyObject_HasAttrString(obj, "__dlpack__")) {'
+    src.indent()
+    src += 'view->owner = PyObject_CallMethod(obj, "__dlpack__", NULL);'
+    src += 'if(view->owner == NULL) {'
+    src.indent()
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += 'if(view->owner != NULL) {'
+    src.indent()
+    src += '//The capsule is not marked as consumed, so its destructor still frees the tensor'
+    src += 'DLManagedTensor* managed = (DLManagedTensor*)PyCapsule_GetPointer(view->owner, "dltensor");'
+    src += 'if(managed == NULL) {'
+    src.indent()
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'DLTensor* tensor = &managed->dl_tensor;'
+    src += 'if(tensor->device.device_type != kDLCPU || tensor->dtype.code != %d || tensor->dtype.bits != 32 || tensor->dtype.lanes != 1) {'%(dl_code)
+    src.indent()
+    src += 'PyErr_Format(PyExc_TypeError, "Expected a CPU tensor of %s (%%s)", name);'%(type_name)
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'if(tensor->ndim != 1 && tensor->strides != NULL) {'
+    src.indent()
+    src += 'PyErr_Format(PyExc_ValueError, "Unsupported tensor layout (%s)", name);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'view->buf = (char*)tensor->data + tensor->byte_offset;'
+    src += 'view->length = 1;'
+    src += 'for(int32_t d = 0; d < tensor->ndim; d++) {'
+    src.indent()
+    src += 'view->length *= tensor->shape[d];'
+    src.unindent()
+    src += '}'
+    src += 'if(tensor->strides != NULL) {'
+    src.indent()
+    src += 'view->stride = tensor->strides[0];'
+    src.unindent()
+    src += '}'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    src += '//NumPy-style array interface'
+    src += 'view->owner = PyObject_GetAttrString(obj, "__array_interface__");'
+    src += 'if(view->owner == NULL || !PyDict_Check(view->owner)) {'
+    src.indent()
+    src += 'PyErr_Clear();'
+    src += 'PyErr_Format(PyExc_TypeError, "Expected a buffer, DLPack tensor, or array interface (%s)", name);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'PyObject* typestr = PyDict_GetItemString(view->owner, "typestr");'
+    src += 'PyObject* data = PyDict_GetItemString(view->owner, "data");'
+    src += 'PyObject* shape = PyDict_GetItemString(view->owner, "shape");'
+    src += 'PyObject* strides = PyDict_GetItemString(view->owner, "strides");'
+    src += 'if(typestr == NULL || !PyUnicode_Check(typestr) || PyUnicode_CompareWithASCIIString(typestr, "%s") != 0) {'%(typestr)
+    src.indent()
+    src += 'PyErr_Format(PyExc_TypeError, "Expected an array of %s (%%s)", name);'%(type_name)
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'if(data == NULL || !PyTuple_Check(data) || PyTuple_Size(data) != 2 || shape == NULL || !PyTuple_Check(shape) || PyTuple_Size(shape) != 1) {'
+    src.indent()
+    src += 'PyErr_Format(PyExc_ValueError, "Unsupported array interface (%s)", name);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'if(writable && PyObject_IsTrue(PyTuple_GetItem(data, 1))) {'
+    src.indent()
+    src += 'PyErr_Format(PyExc_ValueError, "Array is read-only (%s)", name);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'view->buf = (char*)PyLong_AsVoidPtr(PyTuple_GetItem(data, 0));'
+    src += 'view->length = PyLong_AsSsize_t(PyTuple_GetItem(shape, 0));'
+    src += 'if(strides != NULL && strides != Py_None) {'
+    src.indent()
+    src += 'Py_ssize_t step = PyLong_AsSsize_t(PyTuple_GetItem(strides, 0));'
+    src += 'if(step % size != 0) {'
+    src.indent()
+    src += 'PyErr_Format(PyExc_ValueError, "Unsupported array layout (%s)", name);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'view->stride = step / size;'
+    src.unindent()
+    src += '}'
+    src += 'return PyErr_Occurred() ? -1 : 0;'
+    src.unindent()
+    src += '}'
+    src += ''
+
+  #Generates the handle type returned by the non-blocking Python entry point
+  def compile_python_handle(k, options, src):
+    optional = [arg for arg in k.get_arguments() if arg.is_output and not arg.is_input]
+    src += '//Handle to a call running on native threads'
+    src += 'typedef struct {'
+    src.indent()
+    src += 'PyObject_HEAD'
+    src += 'Call call;'
+    src += 'std::atomic<bool> cancel;'
+    src += 'bool finished;'
+    src += 'bool ok;'
+    src += 'pthread_mutex_t lock;'
+    src += 'pthread_cond_t cond;'
+    src += '//Callbacks to run once finished (swapped out under the lock)'
+    src += 'PyObject* callbacks;'
+    src += 'PyInterpreterState* interp;'
+    src.unindent()
+    src += '} HandleObject;'
+    src += 'static void Handle_dealloc(HandleObject* self) {'
+    src.indent()
+    src += '//Release the arguments that were kept alive for the call'
+    for arg in k.get_arguments(uniform=False):
+      cond = '' if arg not in optional else '!self->call.alloc_%s'%(arg.name)
+      if arg in optional:
+        src += 'if(%s) {'%(cond)
+        src.indent()
+        src += 'Py_XDECREF(self->call.obj_%s);'%(arg.name)
+        src.unindent()
+        src += '}'
+      else:
+        src += 'Py_XDECREF(self->call.obj_%s);'%(arg.name)
+    src += 'releaseCall(&self->call);'
+    src += 'Py_XDECREF(self->callbacks);'
+    src += 'pthread_mutex_destroy(&self->lock);'
+    src += 'pthread_cond_destroy(&self->cond);'
+    src += 'PyTypeObject* type = Py_TYPE(self);'
+    src += 'type->tp_free((PyObject*)self);'
+    src += 'Py_DECREF(type);'
+    src.unindent()
+    src += '}'
+    src += '//Runs the call, then notifies waiters and callbacks'
+    src += 'static void* handleWorker(void* v) {'
+    src.indent()
+    src += 'HandleObject* self = (HandleObject*)v;'
+    src += 'const bool ok = runChunked(&self->call.args, &self->cancel);'
+    src += 'pthread_mutex_lock(&self->lock);'
+    src += 'self->ok = ok;'
+    src += 'self->finished = true;'
+    src += 'PyObject* callbacks = self->callbacks;'
+    src += 'self->callbacks = NULL;'
+    src += 'pthread_cond_broadcast(&self->cond);'
+    src += 'pthread_mutex_unlock(&self->lock);'
+    src += '//Callbacks run on this thread, attached to the interpreter that submitted the call'
+    src += 'Attachment attachment = attachThread(self->interp);'
+    src += 'for(Py_ssize_t i = 0; callbacks != NULL && i < PyList_GET_SIZE(callbacks); i++) {'
+    src.indent()
+    src += 'PyObject* result = PyObject_CallOneArg(PyList_GET_ITEM(callbacks, i), (PyObject*)self);'
+    src += 'if(result == NULL) {'
+    src.indent()
+    src += 'PyErr_WriteUnraisable(PyList_GET_ITEM(callbacks, i));'
+    src.unindent()
+    src += '}'
+    src += 'Py_XDECREF(result);'
+    src.unindent()
+    src += '}'
+    src += 'Py_XDECREF(callbacks);'
+    src += '//Drop the reference that kept the handle (and its buffers) alive while running'
+    src += 'Py_DECREF(self);'
+    src += 'detachThread(attachment);'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'static bool Handle_isFinished(HandleObject* self) {'
+    src.indent()
+    src += 'pthread_mutex_lock(&self->lock);'
+    src += 'const bool finished = self->finished;'
+    src += 'pthread_mutex_unlock(&self->lock);'
+    src += 'return finished;'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Handle_done(HandleObject* self, PyObject* unused) {'
+    src.indent()
+    src += 'return PyBool_FromLong(Handle_isFinished(self));'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Handle_cancel(HandleObject* self, PyObject* unused) {'
+    src.indent()
+    src += '//Chunks already running complete, but no new chunks are started'
+    src += 'if(Handle_isFinished(self)) {'
+    src.indent()
+    src += 'Py_RETURN_FALSE;'
+    src.unindent()
+    src += '}'
+    src += 'self->cancel = true;'
+    src += 'Py_RETURN_TRUE;'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Handle_cancelled(HandleObject* self, PyObject* unused) {'
+    src.indent()
+    src += 'return PyBool_FromLong(self->cancel);'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Handle_result(HandleObject* self, PyObject* unused) {'
+    src.indent()
+    src += '//Wait for completion without holding the GIL'
+    src += 'Py_BEGIN_ALLOW_THREADS'
+    src += 'pthread_mutex_lock(&self->lock);'
+    src += 'while(!self->finished) {'
+    src.indent()
+    src += 'pthread_cond_wait(&self->cond, &self->lock);'
+    src.unindent()
+    src += '}'
+    src += 'pthread_mutex_unlock(&self->lock);'
+    src += 'Py_END_ALLOW_THREADS'
+    src += 'if(!self->ok) {'
+    src.indent()
+    src += 'PyErr_SetString(PyExc_RuntimeError, self->cancel ? "Kernel call was cancelled" : "Kernel reported failure");'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'return finishCall(&self->call);'
+    src.unindent()
+    src += '}'
+    src += 'static PyObject* Handle_addDoneCallback(HandleObject* self, PyObject* callback) {'
+    src.indent()
+    src += '//Queue the callback unless the worker has already taken the queue'
+    src += 'pthread_mutex_lock(&self->lock);'
+    src += 'const bool finished = self->finished;'
+    src += 'const int status = finished ? 0 : PyList_Append(self->callbacks, callback);'
+    src += 'pthread_mutex_unlock(&self->lock);'
+    src += 'if(status != 0) {'
+    src.indent()
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += '//Finished calls invoke the callback immediately'
+    src += 'if(finished) {'
+    src.indent()
+    src += 'PyObject* result = PyObject_CallOneArg(callback, (PyObject*)self);'
+    src += 'if(result == NULL) {'
+    src.indent()
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'Py_DECREF(result);'
+    src.unindent()
+    src += '}'
+    src += 'Py_RETURN_NONE;'
+    src.unindent()
+    src += '}'
+    src += 'static PyMethodDef Handle_methods[] = {'
+    src.indent()
+    src += '{"done", (PyCFunction)Handle_done, METH_NOARGS, "Returns True if the call has finished"},'
+    src += '{"cancel", (PyCFunction)Handle_cancel, METH_NOARGS, "Stops scheduling new chunks; returns False if the call already finished"},'
+    src += '{"cancelled", (PyCFunction)Handle_cancelled, METH_NOARGS, "Returns True if cancellation was requested"},'
+    src += '{"result", (PyCFunction)Handle_result, METH_NOARGS, "Waits for the call to finish and returns its result"},'
+    src += '{"add_done_callback", (PyCFunction)Handle_addDoneCallback, METH_O, "Calls fn(handle) once the call finishes (on a native thread)"},'
+    src += '{NULL, NULL, 0, NULL}'
+    src.unindent()
+    src += '};'
+    src += 'static PyType_Slot Handle_slots[] = {'
+    src.indent()
+    src += '{Py_tp_dealloc, (void*)Handle_dealloc},'
+    src += '{Py_tp_methods, (void*)Handle_methods},'
+    src += '{0, NULL}'
+    src.unindent()
+    src += '};'
+    src += 'static PyType_Spec Handle_spec = {"%s", sizeof(HandleObject), 0, Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION, Handle_slots};'%(Compiler.get_type_name(k, options, 'Handle'))
+    src += ''
+    #Non-blocking wrapper
+    src += '//Non-blocking wrapper for the core function (vectorcall): returns a Handle'
+    src += 'static PyObject* %s_runAsync(PyObject* self, PyObject* const* pyArgs, Py_ssize_t nargs, PyObject* kwnames) {'%(k.name)
+    src.indent()
+    src += 'ModuleState* state = getState(PyModule_GetState(self));'
+    src += 'HandleObject* handle = PyObject_New(HandleObject, state->HandleType);'
+    src += 'if(handle == NULL) {'
+    src.indent()
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'memset(&handle->call, 0, sizeof(Call));'
+    src += 'new (&handle->cancel) std::atomic<bool>(false);'
+    src += 'handle->finished = false;'
+    src += 'handle->ok = false;'
+    src += 'handle->callbacks = PyList_New(0);'
+    src += 'handle->interp = PyInterpreterState_Get();'
+    src += 'pthread_mutex_init(&handle->lock, NULL);'
+    src += 'pthread_cond_init(&handle->cond, NULL);'
+    src += 'const bool prepared = handle->callbacks != NULL && prepareCall(state, &handle->call, pyArgs, nargs, kwnames) == 0;'
+    src += '//Keep the argument objects alive until the handle is released'
+    for arg in k.get_arguments(uniform=False):
+      if arg in optional:
+        src += 'if(!handle->call.alloc_%s) {'%(arg.name)
+        src.indent()
+        src += 'Py_XINCREF(handle->call.obj_%s);'%(arg.name)
+        src.unindent()
+        src += '}'
+      else:
+        src += 'Py_XINCREF(handle->call.obj_%s);'%(arg.name)
+    src += 'if(!prepared) {'
+    src.indent()
+    src += 'Py_DECREF(handle);'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += '//The worker thread holds its own reference until it finishes'
+    src += 'Py_INCREF(handle);'
+    src += 'pthread_t thread;'
+    src += 'if(pthread_create(&thread, NULL, handleWorker, (void*)handle) != 0) {'
+    src.indent()
+    src += 'Py_DECREF(handle);'
+    src += 'Py_DECREF(handle);'
+    src += 'PyErr_SetString(PyExc_RuntimeError, "Unable to start a thread");'
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'pthread_detach(thread);'
+    src += 'return (PyObject*)handle;'
+    src.unindent()
+    src += '}'
+    src += ''
+
+  #Generates the Python API
+  def compile_python(k, options):
+    type = options.type
+    args = k.get_arguments()
+    if DataType.is_floating(type):
+      uniform_ctype = 'float'
+    elif DataType.is_integral(type):
+      uniform_ctype = 'unsigned int'
+    else:
+      raise Exception('Unsupported data type (%s)'%(type))
+    #Outputs that aren't read can be omitted (or None) and are allocated here
+    optional = [arg for arg in args if arg.is_output and not arg.is_input]
+    src = Formatter()
+    src.section('VecPy generated entry point: Python')
+    #Includes
+    src += '//Includes'
+    src += '#include <Python.h>'
+    src += '#include <stdlib.h>'
+    src += '#include <string.h>'
+    src += '#include <new>'
+    src += ''
+    Compiler.compile_python_args(k, options, src)
+    Compiler.compile_python_buffer(k, options, src)
+    #State of a single call
+    src += '//Arguments of a single call'
+    src += 'typedef struct {'
+    src.indent()
+    for arg in k.get_arguments(uniform=False):
+      src += 'PyObject* obj_%s;'%(arg.name)
+      src += 'ArgView vp_%s;'%(arg.name)
+    for arg in optional:
+      src += 'bool alloc_%s;'%(arg.name)
+    src += 'KernelArgs args;'
+    src.unindent()
+    src += '} Call;'
+    src += '//Argument names, for keyword arguments'
+    src += 'static const char* const %s_names[] = {%s};'%(k.name, ', '.join('"%s"'%(arg.name) for arg in args))
+    #Argument decoding
+    src += '//Decodes (vectorcall) arguments into a zeroed call; releaseCall must be called afterwards'
+    src += 'static int prepareCall(ModuleState* state, Call* call, PyObject* const* pyArgs, Py_ssize_t nargs, PyObject* kwnames) {'
+    src.indent()
+    src += 'PyObject* objs[%d] = {NULL};'%(len(args))
+    src += '//Decode positional arguments'
+    src += 'if(nargs > %d) {'%(len(args))
+    src.indent()
+    src += 'PyErr_SetString(PyExc_TypeError, "%s() takes at most %d arguments");'%(k.name, len(args))
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'for(Py_ssize_t i = 0; i < nargs; i++) {'
+    src.indent()
+    src += 'objs[i] = pyArgs[i];'
+    src.unindent()
+    src += '}'
+    src += '//Decode keyword arguments'
+    src += 'if(kwnames != NULL) {'
+    src.indent()
+    src += 'for(Py_ssize_t j = 0; j < PyTuple_GET_SIZE(kwnames); j++) {'
+    src.indent()
+    src += 'PyObject* key = PyTuple_GET_ITEM(kwnames, j);'
+    src += 'int i = 0;'
+    src += 'while(i < %d && PyUnicode_CompareWithASCIIString(key, %s_names[i]) != 0) {'%(len(args), k.name)
+    src.indent()
+    src += 'i++;'
+    src.unindent()
+    src += '}'
+    src += 'if(i == %d || objs[i] != NULL) {'%(len(args))
+    src.indent()
+    src += 'PyErr_Format(PyExc_TypeError, "Unexpected or repeated argument (%U)", key);'
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'objs[i] = pyArgs[nargs + j];'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += '//Get Python objects'
+    for i, arg in enumerate(args):
+      if arg not in optional:
+        src += 'if(objs[%d] == NULL) {'%(i)
+        src.indent()
+        src += 'PyErr_SetString(PyExc_TypeError, "Missing argument (%s)");'%(arg.name)
+        src += 'return -1;'
+        src.unindent()
+        src += '}'
+      if arg.is_uniform:
+        src += 'call->args.%s = (%s)%s(objs[%d]);'%(arg.name, uniform_ctype, 'PyFloat_AsDouble' if DataType.is_floating(type) else 'PyLong_AsUnsignedLong', i)
+        src += 'if(call->args.%s == (%s)-1 && PyErr_Occurred()) {'%(arg.name, uniform_ctype)
+        src.indent()
+        src += 'return -1;'
+        src.unindent()
+        src += '}'
+      else:
+        src += 'call->obj_%s = objs[%d];'%(arg.name, i)
+    if len(optional) > 0:
+      src += '//Omitted outputs are allocated once the number of elements is known'
+      for arg in optional:
+        src += 'call->alloc_%s = call->obj_%s == NULL || call->obj_%s == Py_None;'%(arg.name, arg.name, arg.name)
+        src += 'if(call->alloc_%s) {'%(arg.name)
+        src.indent()
+        src += 'call->obj_%s = NULL;'%(arg.name)
+        src.unindent()
+        src += '}'
+    src += '//Get arrays from Python objects'
+    for arg in k.get_arguments(uniform=False):
+      cond = 'getArg(call->obj_%s, &call->vp_%s, %s, "%s") != 0'%(arg.name, arg.name, 'true' if arg.is_output else 'false', arg.name)
+      if arg in optional:
+        cond = '!call->alloc_%s && %s'%(arg.name, cond)
+      src += 'if(%s) {'%(cond)
+      src.indent()
+      src += 'return -1;'
+      src.unindent()
+      src += '}'
+    #Get the number of elements from the length of the first array
+    src += '//Number of elements to process'
+    candidates = [arg for arg in k.get_arguments(uniform=False, fuse=False) if arg not in optional]
+    if len(candidates) == 0:
+      raise Exception('Kernel must take at least one non-uniform, non-fuse input')
+    arg = candidates[0]
+    src += 'const uint64_t N = call->vp_%s.length%s;'%(arg.name, ' / %d'%(arg.stride) if arg.stride > 1 else '')
+    for arg in optional:
+      num = '1' if arg.is_fuse else 'N'
+      src += 'if(call->alloc_%s) {'%(arg.name)
+      src.indent()
+      src += 'call->obj_%s = newBuffer(state, %s);'%(arg.name, num)
+      src += 'if(call->obj_%s == NULL || getArg(call->obj_%s, &call->vp_%s, true, "%s") != 0) {'%(arg.name, arg.name, arg.name, arg.name)
+      src.indent()
+      src += 'return -1;'
+      src.unindent()
+      src += '}'
+      src.unindent()
+      src += '}'
+    src += '//Check length (and contiguity of whole-array arguments) for all arrays'
+    for arg in k.get_arguments(uniform=False):
+      num = 'N'
+      if arg.stride > 1:
+        num = '%s * %d'%(num, arg.stride)
+      elif arg.is_fuse:
+        num = '1'
+      cond = 'call->vp_%s.length != (Py_ssize_t)(%s)'%(arg.name, num)
+      if arg.is_fuse or arg.stride > 1:
+        cond += ' || call->vp_%s.stride != 1'%(arg.name)
+      src += 'if(%s) {'%(cond)
+      src.indent()
+      src += 'PyErr_SetString(PyExc_ValueError, "Array sizes don\'t match (%s)");'%(arg.name)
+      src += 'return -1;'
+      src.unindent()
+      src += '}'
+    src += '//Extract input arrays'
+    for arg in k.get_arguments(uniform=False):
+      src += 'call->args.%s = (%s*)call->vp_%s.buf;'%(arg.name, type, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'call->args.%s_stride = call->vp_%s.stride;'%(arg.name, arg.name)
+    src += 'call->args.N = N;'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    #Result of a call
+    src += '//Returns the result of a completed call'
+    src += 'static PyObject* finishCall(Call* call) {'
+    src.indent()
+    if len(optional) > 0:
+      outputs = k.get_arguments(output=True)
+      src += '//Return the outputs if any were allocated here'
+      src += 'if(%s) {'%(' || '.join('call->alloc_%s'%(arg.name) for arg in optional))
+      src.indent()
+      src += 'return PyTuple_Pack(%d, %s);'%(len(outputs), ', '.join('call->obj_%s'%(arg.name) for arg in outputs))
+      src.unindent()
+      src += '}'
+    src += 'Py_RETURN_TRUE;'
+    src.unindent()
+    src += '}'
+    src += '//Releases arrays and any outputs allocated for a call'
+    src += 'static void releaseCall(Call* call) {'
+    src.indent()
+    for arg in k.get_arguments(uniform=False):
+      src += 'releaseArg(&call->vp_%s);'%(arg.name)
+    for arg in optional:
+      src += 'if(call->alloc_%s) {'%(arg.name)
+      src.indent()
+      src += 'Py_CLEAR(call->obj_%s);'%(arg.name)
+      src.unindent()
+      src += '}'
+    src.unindent()
+    src += '}'
+    src += ''
+    Compiler.compile_python_handle(k, options, src)
+    #Wrapper for the core function
+    src += '//Wrapper for the core function (vectorcall)'
+    src += 'static PyObject* %s_run(PyObject* self, PyObject* const* pyArgs, Py_ssize_t nargs, PyObject* kwnames) {'%(k.name)
+    src.indent()
+    src += 'Call call;'
+    src += 'memset(&call, 0, sizeof(Call));'
+    src += 'PyObject* result = NULL;'
+    src += 'if(prepareCall(getState(PyModule_GetState(self)), &call, pyArgs, nargs, kwnames) == 0) {'
+    src.indent()
+    src += '//The arrays stay acquired, so other Python threads may run meanwhile'
+    src += 'bool ok;'
+    src += 'Py_BEGIN_ALLOW_THREADS'
+    src += 'ok = run(&call.args);'
+    src += 'Py_END_ALLOW_THREADS'
+    src += 'if(ok) {'
+    src.indent()
+    src += 'result = finishCall(&call);'
+    src.unindent()
+    src += '} else {'
+    src.indent()
+    src += 'PyErr_SetString(PyExc_RuntimeError, "Kernel reported failure");'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += 'releaseCall(&call);'
+    src += 'return result;'
+    src.unindent()
+    src += '}'
+    src += ''
+    #Batched wrapper
+    src += '//Batched wrapper: runs a sequence of argument tuples in one dispatch'
+    src += 'static PyObject* %s_runBatch(PyObject* self, PyObject* jobs) {'%(k.name)
+    src.indent()
+    src += 'ModuleState* state = getState(PyModule_GetState(self));'
+    src += 'PyObject* seq = PySequence_Fast(jobs, "Expected a sequence of argument tuples");'
+    src += 'if(seq == NULL) {'
+    src.indent()
+    src += 'return NULL;'
+    src.unindent()
+    src += '}'
+    src += 'const Py_ssize_t numJobs = PySequence_Fast_GET_SIZE(seq);'
+    src += 'Call* calls = (Call*)calloc(numJobs > 0 ? numJobs : 1, sizeof(Call));'
+    src += 'PyObject** items = (PyObject**)calloc(numJobs > 0 ? numJobs : 1, sizeof(PyObject*));'
+    src += 'KernelArgs* jobArgs = new KernelArgs[numJobs > 0 ? numJobs : 1];'
+    src += 'PyObject* result = NULL;'
+    src += 'bool ok = calls != NULL && items != NULL;'
+    src += 'if(!ok) {'
+    src.indent()
+    src += 'PyErr_NoMemory();'
+    src.unindent()
+    src += '}'
+    src += '//Acquire every job\'s arrays up front'
+    src += 'for(Py_ssize_t j = 0; ok && j < numJobs; j++) {'
+    src.indent()
+    src += 'items[j] = PySequence_Fast(PySequence_Fast_GET_ITEM(seq, j), "Expected a tuple of arguments");'
+    src += 'ok = items[j] != NULL && prepareCall(state, &calls[j], PySequence_Fast_ITEMS(items[j]), PySequence_Fast_GET_SIZE(items[j]), NULL) == 0;'
+    src += 'if(ok) {'
+    src.indent()
+    src += 'jobArgs[j] = calls[j].args;'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += '//Run all jobs without holding the GIL'
+    src += 'if(ok) {'
+    src.indent()
+    src += 'Py_BEGIN_ALLOW_THREADS'
+    src += 'ok = runBatch(jobArgs, numJobs);'
+    src += 'Py_END_ALLOW_THREADS'
+    src += 'if(!ok) {'
+    src.indent()
+    src += 'PyErr_SetString(PyExc_RuntimeError, "Kernel reported failure");'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += 'if(ok) {'
+    src.indent()
+    src += 'result = PyList_New(numJobs);'
+    src += 'for(Py_ssize_t j = 0; result != NULL && j < numJobs; j++) {'
+    src.indent()
+    src += 'PyObject* item = finishCall(&calls[j]);'
+    src += 'if(item == NULL) {'
+    src.indent()
+    src += 'Py_CLEAR(result);'
+    src.unindent()
+    src += '} else {'
+    src.indent()
+    src += 'PyList_SET_ITEM(result, j, item);'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src.unindent()
+    src += '}'
+    src += '//Release everything'
+    src += 'for(Py_ssize_t j = 0; calls != NULL && items != NULL && j < numJobs; j++) {'
+    src.indent()
+    src += 'releaseCall(&calls[j]);'
+    src += 'Py_XDECREF(items[j]);'
+    src.unindent()
+    src += '}'
+    src += 'free(calls);'
+    src += 'free(items);'
+    src += 'delete [] jobArgs;'
+    src += 'Py_DECREF(seq);'
+    src += 'return result;'
+    src.unindent()
+    src += '}'
+    src += ''
+    #Module manifest
+    src += '//Module manifest'
+    src += 'static PyMethodDef module_methods[] = {'
+    src.indent()
+    src += '{'
+    src.indent()
+    src += '//Export name, visible within Python'
+    src += '"%s",'%(k.name)
+    src += '//Pointer to local implementation'
+    src += '(PyCFunction)(void(*)(void))%s_run,'%(k.name)
+    src += '//Accept positional and keyword arguments through vectorcall'
+    src += 'METH_FASTCALL | METH_KEYWORDS,'
+    src += '//Function documentation'
+    src += '"%s"'%('\n'.join(k.docstring.splitlines()))
+    src.unindent()
+    src += '},{'
+    src.indent()
+    src += '"%s_batch",'%(k.name)
+    src += '%s_runBatch,'%(k.name)
+    src += '//Accept a single sequence of argument tuples'
+    src += 'METH_O,'
+    src += '"Runs %s on each tuple of arguments in a sequence, in one dispatch."'%(k.name)
+    src.unindent()
+    src += '},{'
+    src.indent()
+    src += '"%s_submit",'%(k.name)
+    src += '(PyCFunction)(void(*)(void))%s_runAsync,'%(k.name)
+    src += 'METH_FASTCALL | METH_KEYWORDS,'
+    src += '"Starts %s on native threads and returns a Handle without waiting for it."'%(k.name)
+    src.unindent()
+    src += '},{NULL, NULL, 0, NULL} //End of manifest entries'
+    src.unindent()
+    src += '};'
+    src += ''
+    #Module lifecycle
+    src += '//Creates the per-module state (multi-phase initialization)'
+    src += 'static int module_exec(PyObject* m) {'
+    src.indent()
+    src += 'ModuleState* state = getState(PyModule_GetState(m));'
+    src += 'pthread_mutex_init(&state->poolLock, NULL);'
+    src += 'state->poolSize = 0;'
+    src += 'state->BufferType = (PyTypeObject*)PyType_FromModuleAndSpec(m, &Buffer_spec, NULL);'
+    src += 'state->HandleType = (PyTypeObject*)PyType_FromModuleAndSpec(m, &Handle_spec, NULL);'
+    src += 'if(state->BufferType == NULL || state->HandleType == NULL) {'
+    src.indent()
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    src += 'if(PyModule_AddType(m, state->BufferType) != 0 || PyModule_AddType(m, state->HandleType) != 0) {'
+    src.indent()
+    src += 'return -1;'
+    src.unindent()
+    src += '}'
+    if Binding.numpy in options.bindings:
+      src += 'if(add_ufuncs(m) != 0) {'
+      src.indent()
+      src += 'return -1;'
+      src.unindent()
+      src += '}'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    src += 'static int module_traverse(PyObject* m, visitproc visit, void* arg) {'
+    src.indent()
+    src += 'ModuleState* state = getState(PyModule_GetState(m));'
+    src += 'Py_VISIT(state->BufferType);'
+    src += 'Py_VISIT(state->HandleType);'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    src += 'static int module_clear(PyObject* m) {'
+    src.indent()
+    src += 'ModuleState* state = getState(PyModule_GetState(m));'
+    src += 'Py_CLEAR(state->BufferType);'
+    src += 'Py_CLEAR(state->HandleType);'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
+    src += 'static void module_free(void* m) {'
+    src.indent()
+    src += 'module_clear((PyObject*)m);'
+    src += '//No buffers are left once the module is freed (each holds a reference to it)'
+    src += 'ModuleState* state = getState(PyModule_GetState((PyObject*)m));'
+    src += 'for(int i = 0; i < state->poolSize; i++) {'
+    src.indent()
+    src += 'free(state->poolData[i]);'
+    src.unindent()
+    src += '}'
+    src += 'state->poolSize = 0;'
+    src += 'pthread_mutex_destroy(&state->poolLock);'
+    src.unindent()
+    src += '}'
+    #Modules of several kernels are defined by the library (see compile_library_core)
+    if options.library is None:
+      Compiler.compile_python_module(k.name, 'VecPy module for %s.'%(k.name), Binding.numpy in options.bindings, 'sizeof(ModuleState)', 'module_methods', src)
     #Save code to file
-    file_name = Compiler.get_cpp_file(k)
-    with open(file_name, 'w') as file:
+    file_name = Compiler.get_python_file(k)
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
       file.write(src.get_code())
     #print('Saved to file: %s'%(file_name))
 
-  #Generates the Python API
-  def compile_python(k, options):
+  #Generates the module definition and initializer (module_exec, module_traverse, module_clear and module_free must exist)
+  def compile_python_module(name, doc, numpy, state_size, methods, src):
+    src += 'static PyModuleDef_Slot module_slots[] = {'
+    src.indent()
+    src += '{Py_mod_exec, (void*)module_exec},'
+    src += '#if PY_VERSION_HEX >= 0x030C0000'
+    if numpy:
+      src += '//NumPy doesn\'t support subinterpreters'
+      src += '{Py_mod_multiple_interpreters, Py_MOD_MULTIPLE_INTERPRETERS_NOT_SUPPORTED},'
+    else:
+      src += '{Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},'
+    src += '#endif'
+    src += '#if PY_VERSION_HEX >= 0x030D0000'
+    src += '//All mutable state is per-module and locked, and kernels never touch Python objects'
+    src += '{Py_mod_gil, Py_MOD_GIL_NOT_USED},'
+    src += '#endif'
+    src += '{0, NULL}'
+    src.unindent()
+    src += '};'
+    src += ''
+    #Module definition
+    src += '//Module definition'
+    src += 'static struct PyModuleDef module = {'
+    src.indent()
+    src += 'PyModuleDef_HEAD_INIT,'
+    src += '//Module name'
+    src += '"vecpy_%s",'%(name)
+    src += '//Module documentation'
+    src += '"%s",'%(doc)
+    src += '//Other module info'
+    src += '%s, %s, module_slots, module_traverse, module_clear, module_free'%(state_size, methods)
+    src.unindent()
+    src += '};'
+    src += ''
+    #Module initializer
+    src += '//Module initializer'
+    src += 'PyMODINIT_FUNC PyInit_vecpy_%s() {'%(name)
+    src.indent()
+    src += 'return PyModuleDef_Init(&module);'
+    src.unindent()
+    src += '}'
+    src += ''
+
+  #Returns the (inputs, outputs) of the NumPy ufunc for this kernel
+  def get_ufunc_operands(k):
+    if len(k.get_arguments(fuse=True)) > 0 or len(k.get_arguments(array=True)) > 0:
+      raise Exception('NumPy ufuncs require elementwise arguments (no fuse or array arguments)')
+    inputs = k.get_arguments(input=True)
+    outputs = [arg for arg in k.get_arguments(uniform=False) if arg.is_output or not arg.is_input]
+    if len(outputs) == 0:
+      raise Exception('NumPy ufuncs require at least one output argument')
+    return (inputs, outputs)
+
+  #Generates the NumPy ufunc API
+  def compile_numpy(k, options):
     type = options.type
-    module_name = 'vecpy_' + k.name
-    args = k.get_arguments()
+    #Loops are registered for the kernel's type and wider types that NumPy defaults to
+    #  (the wider types are converted to the kernel's type, which the ufunc's docstring says)
     if DataType.is_floating(type):
-      uniform_pytype = 'f'
-      uniform_ctype = 'float'
+      loop_types = (('NPY_FLOAT32', 'float'), ('NPY_FLOAT64', 'double'))
+      note = 'float64 operands are computed in float32 precision and converted back.'
     elif DataType.is_integral(type):
-      uniform_pytype = 'I'
-      uniform_ctype = 'uint64_t'
+      loop_types = (('NPY_UINT32', 'uint32_t'), ('NPY_INT64', 'int64_t'), ('NPY_UINT64', 'uint64_t'))
+      note = 'int64 and uint64 operands are computed as uint32 (wrapping modulo 2**32) and converted back.'
     else:
       raise Exception('Unsupported data type (%s)'%(type))
+    inputs, outputs = Compiler.get_ufunc_operands(k)
+    operands = [('in', arg) for arg in inputs] + [('out', arg) for arg in outputs]
+    #Arguments that are both read and written are copied into the output before running
+    in_out = [arg for arg in inputs if arg in outputs]
     src = Formatter()
-    src.section('VecPy generated entry point: Python')
+    src.section('VecPy generated entry point: NumPy')
     #Includes
     src += '//Includes'
-    src += '#include <Python.h>'
+    src += '#include <string.h>'
+    src += '#include <type_traits>'
+    src += '#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION'
+    src += '#include <numpy/arrayobject.h>'
+    src += '#include <numpy/ufuncobject.h>'
     src += ''
-    #Wrapper for the core function
-    src += '//Wrapper for the core function'
-    src += 'static PyObject* %s_run(PyObject* self, PyObject* pyArgs) {'%(k.name)
-    src.indent()
-    src += '//Handles to Python objects and buffers'
-    obj_str = ', '.join('*obj_%s'%(arg.name) for arg in k.get_arguments(uniform=False))
-    src += 'PyObject %s;'%(obj_str)
-    if len(k.get_arguments(uniform=True)) > 0:
-      obj_str = ', '.join('vp_%s'%(arg.name) for arg in k.get_arguments(uniform=True))
-      src += '%s %s;'%(uniform_ctype, obj_str)
-    buf_str = ', '.join('vp_%s'%(arg.name) for arg in k.get_arguments(uniform=False))
-    src += 'Py_buffer %s;'%(buf_str)
-    src += '//Get Python objects'
-    obj_str = ', '.join('&%s_%s'%('vp' if arg.is_uniform else 'obj', arg.name) for arg in args)
-    decode_str = ''.join(uniform_pytype if arg.is_uniform else 'O' for arg in args)
-    src += 'if(!PyArg_ParseTuple(pyArgs, "%s", %s)) {'%(decode_str, obj_str)
+    #Inner loop
+    src += '//Ufunc inner loop: handles any strides and types'
+    src += 'template <typename T>'
+    src += 'static void %s_loop(char** data, npy_intp const* dimensions, npy_intp const* steps, void* extra) {'%(k.name)
     src.indent()
-    src += 'printf("Error retrieving Python objects\\n");'
-    src += 'return NULL;'
-    src.unindent()
-    src += '}'
-    src += '//Get Python buffers from Python objects'
-    for arg in k.get_arguments(uniform=False):
-      src += 'if(PyObject_GetBuffer(obj_%s, &vp_%s, %s) != 0) {'%(arg.name, arg.name, 'PyBUF_WRITABLE' if arg.is_output else '0')
+    src += 'const npy_intp n = dimensions[0];'
+    src += 'const npy_intp size = sizeof(T);'
+    src += 'const npy_intp chunkSize = 4096;'
+    src += '//Operands'
+    for i, (kind, arg) in enumerate(operands):
+      src += 'char* %s_%s = data[%d];'%(kind, arg.name, i)
+      src += 'const npy_intp step_%s_%s = steps[%d];'%(kind, arg.name, i)
+    src += 'KernelArgs args;'
+    src += '//Fast path: arrays of the kernel type (any element stride) and scalar uniforms are passed directly'
+    src += 'bool direct = std::is_same<T, %s>::value;'%(type)
+    for kind, arg in operands:
+      if arg.is_uniform:
+        src += 'direct = direct && step_%s_%s == 0;'%(kind, arg.name)
+      else:
+        src += 'direct = direct && step_%s_%s %% size == 0 && reinterpret_cast<uint64_t>(%s_%s) %% size == 0;'%(kind, arg.name, kind, arg.name)
+    src += 'if(direct) {'
+    src.indent()
+    for arg in in_out:
+      src += 'if(in_%s != out_%s) {'%(arg.name, arg.name)
       src.indent()
-      src += 'printf("Error retrieving Python buffer (%s)\\n");'%(arg.name)
-      src += 'return NULL;'
+      src += 'for(npy_intp i = 0; i < n; i++) *(T*)(out_%s + i * step_out_%s) = *(T*)(in_%s + i * step_in_%s);'%(arg.name, arg.name, arg.name, arg.name)
       src.unindent()
       src += '}'
-    #Get the number of elements from the length of the first buffer
-    src += '//Number of elements to process'
-    src += 'uint64_t N = vp_%s.len / sizeof(%s);'%(k.get_arguments(uniform=False, array=False)[0].name, type)
-    src += '//Check length for all buffers'
+    for arg in k.get_arguments():
+      if arg.is_uniform:
+        src += 'args.%s = (%s)*(T*)in_%s;'%(arg.name, type, arg.name)
+      else:
+        kind = 'out' if arg in outputs else 'in'
+        src += 'args.%s = (%s*)%s_%s;'%(arg.name, type, kind, arg.name)
+        src += 'args.%s_stride = step_%s_%s / size;'%(arg.name, kind, arg.name)
+    src += 'args.N = n;'
+    src += 'run(&args);'
+    src += 'return;'
+    src.unindent()
+    src += '}'
+    src += '//Slow path: convert through aligned scratch, run, and convert the outputs back'
+    uniforms = [arg for arg in inputs if arg.is_uniform]
     for arg in k.get_arguments(uniform=False):
-      num = 'N'
-      if arg.stride > 1:
-        num = '%s * %d'%(num, arg.stride)
-      elif arg.is_fuse:
-        num = '1'
-      src += 'if(vp_%s.len / sizeof(%s) != %s) {'%(arg.name, type, num)
+      src += 'alignas(64) %s scratch_%s[chunkSize];'%(type, arg.name)
+      src += 'args.%s = scratch_%s;'%(arg.name, arg.name)
+      src += 'args.%s_stride = 1;'%(arg.name)
+    src += 'for(npy_intp i = 0; i < n;) {'
+    src.indent()
+    src += 'npy_intp count = (n - i < chunkSize) ? (n - i) : chunkSize;'
+    if len(uniforms) > 0:
+      #Uniforms broadcast from arrays are split into runs of equal values, one call per run
+      #  (short runs use the scalar kernel, so per-element uniforms cost a scalar loop, not run())
+      src += '//Each call covers a run of elements with the same uniform values'
+      src += 'npy_intp length = 1;'
+      cond = ' && '.join('*(T*)(in_%s + (i + length) * step_in_%s) == *(T*)(in_%s + i * step_in_%s)'%(arg.name, arg.name, arg.name, arg.name) for arg in uniforms)
+      src += 'while(length < count && %s) {'%(cond)
       src.indent()
-      src += 'printf("Python buffer sizes don\'t match (%s)\\n");'%(arg.name)
-      src += 'return NULL;'
+      src += 'length++;'
       src.unindent()
       src += '}'
-    src += '//Extract input arrays from buffers'
-    src += 'KernelArgs args;'
-    for arg in args:
+      src += 'count = length;'
+    for arg in inputs:
       if arg.is_uniform:
-        src += 'args.%s = vp_%s;'%(arg.name, arg.name)
+        src += 'args.%s = (%s)*(T*)(in_%s + i * step_in_%s);'%(arg.name, type, arg.name, arg.name)
       else:
-        src += 'args.%s = (%s*)vp_%s.buf;'%(arg.name, type, arg.name)
-    src += 'args.N = N;'
-    src += '//Run the kernel'
-    src += 'bool result = run(&args);'
-    src += '//Release buffers'
-    for arg in k.get_arguments(uniform=False):
-      src += 'PyBuffer_Release(&vp_%s);'%(arg.name)
-    src += '//Return the result'
-    src += 'if(result) { Py_RETURN_TRUE; } else { printf("Kernel reported failure\\n"); Py_RETURN_FALSE; }'
+        src += 'for(npy_intp j = 0; j < count; j++) scratch_%s[j] = (%s)*(T*)(in_%s + (i + j) * step_in_%s);'%(arg.name, type, arg.name, arg.name)
+    src += 'args.N = count;'
+    if len(uniforms) > 0:
+      #Uniforms that change every element would otherwise dispatch run() once per element
+      src += '//Runs shorter than a vector (e.g. uniforms that change every element) go straight to the scalar kernel'
+      src += 'if(count < %d) {'%(options.arch['size'])
+      src.indent()
+      src += '%s_scalar(&args);'%(k.name)
+      src.unindent()
+      src += '} else {'
+      src.indent()
+      src += 'run(&args);'
+      src.unindent()
+      src += '}'
+    else:
+      src += 'run(&args);'
+    for arg in outputs:
+      src += 'for(npy_intp j = 0; j < count; j++) *(T*)(out_%s + (i + j) * step_out_%s) = (T)scratch_%s[j];'%(arg.name, arg.name, arg.name)
+    src += 'i += count;'
+    src.unindent()
+    src += '}'
     src.unindent()
     src += '}'
     src += ''
-    #Module manifest
-    src += '//Module manifest'
-    src += 'static PyMethodDef module_methods[] = {'
+    #Ufunc registration
+    src += '//Ufunc definition'
+    src += 'static PyUFuncGenericFunction %s_loops[] = {%s};'%(k.name, ', '.join('%s_loop<%s>'%(k.name, ctype) for npy_type, ctype in loop_types))
+    src += 'static void* %s_data[] = {%s};'%(k.name, ', '.join('NULL' for loop_type in loop_types))
+    src += 'static char %s_types[] = {%s};'%(k.name, ', '.join(', '.join([npy_type] * len(operands)) for npy_type, ctype in loop_types))
+    src += ''
+    src += '//Adds the ufunc to the Python module'
+    src += 'static int add_ufuncs(PyObject* module) {'
     src.indent()
-    src += '{'
+    src += 'import_array1(-1);'
+    src += 'import_umath1(-1);'
+    src += 'PyObject* ufunc = PyUFunc_FromFuncAndData(%s_loops, %s_data, %s_types, %d, %d, %d, PyUFunc_None, "%s_ufunc", "%s\\n\\n%s", 0);'%(k.name, k.name, k.name, len(loop_types), len(inputs), len(outputs), k.name, '\n'.join(k.docstring.splitlines()), note)
+    src += 'if(ufunc == NULL) {'
     src.indent()
-    src += '//Export name, visible within Python'
-    src += '"%s",'%(k.name)
-    src += '//Pointer to local implementation'
-    src += '%s_run,'%(k.name)
-    src += '//Accept normal (not keyword) arguments'
-    src += 'METH_VARARGS,'
-    src += '//Function documentation'
-    src += '"%s"'%('\n'.join(k.docstring.splitlines()))
-    src.unindent()
-    src += '},{NULL, NULL, 0, NULL} //End of manifest entries'
+    src += 'return -1;'
     src.unindent()
-    src += '};'
-    src += ''
-    #Module definition
-    src += '//Module definition'
-    src += 'static struct PyModuleDef module = {'
+    src += '}'
+    src += 'if(PyModule_AddObject(module, "%s_ufunc", ufunc) != 0) {'%(k.name)
     src.indent()
-    src += 'PyModuleDef_HEAD_INIT,'
-    src += '//Module name'
-    src += '"%s",'%(module_name)
-    src += '//Module documentation'
-    src += '"VecPy module for %s.",'%(k.name)
-    src += '//Other module info'
-    src += '-1, module_methods, NULL, NULL, NULL, NULL'
+    src += 'Py_DECREF(ufunc);'
+    src += 'return -1;'
     src.unindent()
-    src += '};'
-    src += ''
-    #Module initializer
-    src += '//Module initializer'
-    src += 'PyMODINIT_FUNC PyInit_%s() { return PyModule_Create(&module); }'%(module_name)
+    src += '}'
+    src += 'return 0;'
+    src.unindent()
+    src += '}'
     src += ''
     #Save code to file
-    file_name = Compiler.get_python_file(k)
-    with open(file_name, 'w') as file:
+    file_name = Compiler.get_numpy_file(k)
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
       file.write(src.get_code())
-    #print('Saved to file: %s'%(file_name))
 
   #Generates the Java API
+  #Returns the (buffer, uniform) Java types of a data type
+  def get_java_types(type):
+    if DataType.is_floating(type):
+      return ('FloatBuffer', 'float')
+    elif DataType.is_integral(type):
+      return ('IntBuffer', 'int')
+    raise Exception('Unsupported data type (%s)'%(type))
+
   def compile_java(k, options):
     type = options.type
     args = k.get_arguments()
-    if DataType.is_floating(type):
-      buffer_type = 'FloatBuffer'
-      uniform_type = 'float'
-    elif DataType.is_integral(type):
-      buffer_type = 'IntBuffer'
-      uniform_type = 'int'
-    else:
-      raise Exception('Unsupported data type (%s)'%(type))
+    (buffer_type, uniform_type) = Compiler.get_java_types(type)
     #JNI header file
     src = Formatter()
     src.section('VecPy generated entry point: Java')
@@ -324,20 +2115,20 @@ class Compiler:
     src += '#include <stdlib.h>'
     src += '#include <jni.h>'
     src += ''
-    #Wrapper for the core function
-    name_str = 'VecPy_%s'%(k.name)
-    if options.java_package is not None:
-      name_str = '%s_%s'%(options.java_package, name_str)
-      name_str = '_'.join(name_str.split('.'))
+    #Shared by all kernels of a library (see compile_library_core)
+    if options.library is None:
+      Compiler.compile_java_common(src)
+    #Wrapper for the core function (the kernel is overloaded, so the long JNI names are used)
+    uniform_sig = 'F' if DataType.is_floating(type) else 'I'
+    buffer_sig = 'Ljava/nio/%s;'%(buffer_type)
+    signature = ''.join(uniform_sig if arg.is_uniform else buffer_sig for arg in args)
     arg_str = ', '.join('j%s vp_%s'%(uniform_type if arg.is_uniform else 'object', arg.name) for arg in args)
-    src += '//Wrapper for the core function'
-    src += 'extern "C" JNIEXPORT jboolean JNICALL Java_%s(JNIEnv* env, jclass cls, %s) {'%(name_str, arg_str)
+    src += '//Wrapper for the core function (direct buffers)'
+    src += 'extern "C" JNIEXPORT jboolean JNICALL %s(JNIEnv* env, jclass cls, %s) {'%(Compiler.get_jni_name(options, k.name, signature), arg_str)
     src.indent()
     src += '//Make sure the buffers are directly allocated'
-    src += 'jclass Buffer = env->FindClass("java/nio/Buffer");'
-    src += 'jmethodID isDirect = env->GetMethodID(Buffer, "isDirect", "()Z");'
     for arg in k.get_arguments(uniform=False):
-      src += 'if(!env->CallBooleanMethod(vp_%s, isDirect)) {'%(arg.name)
+      src += 'if(!env->CallBooleanMethod(vp_%s, isDirectMethod)) {'%(arg.name)
       src.indent()
       src += 'printf("Buffer not direct (%s)\\n");'%(arg.name)
       src += 'return false;'
@@ -372,6 +2163,8 @@ class Compiler:
         src += 'args.%s = vp_%s;'%(arg.name, arg.name)
       else:
         src += 'args.%s = (%s*)env->GetDirectBufferAddress(vp_%s);'%(arg.name, type, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'args.%s_stride = 1;'%(arg.name)
     src += 'args.N = N;'
     for arg in k.get_arguments(uniform=False):
       src += 'if(args.%s == NULL) {'%(arg.name)
@@ -385,13 +2178,171 @@ class Compiler:
     src.unindent()
     src += '}'
     src += ''
-    #Aligned buffer allocation
-    name_str = 'VecPy_allocate'
-    if options.java_package is not None:
-      name_str = '%s_%s'%(options.java_package, name_str)
-      name_str = '_'.join(name_str.split('.'))
+    #Wrapper for heap arrays
+    signature = ''.join(uniform_sig if arg.is_uniform else '[' + uniform_sig for arg in args)
+    arg_str = ', '.join('j%s%s vp_%s'%(uniform_type, '' if arg.is_uniform else 'Array', arg.name) for arg in args)
+    src += '//Wrapper for the core function (heap arrays, pinned for the duration of the call)'
+    src += 'extern "C" JNIEXPORT jboolean JNICALL %s(JNIEnv* env, jclass cls, %s) {'%(Compiler.get_jni_name(options, k.name, signature), arg_str)
+    src.indent()
+    #Get the number of elements from the length of the first array
+    src += '//Number of elements to process'
+    src += 'jlong N = env->GetArrayLength(vp_%s);'%(k.get_arguments(uniform=False, array=False)[0].name)
+    src += '//Check length for all arrays'
+    for arg in k.get_arguments(uniform=False):
+      num = 'N'
+      if arg.stride > 1:
+        num = '%s * %d'%(num, arg.stride)
+      elif arg.is_fuse:
+        num = '1'
+      src += 'if(env->GetArrayLength(vp_%s) != %s) {'%(arg.name, num)
+      src.indent()
+      src += 'printf("Java array sizes don\'t match (%s)\\n");'%(arg.name)
+      src += 'return false;'
+      src.unindent()
+      src += '}'
+    src += '//Pin the arrays (no other JNI calls are allowed until they are released)'
+    src += 'KernelArgs args;'
+    for arg in args:
+      if arg.is_uniform:
+        src += 'args.%s = vp_%s;'%(arg.name, arg.name)
+      else:
+        src += 'args.%s = (%s*)env->GetPrimitiveArrayCritical(vp_%s, NULL);'%(arg.name, type, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'args.%s_stride = 1;'%(arg.name)
+    src += 'args.N = N;'
+    src += 'bool ok = %s;'%(' && '.join('args.%s != NULL'%(arg.name) for arg in k.get_arguments(uniform=False)))
+    src += '//Run the kernel (heap arrays are usually unaligned, which run() handles)'
+    src += 'if(ok) {'
+    src.indent()
+    src += 'ok = run(&args);'
+    src.unindent()
+    src += '}'
+    src += '//Unpin the arrays, copying back only the outputs'
+    for arg in reversed(k.get_arguments(uniform=False)):
+      src += 'if(args.%s != NULL) {'%(arg.name)
+      src.indent()
+      src += 'env->ReleasePrimitiveArrayCritical(vp_%s, args.%s, %s);'%(arg.name, arg.name, '0' if arg.is_output else 'JNI_ABORT')
+      src.unindent()
+      src += '}'
+    src += 'if(!ok) {'
+    src.indent()
+    src += 'printf("Error retrieving Java array\\n");'
+    src.unindent()
+    src += '}'
+    src += 'return ok;'
+    src.unindent()
+    src += '}'
+    src += ''
+    #Batched wrapper
+    arg_str = ', '.join('j%sArray vp_%s'%(uniform_type, arg.name) if arg.is_uniform else 'jobjectArray vp_%s'%(arg.name) for arg in args)
+    src += '//Batched wrapper: element i of every array argument belongs to job i'
+    src += 'extern "C" JNIEXPORT jboolean JNICALL %s(JNIEnv* env, jclass cls, %s) {'%(Compiler.get_jni_name(options, '%s_batch'%(k.name)), arg_str)
+    src.indent()
+    src += '//Every argument must have one entry per job'
+    src += 'const jsize numJobs = env->GetArrayLength(vp_%s);'%(args[0].name)
+    for arg in args:
+      src += 'if(env->GetArrayLength(vp_%s) != numJobs) {'%(arg.name)
+      src.indent()
+      src += 'printf("Java batch sizes don\'t match (%s)\\n");'%(arg.name)
+      src += 'return false;'
+      src.unindent()
+      src += '}'
+    src += 'KernelArgs* jobs = new KernelArgs[numJobs > 0 ? numJobs : 1];'
+    for arg in k.get_arguments(uniform=True):
+      src += 'j%s* buf_%s = env->Get%sArrayElements(vp_%s, NULL);'%(uniform_type, arg.name, uniform_type.capitalize(), arg.name)
+    src += 'bool ok = true;'
+    src += 'for(jsize j = 0; ok && j < numJobs; j++) {'
+    src.indent()
+    src += '//Get the buffers of this job'
+    for arg in k.get_arguments(uniform=False):
+      src += 'jobject %s = env->GetObjectArrayElement(vp_%s, j);'%(arg.name, arg.name)
+    src += '//Number of elements to process'
+    src += 'jlong N = env->GetDirectBufferCapacity(%s);'%(k.get_arguments(uniform=False, array=False)[0].name)
+    for arg in k.get_arguments(uniform=False):
+      num = 'N'
+      if arg.stride > 1:
+        num = '%s * %d'%(num, arg.stride)
+      elif arg.is_fuse:
+        num = '1'
+      src += 'jobs[j].%s = (%s*)env->GetDirectBufferAddress(%s);'%(arg.name, type, arg.name)
+      src += 'if(jobs[j].%s == NULL || env->GetDirectBufferCapacity(%s) != %s) {'%(arg.name, arg.name, num)
+      src.indent()
+      src += 'printf("Java buffer not direct or sizes don\'t match (%s, job %%d)\\n", (int)j);'%(arg.name)
+      src += 'ok = false;'
+      src.unindent()
+      src += '}'
+      src += 'env->DeleteLocalRef(%s);'%(arg.name)
+    for arg in k.get_arguments(uniform=True):
+      src += 'jobs[j].%s = buf_%s[j];'%(arg.name, arg.name)
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'jobs[j].%s_stride = 1;'%(arg.name)
+    src += 'jobs[j].N = N;'
+    src.unindent()
+    src += '}'
+    for arg in k.get_arguments(uniform=True):
+      src += 'env->Release%sArrayElements(vp_%s, buf_%s, JNI_ABORT);'%(uniform_type.capitalize(), arg.name, arg.name)
+    src += '//Run all jobs'
+    src += 'if(ok) {'
+    src.indent()
+    src += 'ok = runBatch(jobs, numJobs);'
+    src.unindent()
+    src += '}'
+    src += 'delete [] jobs;'
+    src += 'return ok;'
+    src.unindent()
+    src += '}'
+    src += ''
+    if options.library is None:
+      Compiler.compile_java_memory(options, src)
+    #Save code to file
+    file_name = Compiler.get_java_file(k)
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
+      file.write(src.get_code())
+    if options.library is None:
+      Compiler.compile_java_api([(k, options.type)], options)
+
+  #Generates the JNI class and method IDs cached by the library (shared by all kernels)
+  def compile_java_common(src):
+    src += '//Class and method IDs, cached when the library is loaded'
+    src += 'static jclass BufferClass = NULL;'
+    src += 'static jmethodID isDirectMethod = NULL;'
+    src += 'extern "C" JNIEXPORT jint JNICALL JNI_OnLoad(JavaVM* vm, void* reserved) {'
+    src.indent()
+    src += 'JNIEnv* env;'
+    src += 'if(vm->GetEnv((void**)&env, JNI_VERSION_1_6) != JNI_OK) {'
+    src.indent()
+    src += 'return JNI_ERR;'
+    src.unindent()
+    src += '}'
+    src += 'jclass Buffer = env->FindClass("java/nio/Buffer");'
+    src += 'if(Buffer == NULL) {'
+    src.indent()
+    src += 'return JNI_ERR;'
+    src.unindent()
+    src += '}'
+    src += 'BufferClass = (jclass)env->NewGlobalRef(Buffer);'
+    src += 'isDirectMethod = env->GetMethodID(BufferClass, "isDirect", "()Z");'
+    src += 'env->DeleteLocalRef(Buffer);'
+    src += 'return isDirectMethod == NULL ? JNI_ERR : JNI_VERSION_1_6;'
+    src.unindent()
+    src += '}'
+    src += 'extern "C" JNIEXPORT void JNICALL JNI_OnUnload(JavaVM* vm, void* reserved) {'
+    src.indent()
+    src += 'JNIEnv* env;'
+    src += 'if(vm->GetEnv((void**)&env, JNI_VERSION_1_6) == JNI_OK && BufferClass != NULL) {'
+    src.indent()
+    src += 'env->DeleteGlobalRef(BufferClass);'
+    src.unindent()
+    src += '}'
+    src += 'BufferClass = NULL;'
+    src.unindent()
+    src += '}'
+    src += ''
+
+  #Generates the JNI aligned buffer allocation (shared by all kernels)
+  def compile_java_memory(options, src):
     src += '//Aligned allocation'
-    src += 'extern "C" JNIEXPORT jobject JNICALL Java_%s(JNIEnv* env, jclass cls, jlong N) {'%(name_str)
+    src += 'extern "C" JNIEXPORT jobject JNICALL %s(JNIEnv* env, jclass cls, jlong N) {'%(Compiler.get_jni_name(options, 'allocate'))
     src.indent()
     src += '//Allocate space'
     src += 'void* buffer;'
@@ -415,17 +2366,11 @@ class Compiler:
     src += '}'
     src += ''
     #Aligned buffer free
-    name_str = 'VecPy_free'
-    if options.java_package is not None:
-      name_str = '%s_%s'%(options.java_package, name_str)
-      name_str = '_'.join(name_str.split('.'))
     src += '//Free'
-    src += 'extern "C" JNIEXPORT jboolean JNICALL Java_%s(JNIEnv* env, jclass cls, jobject buffer) {'%(name_str)
+    src += 'extern "C" JNIEXPORT jboolean JNICALL %s(JNIEnv* env, jclass cls, jobject buffer) {'%(Compiler.get_jni_name(options, 'free'))
     src.indent()
     src += '//Make sure the buffer is directly allocated'
-    src += 'jclass Buffer = env->FindClass("java/nio/Buffer");'
-    src += 'jmethodID isDirect = env->GetMethodID(Buffer, "isDirect", "()Z");'
-    src += 'if(!env->CallBooleanMethod(buffer, isDirect)) {'
+    src += 'if(!env->CallBooleanMethod(buffer, isDirectMethod)) {'
     src.indent()
     src += 'printf("Buffer not direct\\n");'
     src += 'return false;'
@@ -437,11 +2382,9 @@ class Compiler:
     src.unindent()
     src += '}'
     src += ''
-    #Save code to file
-    file_name = Compiler.get_java_file(k)
-    with open(file_name, 'w') as file:
-      file.write(src.get_code())
-    #VecPy API for java
+
+  #Generates the VecPy class: the Java API of one or more (kernel, data type) pairs
+  def compile_java_api(kernels, options):
     src = Formatter()
     src.section('VecPy generated API')
     #Package
@@ -451,21 +2394,31 @@ class Compiler:
     src += 'import java.nio.*;'
     src += ''
     #VecPy class
-    arg_str = ', '.join('%s %s'%(uniform_type if arg.is_uniform else buffer_type, arg.name) for arg in args)
     src += 'public class VecPy {'
     src.indent()
-    #Helper functions to allocate and free aligned direct buffers
     #JNI wrapper
     src += '//JNI wrappers'
-    src += 'public static native boolean %s(%s);'%(k.name, arg_str)
+    for (k, type) in kernels:
+      (buffer_type, uniform_type) = Compiler.get_java_types(type)
+      args = k.get_arguments()
+      arg_str = ', '.join('%s %s'%(uniform_type if arg.is_uniform else buffer_type, arg.name) for arg in args)
+      src += 'public static native boolean %s(%s);'%(k.name, arg_str)
+      array_str = ', '.join('%s%s %s'%(uniform_type, '' if arg.is_uniform else '[]', arg.name) for arg in args)
+      src += 'public static native boolean %s(%s);'%(k.name, array_str)
+      batch_str = ', '.join('%s[] %s'%(uniform_type if arg.is_uniform else buffer_type, arg.name) for arg in args)
+      src += 'public static native boolean %s_batch(%s);'%(k.name, batch_str)
     src += 'private static native ByteBuffer allocate(long N);'
     src += 'private static native boolean free(Buffer buffer);'
+    #Helper functions to allocate and free aligned direct buffers
     src += '//Helper functions to allocate and free aligned direct buffers'
-    src += 'public static %s newBuffer(long N) {'%(buffer_type)
-    src.indent()
-    src += 'return allocate(N * %d).order(ByteOrder.nativeOrder()).as%s();'%(4, buffer_type)
-    src.unindent()
-    src += '}'
+    buffer_types = sorted(set(Compiler.get_java_types(type)[0] for (k, type) in kernels))
+    for buffer_type in buffer_types:
+      #Kernels of different data types need a helper per buffer type (e.g. newFloatBuffer)
+      src += 'public static %s %s(long N) {'%(buffer_type, 'newBuffer' if len(buffer_types) == 1 else 'new' + buffer_type)
+      src.indent()
+      src += 'return allocate(N * %d).order(ByteOrder.nativeOrder()).as%s();'%(4, buffer_type)
+      src.unindent()
+      src += '}'
     src += 'public static boolean deleteBuffer(Buffer buffer) {'
     src.indent()
     src += 'return free(buffer);'
@@ -476,7 +2429,7 @@ class Compiler:
     src += ''
     #Save code to file
     file_name = 'VecPy.java'
-    with open(file_name, 'w') as file:
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
       file.write(src.get_code())
 
   #Generates the kernel
@@ -492,41 +2445,137 @@ class Compiler:
     src.indent()
     for arg in k.get_arguments():
       src += '%s%s %s;'%(options.type, '*' if not arg.is_uniform else '', arg.name)
+    src += '//Element strides of the elementwise arrays'
+    for arg in k.get_arguments(uniform=False, fuse=False, array=False):
+      src += 'int64_t %s_stride;'%(arg.name)
     src += 'uint64_t N;'
     src.unindent()
     src += '};'
     src += ''
-    #Generate an architecture-specific kernel
+    #Generate an architecture-specific kernel (unit stride and strided variants)
     src += Compiler_Generic.compile_kernel(k, options)
+    src += Compiler_Generic.compile_kernel(k, options, strided=True)
     if Architecture.is_intel(options.arch):
       src += Compiler_Intel.compile_kernel(k, options)
+      src += Compiler_Intel.compile_kernel(k, options, strided=True)
     elif not Architecture.is_generic(options.arch):
       raise Exception('Target architecture not implemented (%s)'%(options.arch['name']))
     #Save code to file
     file_name = Compiler.get_kernel_file(k)
-    with open(file_name, 'w') as file:
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
       file.write(src.get_code())
     #print('Saved to file: %s'%(file_name))
 
-  #Compiles the module
-  def build(k, build_flags):
+  #Returns (include flags, link flags) for Python, computed once per process
+  def get_python_flags():
+    with Compiler.cache_lock:
+      if 'python' not in Compiler.flag_cache:
+        #Same flags as python3-config, but for the running interpreter and without a subprocess
+        paths = sysconfig.get_paths()
+        includes = ['-I%s'%(path) for path in sorted(set([paths['include'], paths['platinclude']]))]
+        libs = []
+        for var in ('LIBS', 'SYSLIBS'):
+          libs += (sysconfig.get_config_var(var) or '').split()
+        Compiler.flag_cache['python'] = (includes, libs)
+      return Compiler.flag_cache['python']
+
+  #Returns the JNI include flags (per JAVA_HOME)
+  def get_java_flags():
+    java_home = os.environ.get('JAVA_HOME', '')
+    with Compiler.cache_lock:
+      key = 'java:' + java_home
+      if key not in Compiler.flag_cache:
+        Compiler.flag_cache[key] = ['-I%s/include/'%(java_home), '-I%s/include/linux/'%(java_home)]
+      return Compiler.flag_cache[key]
+
+  #Returns the compiler version, which is part of the precompiled header's key
+  def get_compiler_version():
+    with Compiler.cache_lock:
+      if 'version' not in Compiler.flag_cache:
+        Compiler.flag_cache['version'] = subprocess.check_output([Compiler.cxx, '-dumpfullversion']).decode('utf-8').strip()
+      return Compiler.flag_cache['version']
+
+  #Returns the directory where precompiled headers are kept between builds
+  def get_cache_dir():
+    if 'VECPY_CACHE_DIR' in os.environ:
+      return os.environ['VECPY_CACHE_DIR']
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'vecpy')
+
+  #Generates the includes of system and binding headers
+  def compile_system_includes(options, src):
+    if Binding.all in options.bindings or Binding.python in options.bindings or Binding.numpy in options.bindings:
+      #Python.h must come before any standard header
+      src += '#include <Python.h>'
+    if Binding.numpy in options.bindings:
+      src += '#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION'
+      src += '#include <numpy/arrayobject.h>'
+      src += '#include <numpy/ufuncobject.h>'
+    if Binding.all in options.bindings or Binding.java in options.bindings:
+      src += '#include <jni.h>'
+    for header in ('pthread.h', 'stdint.h', 'stdio.h', 'stdlib.h', 'string.h', 'math.h'):
+      src += '#include <%s>'%(header)
+    for header in ('algorithm', 'atomic', 'future', 'new', 'stdexcept', 'type_traits', 'utility', 'vector'):
+      src += '#include <%s>'%(header)
+    if Architecture.is_intel(options.arch):
+      src += '#include <x86intrin.h>'
+
+  #Generates the precompiled header of the system and binding includes
+  def get_pch_header(options):
     src = Formatter()
-    #Generate the build script
-    src += 'NAME=vecpy_%s.so'%(k.name)
-    src += 'rm -f $NAME'
-    src += 'g++ -Wall -Wno-unused-variable -Wno-unused-but-set-variable -O3 -fPIC -shared %s -o $NAME %s'%(' '.join(build_flags), Compiler.get_core_file(k))
-    #src += 'nm $NAME | grep " T "'
-    #Save code to file
-    file_name = 'build.sh'
-    with open(file_name, 'w') as file:
-      file.write(src.get_code())
-    #print('Saved to file: %s'%(file_name))
-    #Run the build script
-    subprocess.call(['chmod', '+x', file_name])
-    subprocess.check_call(['./' + file_name], shell=True)
+    src.section('VecPy precompiled header')
+    Compiler.compile_system_includes(options, src)
+    return src.get_code()
 
-  #Generates all files and compiles the module
-  def compile(kernel, options):
+  #Returns the flags that include the precompiled header, building it if needed
+  #  Headers are cached by their text, flags and compiler version, so they're built once.
+  def get_pch_flags(options, compile_flags):
+    header = Compiler.get_pch_header(options)
+    #Headers aren't checked for changes, so the key includes the versions of their packages
+    versions = [Compiler.get_compiler_version(), sys.version]
+    if Binding.numpy in options.bindings:
+      import numpy
+      versions.append(numpy.__version__)
+    key = '\n'.join(versions + [header] + compile_flags)
+    pch_dir = os.path.join(Compiler.get_cache_dir(), hashlib.sha1(key.encode('utf-8')).hexdigest())
+    header_file = os.path.join(pch_dir, 'vecpy_pch.h')
+    with Compiler.cache_lock:
+      if not os.path.exists(header_file + '.gch'):
+        os.makedirs(pch_dir, exist_ok=True)
+        #Written under a temporary name, so that concurrent builds never see a partial file
+        temp = '%s.%d'%(header_file, os.getpid())
+        with open(temp, 'w') as file:
+          file.write(header)
+        os.replace(temp, header_file)
+        try:
+          subprocess.check_call([Compiler.cxx, '-x', 'c++-header'] + compile_flags + [header_file, '-o', temp + '.gch'])
+          os.replace(temp + '.gch', header_file + '.gch')
+        except (OSError, subprocess.CalledProcessError):
+          #Not fatal, the includes are just compiled as usual
+          return []
+    return ['-include', header_file]
+
+  #Compiles the module vecpy_<name> from its core file, returns the time (in seconds) of each stage
+  def build(name, core_file, options, compile_flags, link_flags):
+    timing = {}
+    module_file = os.path.abspath(os.path.join(options.module_dir, 'vecpy_%s.so'%(name)))
+    object_file = 'vecpy_%s.o'%(name)
+    compile_flags = Compiler.warning_flags + ['-O3', '-fPIC'] + compile_flags
+    start = time.perf_counter()
+    pch_flags = Compiler.get_pch_flags(options, compile_flags)
+    timing['pch'] = time.perf_counter() - start
+    start = time.perf_counter()
+    subprocess.check_call([Compiler.cxx] + compile_flags + pch_flags + ['-c', core_file, '-o', object_file], cwd=options.build_dir)
+    timing['compile'] = time.perf_counter() - start
+    start = time.perf_counter()
+    if os.path.exists(module_file):
+      os.remove(module_file)
+    subprocess.check_call([Compiler.cxx, '-shared', '-o', module_file, object_file] + link_flags, cwd=options.build_dir)
+    timing['link'] = time.perf_counter() - start
+    return timing
+
+  #Checks the options and fills in defaults
+  def prepare(options):
     #Sanity checks
     if options.arch is None:
       raise Exception('No architecture specified')
@@ -541,25 +2590,173 @@ class Compiler:
         options.threads = 1
     #Show options
     options.show()
+    os.makedirs(options.build_dir, exist_ok=True)
+    os.makedirs(options.module_dir, exist_ok=True)
+
+  #Generates the kernel, its bindings and its core, returns the (compile, link) flags
+  def generate(kernel, options):
     #Generate the kernel
     Compiler.compile_kernel(kernel, options)
     #Generate API for each language
     include_files = []
-    build_flags = [options.arch['flag']]
+    #Generic builds have no architecture flag
+    compile_flags = [options.arch['flag']] if options.arch['flag'] else []
+    link_flags = []
     if Binding.all in options.bindings or Binding.cpp in options.bindings:
       Compiler.compile_cpp(kernel, options)
+      Compiler.compile_cpp_header(kernel, options)
       include_files.append(Compiler.get_cpp_file(kernel))
-    if Binding.all in options.bindings or Binding.python in options.bindings:
+    if Binding.numpy in options.bindings:
+      #The ufunc is registered by the Python module's initializer
+      try:
+        import numpy
+      except ImportError:
+        raise Exception('NumPy is required for the NumPy binding')
+      Compiler.compile_numpy(kernel, options)
+      include_files.append(Compiler.get_numpy_file(kernel))
+      compile_flags.append('-I%s'%(numpy.get_include()))
+    if Binding.all in options.bindings or Binding.python in options.bindings or Binding.numpy in options.bindings:
       Compiler.compile_python(kernel, options)
       include_files.append(Compiler.get_python_file(kernel))
-      build_flags.append('$(python3-config --libs)')
-      build_flags.append('$(python3-config --includes)')
+      (includes, libs) = Compiler.get_python_flags()
+      compile_flags += includes
+      link_flags += libs
     if Binding.all in options.bindings or Binding.java in options.bindings:
       Compiler.compile_java(kernel, options)
       include_files.append(Compiler.get_java_file(kernel))
-      build_flags.append('-I$JAVA_HOME/include/')
-      build_flags.append('-I$JAVA_HOME/include/linux/')
-    #Generate the core
-    Compiler.compile_core(kernel, options, include_files)
+      compile_flags += Compiler.get_java_flags()
+    #Generate the core (returned instead of saved for a library)
+    core = Compiler.compile_core(kernel, options, include_files)
+    return (compile_flags, link_flags, core)
+
+  #Generates all files and compiles the module
+  def compile(kernel, options):
+    Compiler.prepare(options)
+    start = time.perf_counter()
+    (compile_flags, link_flags, core) = Compiler.generate(kernel, options)
+    timing = {'codegen': time.perf_counter() - start}
+    #Compile the module
+    timing.update(Compiler.build(kernel.name, Compiler.get_core_file(kernel), options, compile_flags, link_flags))
+    return timing
+
+  #Generates the core of a module that exports several kernels
+  #  kernels is a list of (kernel, options, core) triples, each kernel's options naming the
+  #  library and core being the kernel's generated core.
+  def compile_library_core(name, kernels, options):
+    python = Binding.all in options.bindings or Binding.python in options.bindings or Binding.numpy in options.bindings
+    java = Binding.all in options.bindings or Binding.java in options.bindings
+    src = Formatter()
+    src.section('VecPy generated library: vecpy_%s'%(name))
+    #Includes
+    src += '//System and binding headers (included once, outside of the kernels\' namespaces)'
+    Compiler.compile_system_includes(options, src)
+    src += '#include <stddef.h>'
+    src += ''
+    #Utilities that don't depend on the kernel
+    Compiler.compile_core_common(src)
+    if python:
+      src += '//Shared by the Python bindings of all kernels'
+      Compiler.compile_python_dlpack(src)
+      Compiler.compile_python_attachment(src)
+      src += ''
+    if java:
+      src += '//Shared by the Java bindings of all kernels'
+      Compiler.compile_java_common(src)
+      Compiler.compile_java_memory(options, src)
+    #Kernels
+    src += '//Each kernel, with its core and bindings, in a namespace of its own'
+    for (k, kernel_options, core) in kernels:
+      src += 'namespace vecpy_%s {'%(k.name)
+      src.append(core, end='')
+      src += '}'
+    src += ''
+    if python:
+      #Module state
+      src += '//Per-module state: the state of each kernel'
+      src += 'typedef struct {'
+      src.indent()
+      for (k, kernel_options, core) in kernels:
+        src += 'vecpy_%s::ModuleState %s;'%(k.name, k.name)
+      src.unindent()
+      src += '} LibraryState;'
+      for (k, kernel_options, core) in kernels:
+        src += 'const Py_ssize_t vecpy_%s::stateOffset = offsetof(LibraryState, %s);'%(k.name, k.name)
+      #Module lifecycle
+      src += '//Creates the state and adds the functions of each kernel (multi-phase initialization)'
+      src += 'static int module_exec(PyObject* m) {'
+      src.indent()
+      for (k, kernel_options, core) in kernels:
+        src += 'if(vecpy_%s::module_exec(m) != 0 || PyModule_AddFunctions(m, vecpy_%s::module_methods) != 0) {'%(k.name, k.name)
+        src.indent()
+        src += 'return -1;'
+        src.unindent()
+        src += '}'
+      src += 'return 0;'
+      src.unindent()
+      src += '}'
+      src += 'static int module_traverse(PyObject* m, visitproc visit, void* arg) {'
+      src.indent()
+      src += 'int result;'
+      for (k, kernel_options, core) in kernels:
+        src += 'if((result = vecpy_%s::module_traverse(m, visit, arg)) != 0) {'%(k.name)
+        src.indent()
+        src += 'return result;'
+        src.unindent()
+        src += '}'
+      src += 'return 0;'
+      src.unindent()
+      src += '}'
+      src += 'static int module_clear(PyObject* m) {'
+      src.indent()
+      for (k, kernel_options, core) in kernels:
+        src += 'vecpy_%s::module_clear(m);'%(k.name)
+      src += 'return 0;'
+      src.unindent()
+      src += '}'
+      src += 'static void module_free(void* m) {'
+      src.indent()
+      for (k, kernel_options, core) in kernels:
+        src += 'vecpy_%s::module_free(m);'%(k.name)
+      src.unindent()
+      src += '}'
+      #The functions are added by module_exec
+      Compiler.compile_python_module(name, 'VecPy module for %s.'%(', '.join(k.name for (k, kernel_options, core) in kernels)), Binding.numpy in options.bindings, 'sizeof(LibraryState)', 'NULL', src)
+    #Save code to file
+    file_name = Compiler.get_library_file(name)
+    with open(os.path.join(options.build_dir, file_name), 'w') as file:
+      file.write(src.get_code())
+    #The other APIs
+    if java:
+      Compiler.compile_java_api([(k, kernel_options.type) for (k, kernel_options, core) in kernels], options)
+    if Binding.all in options.bindings or Binding.cpp in options.bindings:
+      src = Formatter()
+      src.section('VecPy generated header: C++17 wrappers for vecpy_%s'%(name))
+      src += '#pragma once'
+      for (k, kernel_options, core) in kernels:
+        src += '#include "%s"'%(Compiler.get_cpp_header_file(k))
+      src += ''
+      with open(os.path.join(options.build_dir, 'vecpy_%s.hpp'%(name)), 'w') as file:
+        file.write(src.get_code())
+
+  #Generates and compiles a single module (vecpy_<name>) that exports several kernels
+  #  kernels is a list of (kernel, data type) pairs; all kernels share the other options.
+  def compile_library(name, kernels, options):
+    names = [k.name for (k, type) in kernels]
+    if len(set(names)) != len(names):
+      raise Exception('Kernel names must be unique')
+    if name in names:
+      raise Exception('The module name must differ from the kernel names (%s)'%(name))
+    options.library = name
+    Compiler.prepare(options)
+    start = time.perf_counter()
+    library = []
+    for (k, type) in kernels:
+      kernel_options = copy.copy(options)
+      kernel_options.type = type
+      (compile_flags, link_flags, core) = Compiler.generate(k, kernel_options)
+      library.append((k, kernel_options, core))
+    Compiler.compile_library_core(name, library, options)
+    timing = {'codegen': time.perf_counter() - start}
     #Compile the module
-    Compiler.build(kernel, build_flags)
+    timing.update(Compiler.build(name, Compiler.get_library_file(name), options, compile_flags, link_flags))
+    return timing
@@ -40,10 +40,12 @@ class Binding:
   cpp    = 'cpp'
   python = 'python'
   java   = 'java'
+  #Not included in 'all' since it requires NumPy at build time
+  numpy  = 'numpy'
 
 #Compile time options
 class Options:
-  def __init__(self, arch, type, bindings=(Binding.all,), threads=None, java_package='vecpy'):
+  def __init__(self, arch, type, bindings=(Binding.all,), threads=None, java_package='vecpy', tiling=False, cache_size=262144, prefetch_distance=256, output_pool=4, parallel_threshold=16384, build_dir='.', module_dir='.'):
     if arch is None or type is None or bindings is None or len(bindings) == 0:
       raise Exception('Invalid options')
     #Target architecture
@@ -56,16 +58,42 @@ class Options:
     self.threads = threads
     #Java package name
     self.java_package = java_package
+    #Whether to process each thread's slice in cache-sized tiles
+    self.tiling = tiling
+    #Size (in bytes) of the cache that tiles should fit into (typically L2)
+    self.cache_size = cache_size
+    #Number of elements ahead of the current index to prefetch (0 to disable)
+    self.prefetch_distance = prefetch_distance
+    #Number of freed output buffers the Python binding keeps for reuse
+    self.output_pool = output_pool
+    #Inputs with fewer elements than this are processed on the calling thread
+    self.parallel_threshold = parallel_threshold
+    #Directory for the generated sources and object files
+    self.build_dir = build_dir
+    #Directory the compiled module is written to
+    self.module_dir = module_dir
+    #Name of the module when several kernels share one (set by Compiler.compile_library)
+    self.library = None
   def show(self):
     print('=' * 40)
     print('VecPy options')
     print('-' * 40)
     print('Data Type:         ' + self.type)
     print('Threads:           ' + str(self.threads))
+    print('Thread Threshold:  ' + str(self.parallel_threshold))
     print('Architecture:      ' + self.arch['name'])
     print('Language Bindings: ' + ','.join(self.bindings))
     if Binding.all in self.bindings or Binding.java in self.bindings:
       print('Java Package:      ' + str(self.java_package))
+    if self.build_dir != '.':
+      print('Build Directory:   ' + str(self.build_dir))
+    if self.library is not None:
+      print('Module:            vecpy_' + self.library)
+    if self.module_dir != '.':
+      print('Module Directory:  ' + str(self.module_dir))
+    if self.tiling:
+      print('Cache Size:        ' + str(self.cache_size))
+      print('Prefetch Distance: ' + str(self.prefetch_distance))
     print('=' * 40)
 
 #Indent amount
@@ -76,7 +104,8 @@ def get_indent(level):
 class Formatter:
   def __init__(self):
     self.level = 0
-    self.code = ''
+    #Lines are joined once at the end (repeated string concatenation is quadratic)
+    self.lines = []
   def section(self, title):
     width = 78
     left = (width - len(title)) // 2
@@ -88,7 +117,7 @@ class Formatter:
     self.append(other)
     return self
   def append(self, code, end='\n'):
-    self.code += get_indent(self.level) + code + end
+    self.lines.append(get_indent(self.level) + code + end)
   def indent(self):
     self.level += 1
   def unindent(self):
@@ -98,4 +127,4 @@ class Formatter:
   def get_code(self):
     if self.level != 0:
       raise Exception('Still indented')
-    return self.code
+    return ''.join(self.lines)
@@ -3,9 +3,10 @@ from vecpy.compiler_constants import *
 
 class Compiler_Generic:
 
-  def compile_kernel(k, options):
+  def compile_kernel(k, options, strided=False):
+    suffix = '_strided' if strided else ''
     src = Formatter()
-    src.section('Target Architecture: %s (%s)'%(options.arch['name'], options.type))
+    src.section('Target Architecture: %s (%s%s)'%(options.arch['name'], options.type, ', strided' if strided else ''))
     #Includes
     src += '//Includes'
     src += '#include <math.h>'
@@ -13,7 +14,7 @@ class Compiler_Generic:
     src += ''
     #Function header
     src += '//Kernel function: %s'%(k.name)
-    src += 'static void %s_scalar(KernelArgs* args) {'%(k.name)
+    src += 'static void %s_scalar%s(KernelArgs* args) {'%(k.name, suffix)
     src += ''
     src.indent()
     #Uniforms
@@ -60,6 +61,8 @@ class Compiler_Generic:
       if arg.stride > 1:
         addr = '&'
         index = '%s * %d'%(index, arg.stride)
+      elif strided and not arg.is_fuse:
+        index = '%s * args->%s_stride'%(index, arg.name)
       src += '%s = %sargs->%s[%s];'%(arg.name, addr, arg.name, index)
     src += ''
     #Core kernel logic
@@ -74,7 +77,10 @@ class Compiler_Generic:
     #Outputs
     src += '//Outputs'
     for arg in k.get_arguments(output=True, fuse=False):
-      src += 'args->%s[index] = %s;'%(arg.name, arg.name)
+      index = 'index'
+      if strided:
+        index = '%s * args->%s_stride'%(index, arg.name)
+      src += 'args->%s[%s] = %s;'%(arg.name, index, arg.name)
     for arg in k.get_arguments(output=True, fuse=True):
       src += 'if(%s_written) args->%s[0] = %s;'%(arg.name, arg.name, arg.name)
     src += ''
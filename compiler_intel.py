@@ -3,9 +3,10 @@ from vecpy.compiler_constants import *
 
 class Compiler_Intel:
 
-  def compile_kernel(k, options):
+  def compile_kernel(k, options, strided=False):
+    suffix = '_strided' if strided else ''
     src = Formatter()
-    src.section('Target Architecture: %s (%s)'%(options.arch['name'], options.type))
+    src.section('Target Architecture: %s (%s%s)'%(options.arch['name'], options.type, ', strided' if strided else ''))
     #Set some basic parameters
     size = options.arch['size']
     #Select an appropriate translator for the target architecture and data type
@@ -28,7 +29,7 @@ class Compiler_Intel:
     src += ''
     #Function header
     src += '//Kernel function: %s'%(k.name)
-    src += 'static void %s_vector(KernelArgs* args) {'%(k.name)
+    src += 'static void %s_vector%s(KernelArgs* args) {'%(k.name, suffix)
     src += ''
     src.indent()
     #Target-dependent setup
@@ -67,12 +68,32 @@ class Compiler_Intel:
     src += ''
     #Function body
     src.indent()
+    #Prefetch (reaches into the next tile near the end of the current one)
+    if options.tiling and options.prefetch_distance > 0 and not strided:
+      src += '//Prefetch'
+      for arg in k.get_arguments(input=True, uniform=False):
+        index = 'index + %d'%(options.prefetch_distance)
+        if arg.stride > 1:
+          index = '(%s) * %d'%(index, arg.stride)
+        src += '_mm_prefetch((const char*)&args->%s[%s], _MM_HINT_T0);'%(arg.name, index)
+      src += ''
     #Inputs
     src += '//Inputs'
     for arg in k.get_arguments(input=True, uniform=False):
       if arg.stride > 1:
         index = 'index * %d'%(arg.stride)
         src += '%s = &args->%s[%s];'%(arg.name, arg.name, index)
+      elif strided:
+        #Unit stride (but unaligned) arrays, e.g. JVM heap arrays, avoid the gather
+        src += 'if(args->%s_stride == 1) {'%(arg.name)
+        src.indent()
+        trans.load_unaligned(arg.name, '&args->%s[index]'%(arg.name))
+        src.unindent()
+        src += '} else {'
+        src.indent()
+        trans.load_strided(arg.name, '&args->%s[index * args->%s_stride]'%(arg.name, arg.name), 'args->%s_stride'%(arg.name))
+        src.unindent()
+        src += '}'
       else:
         trans.load(arg.name, '&args->%s[index]'%(arg.name))
     src += ''
@@ -88,7 +109,18 @@ class Compiler_Intel:
     #Outputs
     src += '//Outputs'
     for arg in k.get_arguments(output=True, fuse=False):
-      trans.store('&args->%s[index]'%(arg.name), arg.name)
+      if strided:
+        src += 'if(args->%s_stride == 1) {'%(arg.name)
+        src.indent()
+        trans.store_unaligned('&args->%s[index]'%(arg.name), arg.name)
+        src.unindent()
+        src += '} else {'
+        src.indent()
+        trans.store_strided('&args->%s[index * args->%s_stride]'%(arg.name, arg.name), arg.name, 'args->%s_stride'%(arg.name))
+        src.unindent()
+        src += '}'
+      else:
+        trans.store('&args->%s[index]'%(arg.name), arg.name)
     for arg in k.get_arguments(output=True, fuse=True):
       for lane in range(size):
         src += 'if(%s(%s_written, %d)) args->%s[0] = %s(%s, %d);'%(trans.extract, arg.name, lane, arg.name, trans.extract, arg.name, lane)
@@ -294,6 +326,24 @@ class Compiler_Intel:
         self.src += '%s = %s;'%(output, input)
       else:
         self.src += '%s = %s(%s(%s, %s), %s(%s, %s));'%(output, or_, and_, mask, input, andnot_, mask, output)
+    def load_strided(self, *args):
+      #Gather lanes through an aligned scratch array
+      (output, addr, step) = args
+      self.src += '{'
+      self.src += 'alignas(32) %s lanes[%d];'%(self.scalar_type, self.size)
+      for i in range(self.size):
+        self.src += 'lanes[%d] = (%s)[%d * %s];'%(i, addr, i, step)
+      self.load(output, 'lanes')
+      self.src += '}'
+    def store_strided(self, *args):
+      #Scatter lanes through an aligned scratch array
+      (addr, input, step) = args
+      self.src += '{'
+      self.src += 'alignas(32) %s lanes[%d];'%(self.scalar_type, self.size)
+      self.store('lanes', input)
+      for i in range(self.size):
+        self.src += '(%s)[%d * %s] = lanes[%d];'%(addr, i, step, i)
+      self.src += '}'
     def error(self):
       raise Exception('Not implemented')
     #Abstract stubs
@@ -306,6 +356,10 @@ class Compiler_Intel:
       self.error()
     def store(self, *args):
       self.error()
+    def load_unaligned(self, *args):
+      self.error()
+    def store_unaligned(self, *args):
+      self.error()
     def mask(self, *args):
       self.error()
     #Python arithmetic operators
@@ -453,6 +507,7 @@ class Compiler_Intel:
     def __init__(self, src, size):
       Compiler_Intel.Translator.__init__(self, src, size)
       self.type = '__m128'
+      self.scalar_type = 'float'
       self.test = '_mm_movemask_ps'
     #Misc
     def setup(self):
@@ -471,6 +526,10 @@ class Compiler_Intel:
       self.vector_1_1('_mm_load_ps', args)
     def store(self, *args):
       self.vector_0_2('_mm_store_ps', args)
+    def load_unaligned(self, *args):
+      self.vector_1_1('_mm_loadu_ps', args)
+    def store_unaligned(self, *args):
+      self.vector_0_2('_mm_storeu_ps', args)
     def mask(self, *args):
       (input, output, mask) = args
       self.mask_1_2(input, output, mask, '_mm_or_ps', '_mm_and_ps', '_mm_andnot_ps')
@@ -607,6 +666,7 @@ class Compiler_Intel:
     def __init__(self, src, size):
       Compiler_Intel.Translator.__init__(self, src, size)
       self.type = '__m128i'
+      self.scalar_type = 'unsigned int'
       self.test = '_mm_movemask_epi8'
       self.insert = '_mm_insert_epi32'
       self.extract = '_mm_extract_epi32'
@@ -631,6 +691,12 @@ class Compiler_Intel:
     def store(self, *args):
       args = ('(%s*)(%s)'%(self.type, args[0]), args[1])
       self.vector_0_2('_mm_store_si128', args)
+    def load_unaligned(self, *args):
+      args = (args[0], '(const %s*)(%s)'%(self.type, args[1]))
+      self.vector_1_1('_mm_loadu_si128', args)
+    def store_unaligned(self, *args):
+      args = ('(%s*)(%s)'%(self.type, args[0]), args[1])
+      self.vector_0_2('_mm_storeu_si128', args)
     def mask(self, *args):
       (input, output, mask) = args
       self.mask_1_2(input, output, mask, '_mm_or_si128', '_mm_and_si128', '_mm_andnot_si128')
@@ -734,6 +800,7 @@ class Compiler_Intel:
     def __init__(self, src, size):
       Compiler_Intel.Translator.__init__(self, src, size)
       self.type = '__m256'
+      self.scalar_type = 'float'
       self.test = '_mm256_movemask_ps'
     #Misc
     def setup(self):
@@ -745,6 +812,14 @@ class Compiler_Intel:
       self.vector_1_1('_mm256_load_ps', args)
     def store(self, *args):
       self.vector_0_2('_mm256_store_ps', args)
+    def load_unaligned(self, *args):
+      self.vector_1_1('_mm256_loadu_ps', args)
+    def store_unaligned(self, *args):
+      self.vector_0_2('_mm256_storeu_ps', args)
+    def load_strided(self, *args):
+      (output, addr, step) = args
+      index = '_mm256_mullo_epi32(_mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7), _mm256_set1_epi32((int)%s))'%(step)
+      self.src += '%s = _mm256_i32gather_ps(%s, %s, 4);'%(output, addr, index)
     def mask(self, *args):
       (input, output, mask) = args
       self.mask_1_2(input, output, mask, '_mm256_or_ps', '_mm256_and_ps', '_mm256_andnot_ps')
@@ -887,6 +962,7 @@ class Compiler_Intel:
     def __init__(self, src, size):
       Compiler_Intel.Translator.__init__(self, src, size)
       self.type = '__m256i'
+      self.scalar_type = 'unsigned int'
       self.test = '_mm256_movemask_epi8'
       self.insert = '_mm256_insert_epi32'
       self.extract = '_mm256_extract_epi32'
@@ -911,6 +987,16 @@ class Compiler_Intel:
     def store(self, *args):
       args = ('(%s*)(%s)'%(self.type, args[0]), args[1])
       self.vector_0_2('_mm256_store_si256', args)
+    def load_unaligned(self, *args):
+      args = (args[0], '(const %s*)(%s)'%(self.type, args[1]))
+      self.vector_1_1('_mm256_loadu_si256', args)
+    def store_unaligned(self, *args):
+      args = ('(%s*)(%s)'%(self.type, args[0]), args[1])
+      self.vector_0_2('_mm256_storeu_si256', args)
+    def load_strided(self, *args):
+      (output, addr, step) = args
+      index = '_mm256_mullo_epi32(_mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7), _mm256_set1_epi32((int)%s))'%(step)
+      self.src += '%s = _mm256_i32gather_epi32((const int*)(%s), %s, 4);'%(output, addr, index)
     def mask(self, *args):
       (input, output, mask) = args
       self.mask_1_2(input, output, mask, '_mm256_or_si256', '_mm256_and_si256', '_mm256_andnot_si256')
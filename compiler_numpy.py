@@ -0,0 +1,306 @@
+import math
+import operator
+from vecpy.kernel import *
+from vecpy.compiler_constants import *
+
+#Generates a pure-NumPy version of a kernel (no C++ compiler needed)
+#  Every variable becomes an array holding one chunk of elements, masked assignments
+#  become np.where, and while loops run until no element's mask is set.
+class Compiler_NumPy:
+  #Elements per chunk (bounds the size of temporaries)
+  chunk_size = 65536
+
+  #NumPy equivalents of the C functions
+  functions = {
+    'abs': 'np.abs',
+    'max': 'np.maximum',
+    'min': 'np.minimum',
+    'acos': 'np.arccos',
+    'acosh': 'np.arccosh',
+    'asin': 'np.arcsin',
+    'asinh': 'np.arcsinh',
+    'atan': 'np.arctan',
+    'atanh': 'np.arctanh',
+    'atan2': 'np.arctan2',
+    'ceil': 'np.ceil',
+    'copysign': 'np.copysign',
+    'cos': 'np.cos',
+    'cosh': 'np.cosh',
+    'exp': 'np.exp',
+    'expm1': 'np.expm1',
+    'fabs': 'np.fabs',
+    'floor': 'np.floor',
+    'fmod': 'np.fmod',
+    'hypot': 'np.hypot',
+    'log': 'np.log',
+    'log10': 'np.log10',
+    'log1p': 'np.log1p',
+    'log2': 'np.log2',
+    'sin': 'np.sin',
+    'sinh': 'np.sinh',
+    'sqrt': 'np.sqrt',
+    'tan': 'np.tan',
+    'tanh': 'np.tanh',
+    'trunc': 'np.trunc',
+  }
+  #Functions without a NumPy ufunc, applied element by element
+  python_functions = ('erf', 'erfc', 'gamma', 'lgamma')
+
+  #Utility functions (called by the generated code)
+  def get_dtype(type):
+    return 'np.float32' if DataType.is_floating(type) else 'np.uint32'
+
+  #Matches positional and keyword arguments to names, like the Python binding
+  def get_objects(kernel, names, args, kwargs):
+    if len(args) > len(names):
+      raise TypeError('%s() takes at most %d arguments'%(kernel, len(names)))
+    objs = list(args) + [None] * (len(names) - len(args))
+    for (key, value) in kwargs.items():
+      if key not in names or names.index(key) < len(args):
+        raise TypeError('Unexpected or repeated argument (%s)'%(key))
+      objs[names.index(key)] = value
+    return objs
+
+  #Returns a uniform argument as a scalar of the kernel's type
+  def get_uniform(np, obj, dtype):
+    if dtype == np.float32:
+      return dtype(float(obj))
+    return dtype(operator.index(obj))
+
+  #Returns an argument as a 1-D array of the kernel's type
+  def get_array(np, obj, name, dtype, writable):
+    if obj is None:
+      raise TypeError('Missing argument (%s)'%(name))
+    array = np.asarray(obj)
+    if array.dtype != dtype or array.ndim != 1:
+      raise TypeError('Expected an array of %s (%s)'%(np.dtype(dtype).name, name))
+    if writable and not array.flags.writeable:
+      raise TypeError('Expected a writable array (%s)'%(name))
+    return array
+
+  #Applies a Python function to every element
+  def apply(np, func, value, dtype):
+    return np.asarray(np.frompyfunc(func, 1, 1)(value), dtype)
+
+  #Writes an element of each row of an array argument, in the lanes where mask is set
+  def write_array(np, array, index, value, mask):
+    rows = np.arange(array.shape[0])
+    (index, value, mask) = np.broadcast_arrays(np.asarray(index, np.intp), value, mask)
+    array[rows[mask], index[mask]] = value[mask]
+
+  #Returns the value of the last element to write a fuse
+  def get_fuse(np, value, written):
+    lanes = np.flatnonzero(written)
+    return np.broadcast_to(value, written.shape)[lanes[-1]]
+
+  #Generates the Python function
+  def compile_kernel(k, options, chunk_size=None):
+    if chunk_size is None:
+      chunk_size = Compiler_NumPy.chunk_size
+    type = options.type
+    dtype = Compiler_NumPy.get_dtype(type)
+    args = k.get_arguments()
+    optional = [arg for arg in args if arg.is_output and not arg.is_input]
+    candidates = [arg for arg in k.get_arguments(uniform=False, fuse=False) if arg not in optional]
+    if len(candidates) == 0:
+      raise Exception('Kernel must take at least one non-uniform, non-fuse input')
+    src = Formatter()
+    src += '#VecPy generated NumPy kernel: %s'%(k.name)
+    src += 'def %s(*args, **kwargs):'%(k.name)
+    src.indent()
+    src += repr(k.docstring.replace('\\n', '\n'))
+    src += 'objs = Compiler_NumPy.get_objects("%s", %s, args, kwargs)'%(k.name, repr([arg.name for arg in args]))
+    src += '#Uniforms'
+    for (i, arg) in enumerate(args):
+      if arg.is_uniform:
+        src += 'if objs[%d] is None:'%(i)
+        src.indent()
+        src += 'raise TypeError("Missing argument (%s)")'%(arg.name)
+        src.unindent()
+        src += '%s = Compiler_NumPy.get_uniform(np, objs[%d], %s)'%(arg.name, i, dtype)
+    src += '#Arrays'
+    for (i, arg) in enumerate(args):
+      if arg.is_uniform or arg in optional:
+        continue
+      src += 'array_%s = Compiler_NumPy.get_array(np, objs[%d], "%s", %s, %s)'%(arg.name, i, arg.name, dtype, arg.is_output)
+    arg = candidates[0]
+    src += 'allocated = False'
+    src += 'N = len(array_%s)%s'%(arg.name, ' // %d'%(arg.stride) if arg.stride > 1 else '')
+    for arg in optional:
+      i = args.index(arg)
+      src += 'if objs[%d] is None:'%(i)
+      src.indent()
+      src += 'array_%s = np.zeros(%s, %s)'%(arg.name, '1' if arg.is_fuse else 'N', dtype)
+      src += 'objs[%d] = array_%s'%(i, arg.name)
+      src += 'allocated = True'
+      src.unindent()
+      src += 'else:'
+      src.indent()
+      src += 'array_%s = Compiler_NumPy.get_array(np, objs[%d], "%s", %s, True)'%(arg.name, i, arg.name, dtype)
+      src.unindent()
+    src += '#Check lengths'
+    for arg in k.get_arguments(uniform=False):
+      num = '1' if arg.is_fuse else ('N * %d'%(arg.stride) if arg.stride > 1 else 'N')
+      src += 'if len(array_%s) != %s:'%(arg.name, num)
+      src.indent()
+      src += 'raise ValueError("Array sizes don\'t match (%s)")'%(arg.name)
+      src.unindent()
+      if arg.stride > 1:
+        src += 'array_%s = array_%s.reshape(N, %d)'%(arg.name, arg.name, arg.stride)
+    src += '#Literals'
+    for var in k.get_literals():
+      value = var.value if DataType.is_floating(type) else int(var.value) & 0xffffffff
+      src += '%s = %s(%s)'%(var.name, dtype, repr(str(value)))
+    src += 'with np.errstate(all="ignore"):'
+    src.indent()
+    src += 'for start in range(0, N, %d):'%(chunk_size)
+    src.indent()
+    src += 'end = min(start + %d, N)'%(chunk_size)
+    src += 'MASK_TRUE = np.ones(end - start, bool)'
+    src += 'MASK_FALSE = np.zeros(end - start, bool)'
+    src += '#Stack variables'
+    for var in k.get_variables(uniform=False):
+      if var.is_arg:
+        continue
+      src += '%s = np.zeros(end - start, %s)'%(var.name, 'bool' if var.is_mask else dtype)
+    for arg in k.get_arguments(fuse=True):
+      src += '%s = np.zeros(end - start, %s)'%(arg.name, dtype)
+      src += '%s_written = MASK_FALSE.copy()'%(arg.name)
+    src += '#Inputs'
+    for arg in k.get_arguments(uniform=False, fuse=False):
+      if arg.is_input or arg.stride > 1:
+        src += '%s = array_%s[start:end]'%(arg.name, arg.name)
+      else:
+        src += '%s = np.zeros(end - start, %s)'%(arg.name, dtype)
+    src += '#Begin kernel logic'
+    Compiler_NumPy.compile_block(k.block, src, options)
+    src += '#Outputs'
+    for arg in k.get_arguments(output=True, fuse=False):
+      src += 'array_%s[start:end] = %s'%(arg.name, arg.name)
+    for arg in k.get_arguments(output=True, fuse=True):
+      src += 'if np.any(%s_written):'%(arg.name)
+      src.indent()
+      src += 'array_%s[0] = Compiler_NumPy.get_fuse(np, %s, %s_written)'%(arg.name, arg.name, arg.name)
+      src.unindent()
+    src.unindent()
+    src.unindent()
+    if len(optional) > 0:
+      src += '#Return the outputs if any were allocated here'
+      src += 'if allocated:'
+      src.indent()
+      src += 'return (%s,)'%(', '.join('objs[%d]'%(args.index(arg)) for arg in k.get_arguments(output=True)))
+      src.unindent()
+    src += 'return True'
+    src.unindent()
+    return src.get_code()
+
+  #Generates code for a block of statements
+  def compile_block(block, src, options):
+    dtype = Compiler_NumPy.get_dtype(options.type)
+    integral = DataType.is_integral(options.type)
+    for stmt in block.code:
+      if isinstance(stmt, Comment):
+        src += '#>>> %s'%(stmt.comment)
+      elif isinstance(stmt, Assignment):
+        var = stmt.var.name
+        if isinstance(stmt.expr, Variable):
+          mask = stmt.mask.name if stmt.vector_only and stmt.mask is not None else 'MASK_TRUE'
+          if mask == 'MASK_TRUE':
+            src += '%s = %s'%(var, stmt.expr.name)
+          else:
+            src += '%s = np.where(%s, %s, %s)'%(var, mask, stmt.expr.name, var)
+          if stmt.var.is_fuse:
+            src += '%s_written = %s_written | %s'%(var, var, mask)
+        elif isinstance(stmt.expr, BinaryOperation):
+          op = stmt.expr.op
+          left = stmt.expr.left.name
+          right = stmt.expr.right.name
+          if op in ('+', '-', '*', '&', '|', '^', '<<', '>>'):
+            expr = '%s %s %s'%(left, op, right)
+          elif op == '&~':
+            expr = '~%s & %s'%(left, right)
+          elif op == '&&':
+            expr = 'np.logical_and(%s, %s)'%(left, right)
+          elif op == '||':
+            expr = 'np.logical_or(%s, %s)'%(left, right)
+          elif op == '/':
+            expr = 'np.floor_divide(%s, %s)'%(left, right) if integral else '%s / %s'%(left, right)
+          elif op == '//':
+            expr = 'np.floor_divide(%s, %s)'%(left, right) if integral else 'np.floor(%s / %s)'%(left, right)
+          elif op == '%':
+            expr = 'np.remainder(%s, %s)'%(left, right) if integral else 'np.fmod(%s, %s)'%(left, right)
+          elif op in ('**', 'pow'):
+            expr = 'np.asarray(np.power(%s, %s, dtype=np.float64), %s)'%(left, right, dtype)
+          elif op in Compiler_NumPy.functions:
+            expr = 'np.asarray(%s(%s, %s), %s)'%(Compiler_NumPy.functions[op], left, right, dtype)
+          else:
+            raise Exception('Unknown operator (%s)'%(op))
+          src += '%s = %s'%(var, expr)
+        elif isinstance(stmt.expr, UnaryOperation):
+          op = stmt.expr.op
+          input = stmt.expr.var.name
+          if op == '~':
+            if not integral:
+              raise Exception('Operator requires integer operand (%s)'%(op))
+            expr = '~%s'%(input)
+          elif op == '!':
+            expr = 'np.logical_not(%s)'%(input)
+          elif op == 'round':
+            #C rounds halfway cases away from zero
+            expr = input if integral else 'np.copysign(np.floor(np.abs(%s) + %s(0.5)), %s)'%(input, dtype, input)
+          elif op in Compiler_NumPy.python_functions:
+            func = 'math.%s'%(op)
+            expr = 'Compiler_NumPy.apply(np, %s, %s, %s)'%(func, input, dtype)
+          elif op in Compiler_NumPy.functions:
+            expr = 'np.asarray(%s(%s), %s)'%(Compiler_NumPy.functions[op], input, dtype)
+          else:
+            raise Exception('Unknown unary operator/function (%s)'%(op))
+          src += '%s = %s'%(var, expr)
+        elif isinstance(stmt.expr, ComparisonOperation):
+          op = stmt.expr.op
+          if op not in ('==', '!=', '>', '>=', '<', '<='):
+            raise Exception('Unknown operator (%s)'%(op))
+          src += '%s = %s %s %s'%(var, stmt.expr.left.name, op, stmt.expr.right.name)
+        elif isinstance(stmt.expr, ArrayAccess):
+          array = stmt.expr.array.name
+          index = stmt.expr.index.name
+          if stmt.expr.is_read:
+            src += '%s = %s[np.arange(len(%s)), np.broadcast_to(np.asarray(%s, np.intp), len(%s))]'%(var, array, array, index, array)
+          else:
+            src += 'Compiler_NumPy.write_array(np, %s, %s, %s, %s)'%(array, index, var, block.mask.name)
+        else:
+          raise Exception('Bad assignment')
+      elif isinstance(stmt, IfElse):
+        #Blocks where no element's mask is set are skipped
+        src += 'if np.any(%s):'%(stmt.if_block.mask.name)
+        src.indent()
+        src += 'pass'
+        Compiler_NumPy.compile_block(stmt.if_block, src, options)
+        src.unindent()
+        if len(stmt.else_block.code) > 0:
+          src += 'if np.any(%s):'%(stmt.else_block.mask.name)
+          src.indent()
+          src += 'pass'
+          Compiler_NumPy.compile_block(stmt.else_block, src, options)
+          src.unindent()
+      elif isinstance(stmt, WhileLoop):
+        src += 'while np.any(%s):'%(stmt.block.mask.name)
+        src.indent()
+        src += 'pass'
+        Compiler_NumPy.compile_block(stmt.block, src, options)
+        src.unindent()
+      else:
+        raise Exception('Can\'t handle that (%s)'%(stmt.__class__))
+
+  #Returns the kernel as a Python function with the same signature as the native module
+  def compile(k, options, chunk_size=None):
+    try:
+      import numpy
+    except ImportError:
+      raise Exception('NumPy is required for the NumPy backend')
+    code = Compiler_NumPy.compile_kernel(k, options, chunk_size)
+    namespace = {'np': numpy, 'math': math, 'Compiler_NumPy': Compiler_NumPy}
+    exec(compile(code, '<vecpy_%s_numpy>'%(k.name), 'exec'), namespace)
+    func = namespace[k.name]
+    func.source = code
+    return func
@@ -0,0 +1,359 @@
+"""
+Shards elementwise kernels across worker processes, locally or on other hosts.
+Every worker loads the same compiled vecpy_<name> module; the coordinator
+splits the N elements into contiguous shards and gathers outputs and
+reductions. Workers on the same host exchange arrays through shared memory,
+others receive their shard over the socket.
+"""
+
+
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from vecpy.allocator import Allocator
+from vecpy.loader import load
+
+#Shard boundaries are multiples of this many elements (keeps shards SIMD aligned)
+shard_align = 16
+
+#Protocol: an 8-byte header size, a JSON header, then the raw payloads listed in the header
+def send_message(sock, header, payloads=()):
+  payloads = [memoryview(payload).cast('B') for payload in payloads]
+  header = dict(header, sizes=[len(payload) for payload in payloads])
+  data = json.dumps(header).encode('utf-8')
+  sock.sendall(struct.pack('<Q', len(data)) + data)
+  for payload in payloads:
+    sock.sendall(payload)
+
+def recv_exact(sock, num_bytes):
+  data = bytearray(num_bytes)
+  view = memoryview(data)
+  offset = 0
+  while offset < num_bytes:
+    count = sock.recv_into(view[offset:])
+    if count == 0:
+      raise ConnectionError('Connection closed')
+    offset += count
+  return data
+
+def recv_message(sock):
+  (size,) = struct.unpack('<Q', recv_exact(sock, 8))
+  header = json.loads(recv_exact(sock, size).decode('utf-8'))
+  return (header, [recv_exact(sock, size) for size in header['sizes']])
+
+#Addresses are 'unix:/path/to/socket' or 'host:port'
+def get_socket(address):
+  if address.startswith('unix:'):
+    return (socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address[5:])
+  (host, port) = address.rsplit(':', 1)
+  return (socket.socket(socket.AF_INET, socket.SOCK_STREAM), (host, int(port)))
+
+def is_local(address):
+  return address.startswith('unix:') or address.rsplit(':', 1)[0] in ('localhost', '127.0.0.1')
+
+#Attaches to a shared memory block created by the coordinator
+def attach(name):
+  block = shared_memory.SharedMemory(name=name)
+  #The coordinator owns the block, so this process must not unlink it on exit
+  try:
+    resource_tracker.unregister(block._name, 'shared_memory')
+  except Exception:
+    pass
+  return block
+
+#Serves kernel calls for one compiled module
+class Worker:
+  def __init__(self, name, address):
+    self.name = name
+    self.kernel = load(name)
+    self.address = address
+
+  #Accepts connections until stopped
+  def serve(self):
+    (server, target) = get_socket(self.address)
+    if self.address.startswith('unix:') and os.path.exists(target):
+      os.unlink(target)
+    else:
+      server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(target)
+    server.listen()
+    self.running = True
+    while self.running:
+      (sock, peer) = server.accept()
+      threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+    server.close()
+    if self.address.startswith('unix:'):
+      os.unlink(target)
+
+  #Runs the requests of one coordinator
+  def handle(self, sock):
+    with sock:
+      while True:
+        try:
+          (header, payloads) = recv_message(sock)
+        except ConnectionError:
+          return
+        if header['op'] == 'stop':
+          self.running = False
+          send_message(sock, {'ok': True})
+          #Wake up the accept loop
+          try:
+            (wake, target) = get_socket(self.address)
+            wake.connect(target)
+            wake.close()
+          except OSError:
+            pass
+          return
+        try:
+          self.run(sock, header, payloads)
+        except (ConnectionError, BrokenPipeError):
+          return
+        except Exception as e:
+          send_message(sock, {'ok': False, 'error': str(e)})
+
+  #Runs the kernel on one shard and replies with the outputs
+  def run(self, sock, header, payloads):
+    if header['kernel'] != self.name:
+      raise Exception('Worker serves %s, not %s'%(self.name, header['kernel']))
+    type = header['type']
+    size = Allocator.sizes[type]
+    args = dict(header['uniforms'])
+    blocks = []
+    views = {}
+    try:
+      for (name, spec) in header['arrays'].items():
+        if 'shm' in spec:
+          block = attach(spec['shm'])
+          blocks.append(block)
+          start = spec['offset'] * size
+          views[name] = block.buf[start:start + spec['length'] * size].cast(type)
+        else:
+          #Copy into an aligned array (socket payloads are not aligned)
+          views[name] = Allocator.get_array(type, spec['length'])
+          Allocator.copy(views[name].cast('B'), payloads[spec['payload']])
+      #Reductions start from the coordinator's value
+      for (name, value) in header['reductions'].items():
+        views[name] = Allocator.get_array(type, 1, value=value)
+      args.update(views)
+      self.kernel(**args)
+      reply = {'ok': True, 'reductions': {name: views[name][0] for name in header['reductions']}}
+      outputs = [views[name] for name in header['outputs'] if 'shm' not in header['arrays'][name]]
+      send_message(sock, reply, outputs)
+    finally:
+      for view in views.values():
+        view.release()
+      for block in blocks:
+        block.close()
+
+#Splits kernel calls across workers
+class Coordinator:
+  def __init__(self, addresses, shared_memory=None):
+    self.addresses = list(addresses)
+    #Shared memory is only possible when every worker is on this host
+    if shared_memory is None:
+      shared_memory = all(is_local(address) for address in self.addresses)
+    self.shared_memory = shared_memory
+    #Segments of the arrays from get_array, by array identity
+    self.arrays = {}
+    #Segments that other arrays are staged through, by argument name (kept across calls)
+    self.staging = {}
+    self.sockets = []
+    for address in self.addresses:
+      (sock, target) = get_socket(address)
+      sock.connect(target)
+      self.sockets.append(sock)
+
+  #Returns an array in a shared memory segment owned by the coordinator
+  #  Local workers run on these arrays in place, so calls don't copy them. Every element is set
+  #  to value; with value=None the contents are left as they are (zero-filled).
+  def get_array(self, type, length, value=0):
+    Allocator.check_type(type)
+    if length <= 0:
+      raise Exception('Length must be positive')
+    size = Allocator.sizes[type]
+    block = shared_memory.SharedMemory(create=True, size=length * size)
+    view = block.buf[:length * size]
+    array = view.cast(type)
+    view.release()
+    if value is not None and value != 0:
+      Allocator.fill(array.cast('B'), type, value)
+    self.arrays[id(array)] = (block, array)
+    return array
+
+  #Releases an array from get_array and frees its segment
+  def release(self, array):
+    if id(array) not in self.arrays:
+      raise Exception('Array not allocated by this coordinator')
+    (block, array) = self.arrays.pop(id(array))
+    array.release()
+    block.close()
+    block.unlink()
+
+  #Returns the (segment name, element offset) of a view that lies in an array from get_array
+  def find_array(self, view):
+    try:
+      address = Allocator.get_address(view.cast('B'))
+    except TypeError:
+      return None
+    for (block, array) in self.arrays.values():
+      base = Allocator.get_address(array.cast('B'))
+      if base <= address and address + view.nbytes <= base + array.nbytes:
+        return (block.name, (address - base) // view.itemsize)
+    return None
+
+  #Returns a staging segment of at least num_bytes for an argument
+  def get_staging(self, name, num_bytes):
+    block = self.staging.get(name)
+    if block is None or block.size < num_bytes:
+      if block is not None:
+        block.close()
+        block.unlink()
+      block = shared_memory.SharedMemory(create=True, size=num_bytes)
+      self.staging[name] = block
+    return block
+
+  #Returns the (offset, length) of each worker's shard
+  def get_shards(self, N):
+    num = len(self.sockets)
+    per_worker = (N // num) // shard_align * shard_align
+    shards = []
+    offset = 0
+    for i in range(num):
+      length = per_worker if i < num - 1 else N - offset
+      shards.append((offset, length))
+      offset += length
+    return shards
+
+  #Runs a kernel over arrays of N elements (and length-1 reduction arrays), in place
+  #  outputs names the arrays to gather; reductions maps each reduced (fuse) argument to a
+  #  function that combines the per-shard values, e.g. {'m': max}
+  def run(self, kernel, arrays, uniforms={}, outputs=(), reductions={}, type='f'):
+    Allocator.check_type(type)
+    size = Allocator.sizes[type]
+    views = {name: memoryview(array).cast('B').cast(type) for (name, array) in arrays.items()}
+    elementwise = [name for name in views if name not in reductions]
+    if len(elementwise) == 0:
+      raise Exception('At least one elementwise array is needed')
+    for name in outputs:
+      if name not in elementwise:
+        raise Exception('Invalid output (%s)'%(name))
+    N = len(views[elementwise[0]])
+    for name in elementwise:
+      if len(views[name]) != N:
+        raise Exception('Array sizes don\'t match (%s)'%(name))
+    shards = self.get_shards(N)
+    try:
+      #Arrays from get_array are used in place; the others are staged in shared memory (outputs
+      #  too, kernels may read them)
+      segments = {}
+      if self.shared_memory:
+        for name in elementwise:
+          segments[name] = self.find_array(views[name])
+          if segments[name] is None:
+            block = self.get_staging(name, N * size)
+            Allocator.copy(block.buf[:N * size], views[name].cast('B'))
+            segments[name] = (block.name, 0)
+      #Send each shard to its worker, then gather
+      replies = [None] * len(self.sockets)
+      def call(i):
+        (offset, length) = shards[i]
+        header = {'op': 'run', 'kernel': kernel, 'type': type, 'uniforms': uniforms, 'outputs': list(outputs), 'arrays': {}}
+        header['reductions'] = {name: views[name][0] for name in reductions}
+        payloads = []
+        for name in elementwise:
+          if self.shared_memory:
+            (segment, start) = segments[name]
+            header['arrays'][name] = {'shm': segment, 'offset': start + offset, 'length': length}
+          else:
+            header['arrays'][name] = {'payload': len(payloads), 'length': length}
+            payloads.append(views[name][offset:offset + length])
+        try:
+          send_message(self.sockets[i], header, payloads)
+          replies[i] = recv_message(self.sockets[i])
+        except Exception as e:
+          replies[i] = ({'ok': False, 'error': str(e)}, [])
+      threads = [threading.Thread(target=call, args=(i,)) for i in range(len(self.sockets)) if shards[i][1] > 0]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      #Gather outputs and reductions
+      values = {name: [] for name in reductions}
+      for (i, reply) in enumerate(replies):
+        if reply is None:
+          continue
+        (header, payloads) = reply
+        if not header['ok']:
+          raise Exception('Worker %s failed: %s'%(self.addresses[i], header['error']))
+        (offset, length) = shards[i]
+        if not self.shared_memory:
+          for (name, payload) in zip(outputs, payloads):
+            views[name][offset:offset + length] = memoryview(payload).cast(type)
+        for name in reductions:
+          values[name].append(header['reductions'][name])
+      if self.shared_memory:
+        for name in outputs:
+          if name in self.staging and segments[name][0] == self.staging[name].name:
+            Allocator.copy(views[name].cast('B'), self.staging[name].buf[:N * size])
+      for (name, combine) in reductions.items():
+        if len(values[name]) > 0:
+          views[name][0] = combine(values[name])
+      return True
+    finally:
+      for view in views.values():
+        view.release()
+
+  #Stops the workers
+  def stop(self):
+    for sock in self.sockets:
+      send_message(sock, {'op': 'stop'})
+      recv_message(sock)
+    self.close()
+
+  #Disconnects and frees the shared memory (including the arrays from get_array)
+  def close(self):
+    for sock in self.sockets:
+      sock.close()
+    self.sockets = []
+    for block in self.staging.values():
+      block.close()
+      block.unlink()
+    self.staging = {}
+    for array in [array for (block, array) in self.arrays.values()]:
+      self.release(array)
+
+#Starts a local worker listening on each address, returns the processes
+def start_workers(name, addresses, timeout=30):
+  processes = []
+  for address in addresses:
+    if address.startswith('unix:') and os.path.exists(address[5:]):
+      os.unlink(address[5:])
+    processes.append(subprocess.Popen([sys.executable, '-m', 'vecpy', 'worker', name, address]))
+  #Wait until every worker is listening
+  deadline = time.time() + timeout
+  for (process, address) in zip(processes, addresses):
+    while True:
+      try:
+        (sock, target) = get_socket(address)
+        with sock:
+          sock.connect(target)
+        break
+      except OSError:
+        pass
+      if process.poll() is not None:
+        raise Exception('Worker exited (%d)'%(process.returncode))
+      if time.time() > deadline:
+        raise Exception('Timed out waiting for workers')
+      time.sleep(0.01)
+  return processes
+
+#Starts count local workers listening on Unix sockets in directory, returns (processes, addresses)
+def spawn_workers(name, count, directory, timeout=30):
+  addresses = ['unix:' + os.path.join(directory, 'vecpy_%s_%d.sock'%(name, i)) for i in range(count)]
+  return (start_workers(name, addresses, timeout), addresses)
@@ -0,0 +1,155 @@
+"""
+The Fuser merges several kernels into one, so that a chain of kernels runs
+as a single pass over the data instead of writing and re-reading full-size
+intermediate arrays between stages.
+"""
+
+
+from vecpy.kernel import *
+
+#Combines abstract kernels
+class Fuser:
+
+  #Splits a 'kernel.argument' wiring endpoint
+  def get_endpoint(kernels, endpoint):
+    if endpoint.count('.') != 1:
+      raise Exception('Expected kernel.argument (%s)'%(endpoint))
+    (name, arg) = endpoint.split('.')
+    for (i, k) in enumerate(kernels):
+      if k.name == name:
+        if arg not in k.arguments:
+          raise Exception('Unknown argument (%s)'%(endpoint))
+        return (i, k.arguments[arg])
+    raise Exception('Unknown kernel (%s)'%(endpoint))
+
+  #Returns a copy of a variable under a new name
+  def copy_variable(var, name, is_arg):
+    return Variable(name=name, is_arg=is_arg, is_uniform=var.is_uniform and is_arg, is_fuse=var.is_fuse and is_arg, is_temp=var.is_temp, is_mask=var.is_mask, stride=var.stride, value=var.value)
+
+  #Returns a copy of a code block with every variable replaced
+  def copy_block(block, get):
+    copy = Block(get(block.mask))
+    for stmt in block.code:
+      copy.add(Fuser.copy_statement(stmt, get))
+    return copy
+
+  def copy_statement(stmt, get):
+    if isinstance(stmt, Comment):
+      return Comment(stmt.comment)
+    elif isinstance(stmt, Assignment):
+      return Assignment(get(stmt.var), Fuser.copy_expression(stmt.expr, get), stmt.vector_only, get(stmt.mask))
+    elif isinstance(stmt, IfElse):
+      copy = IfElse(None, None)
+      copy.if_block = Fuser.copy_block(stmt.if_block, get)
+      copy.else_block = Fuser.copy_block(stmt.else_block, get)
+      return copy
+    elif isinstance(stmt, WhileLoop):
+      copy = WhileLoop(None)
+      copy.block = Fuser.copy_block(stmt.block, get)
+      return copy
+    else:
+      raise Exception('Unexpected statement (%s)'%(stmt.__class__))
+
+  def copy_expression(expr, get):
+    if isinstance(expr, Variable):
+      return get(expr)
+    elif isinstance(expr, BinaryOperation):
+      return BinaryOperation(get(expr.left), expr.op, get(expr.right))
+    elif isinstance(expr, UnaryOperation):
+      return UnaryOperation(expr.op, get(expr.var))
+    elif isinstance(expr, ComparisonOperation):
+      return ComparisonOperation(get(expr.left), expr.op, get(expr.right))
+    elif isinstance(expr, ArrayAccess):
+      return ArrayAccess(get(expr.array), get(expr.index), expr.is_read)
+    else:
+      raise Exception('Unexpected expression (%s)'%(expr.__class__))
+
+  #Fuses kernels (in order) into a single kernel
+  #  wiring maps 'kernel.argument' to the 'kernel.argument' it reads from, e.g.
+  #  {'transform.x': 'normalize.y'}. An output wired this way becomes a temporary
+  #  of the fused kernel; any other argument is shared with the one it's wired to.
+  def fuse(kernels, wiring, name=None):
+    if len(kernels) == 0:
+      raise Exception('No kernels to fuse')
+    if len(set(k.name for k in kernels)) != len(kernels):
+      raise Exception('Kernel names must be unique')
+    if name is None:
+      name = '_'.join(k.name for k in kernels)
+    fused = Kernel(name)
+    fused.set_docstring('Fused kernel: %s'%(' -> '.join(k.name for k in kernels)))
+    #Check the wiring
+    sources = {}
+    intermediates = set()
+    for (dst, src) in wiring.items():
+      (i, dst_arg) = Fuser.get_endpoint(kernels, dst)
+      (j, src_arg) = Fuser.get_endpoint(kernels, src)
+      if j >= i:
+        raise Exception('%s must come from an earlier kernel (%s)'%(dst, src))
+      if src_arg.is_output:
+        #An intermediate value, passed between kernels in registers
+        if src_arg.is_input or src_arg.is_fuse or src_arg.stride > 1:
+          raise Exception('Only elementwise outputs can be fused (%s)'%(src))
+        if dst_arg.is_uniform or dst_arg.is_fuse or dst_arg.stride > 1:
+          raise Exception('Only elementwise inputs can be fused (%s)'%(dst))
+        intermediates.add(id(src_arg))
+      elif (dst_arg.is_uniform, dst_arg.is_fuse, dst_arg.stride) != (src_arg.is_uniform, src_arg.is_fuse, src_arg.stride):
+        raise Exception('Can\'t share arguments of different kinds (%s, %s)'%(dst, src))
+      sources[id(dst_arg)] = src_arg
+    #Arguments keep their names unless two kernels expose the same one
+    exposed = [arg.name for k in kernels for arg in k.get_arguments() if id(arg) not in sources and id(arg) not in intermediates]
+    #Variables of each kernel, by identity, mapped to variables of the fused kernel
+    mapping = {}
+    for k in kernels:
+      for arg in k.get_arguments():
+        if id(arg) in sources:
+          continue
+        if id(arg) in intermediates:
+          var = Fuser.copy_variable(arg, '%s_%s'%(k.name, arg.name), False)
+        else:
+          arg_name = arg.name if exposed.count(arg.name) == 1 else '%s_%s'%(k.name, arg.name)
+          var = Fuser.copy_variable(arg, arg_name, True)
+          var.is_input = arg.is_input
+          var.is_output = arg.is_output
+        mapping[id(arg)] = fused.add_variable(var)
+    #Wired arguments read (or share) the variable they're wired to
+    for k in kernels:
+      for arg in k.get_arguments():
+        if id(arg) in sources:
+          src = sources[id(arg)]
+          while id(src) in sources:
+            src = sources[id(src)]
+          var = mapping[id(src)]
+          if var.is_arg:
+            var.is_input = var.is_input or arg.is_input
+            var.is_output = var.is_output or arg.is_output
+          mapping[id(arg)] = var
+    #Locals are prefixed with their kernel's name and literals are shared
+    for k in kernels:
+      for var in sorted(k.variables.values(), key=lambda var: var.index):
+        if var.is_arg:
+          continue
+        if var.value is not None:
+          lit = fused.get_literal(var.value)
+          if lit is None:
+            lit = fused.add_variable(Fuser.copy_variable(var, '%s_%s'%(k.name, var.name), False))
+          mapping[id(var)] = lit
+        else:
+          mapping[id(var)] = fused.add_variable(Fuser.copy_variable(var, '%s_%s'%(k.name, var.name), False))
+    #Concatenate the code of every kernel
+    for k in kernels:
+      def get(var):
+        if var is None:
+          return None
+        elif var is k.mask_true:
+          return fused.mask_true
+        elif var is k.mask_false:
+          return fused.mask_false
+        elif id(var) in mapping:
+          return mapping[id(var)]
+        raise Exception('Unknown variable (%s)'%(var.name))
+      fused.block.add(Comment('Fused kernel: %s'%(k.name)))
+      fused.block.add(Fuser.copy_block(k.block, get).code)
+    #Same check as the parser
+    if len(fused.get_arguments(uniform=False, array=False)) == 0:
+      raise Exception('Kernel must take at least one non-uniform, non-array argument')
+    return fused
@@ -5,19 +5,8 @@ The Kernel is a set of operations to be performed on a set of data.
 
 #Holds information about variables
 class Variable:
-  #A unique variable identifier
-  index = 0
   def __init__(self, name=None, is_arg=False, is_uniform=False, is_fuse=False, is_temp=False, is_mask=False, stride=1, value=None):
-    if name is None:
-      if value is None:
-        if is_mask:
-          prefix = 'mask'
-        else:
-          prefix = 'var'
-      else:
-        prefix = 'lit'
-      name = '%s%03d'%(prefix, Variable.index)
-    #The variable name
+    #The variable name (unnamed variables are named by their kernel)
     self.name = name
     #Whether or not the variable is an argument
     self.is_arg = is_arg
@@ -33,14 +22,12 @@ class Variable:
     self.stride = stride
     #The value of this literal
     self.value = value
-    #A unique identifier for this variable
-    self.index = Variable.index
+    #A unique identifier for this variable within its kernel (assigned by the kernel)
+    self.index = None
     #Whether or not this argument is read from
     self.is_input = False
     #Whether or not this argument is written to
     self.is_output = False
-    #Increment variable identifier
-    Variable.index += 1
 
 #Built-in Python binary operators
 class Operator:
@@ -237,6 +224,8 @@ class Kernel:
     self.arguments = {}
     #A table of literal variables
     self.literals = {}
+    #The next variable identifier (per kernel, so kernels can be parsed concurrently)
+    self.next_index = 0
     #The default docstring
     self.docstring = 'An undocumented (but probably awesome) kernel function.'
     #Literal masks
@@ -261,6 +250,18 @@ class Kernel:
 
   #Adds a new variable to the kernel
   def add_variable(self, var):
+    #Assign a unique identifier (and name, if there isn't one)
+    var.index = self.next_index
+    self.next_index += 1
+    if var.name is None:
+      if var.value is None:
+        if var.is_mask:
+          prefix = 'mask'
+        else:
+          prefix = 'var'
+      else:
+        prefix = 'lit'
+      var.name = '%s%03d'%(prefix, var.index)
     #Add this variable to the variables dictionary
     self.variables[var.name] = var
     if var.is_arg:
@@ -0,0 +1,85 @@
+"""
+Loads kernels from packages built ahead of time (python -m vecpy build). Only
+the prebuilt module is imported, so neither the parser and compiler nor a C++
+compiler are needed where the kernels run.
+"""
+
+
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import sys
+import sysconfig
+
+#Name of the manifest at the root of a package
+manifest_file = 'manifest.json'
+#Package searched when neither path nor VECPY_PATH is given
+default_path = 'vecpy_dist'
+
+#Instruction set extensions of this CPU (read once)
+cpu_flags = None
+
+def get_cpu_flags():
+  global cpu_flags
+  if cpu_flags is None:
+    cpu_flags = set()
+    try:
+      with open('/proc/cpuinfo') as file:
+        for line in file:
+          if line.startswith('flags'):
+            cpu_flags = set(line.split(':', 1)[1].split())
+            break
+    except OSError:
+      pass
+  return cpu_flags
+
+#Returns the manifest of the package in path, or None if there isn't one
+def read_manifest(path):
+  file_name = os.path.join(path, manifest_file)
+  if not os.path.exists(file_name):
+    return None
+  with open(file_name) as file:
+    return json.load(file)
+
+#Returns the name of the fastest architecture of a kernel that this CPU supports
+def get_arch(entry, arch=None):
+  archs = entry['archs']
+  if arch is not None:
+    if arch not in archs:
+      raise Exception('Architecture not in package (%s)'%(arch))
+    return arch
+  supported = [name for name in archs if archs[name]['requires'] is None or archs[name]['requires'] in get_cpu_flags()]
+  if len(supported) == 0:
+    raise Exception('No architecture in the package is supported by this CPU')
+  return max(supported, key=lambda name: archs[name]['level'])
+
+#Returns a kernel from a prebuilt package
+#  path is the package directory (default: $VECPY_PATH, then ./vecpy_dist); arch overrides
+#  the architecture detected from the CPU. Without a package, vecpy_<name> is imported as usual.
+def load(name, path=None, arch=None):
+  module_name = 'vecpy_' + name
+  if path is None:
+    path = os.environ.get('VECPY_PATH', default_path)
+  manifest = read_manifest(path)
+  if manifest is None or name not in manifest['kernels']:
+    if arch is not None:
+      raise Exception('Kernel not in a package at %s (%s)'%(path, name))
+    return getattr(importlib.import_module(module_name), name)
+  if manifest['soabi'] != sysconfig.get_config_var('SOABI'):
+    raise Exception('Package was built for %s, not %s'%(manifest['soabi'], sysconfig.get_config_var('SOABI')))
+  entry = manifest['kernels'][name]
+  file_name = os.path.join(path, entry['archs'][get_arch(entry, arch)]['file'])
+  #A module is only loaded once per process, so a loaded one must be the file asked for
+  if module_name in sys.modules:
+    loaded = getattr(sys.modules[module_name], '__file__', None)
+    if loaded is None or not os.path.exists(loaded) or not os.path.samefile(loaded, file_name):
+      raise Exception('%s is already loaded from %s, not %s'%(module_name, loaded, file_name))
+    return getattr(sys.modules[module_name], name)
+  loader = importlib.machinery.ExtensionFileLoader(module_name, file_name)
+  spec = importlib.util.spec_from_file_location(module_name, file_name, loader=loader)
+  module = importlib.util.module_from_spec(spec)
+  loader.exec_module(module)
+  sys.modules[module_name] = module
+  return getattr(module, name)
@@ -565,9 +565,7 @@ class Parser:
         print('Skipping function:', node.name)
         continue
 
-      #Make sure there are no decorators
-      if len(node.decorator_list) > 0:
-        raise Exception('Decorators not supported')
+      #Decorators (e.g. @kernel) don't change the kernel itself, so they're ignored
 
       ##Get the function name
       #print("Found '%s' on line %d!"%(kernel_name, node.lineno))
@@ -1,37 +1,690 @@
-import array
-import math
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import importlib
+import json
+import mmap
+import os
+import socket
+import sys
+import threading
 import time
-from vecpy.parser import Parser
-from vecpy.compiler import Compiler
+from multiprocessing import shared_memory
+from vecpy.allocator import Allocator, Arena
+from vecpy.distributed import recv_message, send_message
+from vecpy.compiler_constants import Architecture, Binding, DataType, Options
+from vecpy.loader import manifest_file, read_manifest
+from vecpy.server import default_path
 
-#Invokes the VecPy stack
-def vectorize(func, options):
-  Compiler.compile(Parser.parse(func), options)
+#Invokes the VecPy stack, returns the time (in seconds) of each stage
+#  Stages are parse, codegen, pch (precompiled header, usually cached), compile and link.
+#  Given a list of kernels, builds a single module (vecpy_<name>) that exports all of them;
+#  each item is a function or a (function, DataType) pair, e.g. [f, (g, DataType.uint32)].
+def vectorize(func, options, name=None):
+  #The compiler stack is only imported to build kernels (prebuilt ones are loaded without it)
+  from vecpy.parser import Parser
+  from vecpy.compiler import Compiler
+  start = time.perf_counter()
+  if not isinstance(func, (list, tuple)):
+    kernel = Parser.parse(func)
+    timing = {'parse': time.perf_counter() - start}
+    timing.update(Compiler.compile(kernel, options))
+    return timing
+  if name is None:
+    raise Exception('A module name is needed for several kernels')
+  kernels = []
+  for item in func:
+    (item, type) = item if isinstance(item, tuple) else (item, options.type)
+    kernels.append((Parser.parse(item), type))
+  timing = {'parse': time.perf_counter() - start}
+  timing.update(Compiler.compile_library(name, kernels, copy.copy(options)))
+  return timing
+
+#Returns the kernel as a pure-NumPy function (no C++ compiler needed) with the native signature
+def vectorize_numpy(func, options, chunk_size=None):
+  from vecpy.parser import Parser
+  from vecpy.compiler_numpy import Compiler_NumPy
+  return Compiler_NumPy.compile(Parser.parse(func), options, chunk_size)
+
+#Compiles several kernels at once, each in its own build directory (build_dir/<name>)
+#  Code generation and g++ run on up to jobs threads; modules land in options.module_dir.
+#  Returns the stage timings of each kernel, by name.
+def vectorize_many(funcs, options, jobs=None, build_dir='vecpy_build'):
+  names = [func.__name__ for func in funcs]
+  if len(set(names)) != len(names):
+    raise Exception('Kernel names must be unique')
+  def build(func):
+    kernel_options = copy.copy(options)
+    kernel_options.build_dir = os.path.join(build_dir, func.__name__)
+    return vectorize(func, kernel_options)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+    futures = [pool.submit(build, func) for func in funcs]
+    return {name: future.result() for (name, future) in zip(names, futures)}
+
+#Builds kernels ahead of time into a relocatable package, loaded with vecpy.load
+#  The package holds <arch>/vecpy_<name>.so for each architecture and a manifest; building
+#  into an existing package adds (or replaces) kernels. Returns the stage timings by arch.
+def build_package(funcs, archs, type, path='vecpy_dist', bindings=(Binding.python,), threads=None, jobs=None):
+  import sysconfig
+  import tempfile
+  manifest = read_manifest(path) or {'kernels': {}}
+  manifest['python'] = '%d.%d'%(sys.version_info[:2])
+  manifest['soabi'] = sysconfig.get_config_var('SOABI')
+  manifest['platform'] = sysconfig.get_platform()
+  #The thread count is compiled in, so it's recorded in the manifest
+  if threads is None or threads < 1:
+    threads = os.cpu_count() or 1
+  timing = {}
+  with tempfile.TemporaryDirectory() as build_dir:
+    for arch in archs:
+      arch_name = [name for (name, value) in vars(Architecture).items() if value is arch][0]
+      options = Options(arch, type, bindings=bindings, threads=threads, module_dir=os.path.join(path, arch_name))
+      timing[arch_name] = vectorize_many(funcs, options, jobs, os.path.join(build_dir, arch_name))
+      for func in funcs:
+        entry = manifest['kernels'].setdefault(func.__name__, {'archs': {}})
+        entry.update(type=type, bindings=list(bindings), threads=threads)
+        #The CPU flag that the loader checks for (same as the architecture's name)
+        requires = None if Architecture.is_generic(arch) else arch_name
+        entry['archs'][arch_name] = {'file': '%s/vecpy_%s.so'%(arch_name, func.__name__), 'level': arch['level'], 'requires': requires}
+  with open(os.path.join(path, manifest_file), 'w') as file:
+    json.dump(manifest, file, indent=2, sort_keys=True)
+  return timing
+
+#A kernel that runs on NumPy until its native module is built in the background
+class LazyKernel:
+  def __init__(self, func, options, on_event=None):
+    self.__name__ = func.__name__
+    self.__doc__ = func.__doc__
+    self.func = func
+    self.options = options
+    #Called with each event (a dict) as it's recorded, e.g. to export metrics
+    self.on_event = on_event
+    #Recorded events: 'fallback', 'compiled', 'swapped' and 'failed'
+    self.events = []
+    self.ready = threading.Event()
+    #The current implementation; replacing it is a single (atomic) attribute store
+    self.impl = None
+    #Backend of the current implementation: None, 'numpy' or 'native' (set after impl)
+    self.backend = None
+    try:
+      self.impl = vectorize_numpy(func, options)
+      self.backend = 'numpy'
+      self.record('fallback', backend='numpy')
+    except Exception as e:
+      #Calls wait for the native module instead
+      self.record('fallback', backend=None, error=str(e))
+    threading.Thread(target=self.build, name='vecpy-build-%s'%(func.__name__), daemon=True).start()
+
+  def record(self, event, **details):
+    details.update(event=event, kernel=self.__name__, time=time.time())
+    self.events.append(details)
+    if self.on_event is not None:
+      self.on_event(details)
+
+  #Builds and imports the native module, then swaps it in
+  def build(self):
+    try:
+      start = time.perf_counter()
+      timing = vectorize(self.func, self.options)
+      self.record('compiled', seconds=time.perf_counter() - start, stages=timing)
+      #The module didn't exist when the import system last listed the directory
+      importlib.invalidate_caches()
+      native = getattr(importlib.import_module('vecpy_' + self.__name__), self.__name__)
+      self.impl = native
+      self.backend = 'native'
+      self.record('swapped', backend='native')
+    except Exception as e:
+      self.record('failed', error=str(e))
+    finally:
+      self.ready.set()
+
+  #Waits for the native build; returns True if the native module is in use
+  def wait(self, timeout=None):
+    self.ready.wait(timeout)
+    return self.is_native()
+
+  def is_native(self):
+    return self.backend == 'native'
+
+  def __call__(self, *args, **kwargs):
+    impl = self.impl
+    if impl is None:
+      self.ready.wait()
+      impl = self.impl
+      if impl is None:
+        raise Exception('Kernel failed to build (%s)'%(self.__name__))
+    return impl(*args, **kwargs)
+
+#Decorator form of vectorize: @kernel(arch=Architecture.avx2, type=DataType.float)
+#  Returns immediately; calls run on the NumPy backend until the native build finishes.
+def kernel(arch=Architecture.generic, type=DataType.float, threads=None, on_event=None):
+  def decorate(func):
+    options = Options(arch, type, bindings=(Binding.python,), threads=threads, build_dir=os.path.join('vecpy_build', func.__name__))
+    return LazyKernel(func, options, on_event)
+  return decorate
+
+#Compiles a chain of kernels into a single pass (see Fuser.fuse) and returns the fused kernel
+#  e.g. fuse([normalize, clamp], {'clamp.x': 'normalize.y'}, options)
+def fuse(funcs, wiring, options, name=None):
+  from vecpy.parser import Parser
+  from vecpy.compiler import Compiler
+  from vecpy.fuser import Fuser
+  kernel = Fuser.fuse([Parser.parse(func) for func in funcs], wiring, name)
+  Compiler.compile(kernel, options)
+  return kernel
 
 #Returns an aligned array (necessary for SSE/AVX)
-def get_array(type, length, align=32, value=0):
-  #Check arguments
-  if type not in ('f', 'I'):
-    raise Exception('Invalid type')
-  if length <= 0:
-    raise Exception('Length must be positive')
-  if align < 16 or 2 ** int(math.log2(align)) != align:
-    raise Exception('Alignment must be a power of 2, at least 16')
-  #4 bytes per element
-  size = 4
-  num_elements = align // size
-  padding = num_elements - 1
-  #Allocate the (probably unaligned) buffer
-  buffer = array.array(type, [value for i in range(length + padding)])
-  #Find the offset needed to reach the boundary
-  base_address = buffer.buffer_info()[0]
-  offset = ((align - (base_address % align)) % align) // size
-  #Return the buffer starting at an aligned offset
-  return memoryview(buffer)[offset:length + offset]
-
-#Returns aligned arrays
-def get_arrays(num, type, length, align=32, value=0):
-  return [get_array(type, length, align, value) for i in range(num)]
+def get_array(type, length, align=32, value=0, huge_pages=False):
+  return Allocator.get_array(type, length, align, value, huge_pages=huge_pages)
+
+#Returns aligned arrays (carved out of a single mapping)
+def get_arrays(num, type, length, align=32, value=0, huge_pages=False):
+  arena = Arena(Arena.get_size(num, type, length, align), align, huge_pages)
+  return arena.get_arrays(num, type, length, value)
+
+#Reusable aligned buffers with a bounded amount of idle memory
+class BufferPool:
+  def __init__(self, max_bytes=256 << 20):
+    #Upper bound on the size of idle buffers held by the pool
+    self.max_bytes = max_bytes
+    #Idle buffers keyed by (type, length, align), least recently used first
+    self.idle = collections.OrderedDict()
+    #Total size of idle buffers
+    self.idle_bytes = 0
+    #Keys of buffers currently handed out, by buffer identity
+    self.active = {}
+    #Counters
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+
+  #Returns an aligned array, reusing an idle one if possible
+  #  Every element is set to value; with value=None the contents are uninitialized (a reused
+  #  array keeps whatever it held when it was released).
+  def acquire(self, type, length, align=32, value=None):
+    key = (type, length, align)
+    with self.lock:
+      buffers = self.idle.get(key)
+      if buffers:
+        buffer = buffers.pop()
+        if len(buffers) == 0:
+          del self.idle[key]
+        self.idle_bytes -= buffer.nbytes
+        self.hits += 1
+      else:
+        buffer = None
+        self.misses += 1
+    if buffer is None:
+      buffer = get_array(type, length, align, value)
+    elif value is not None:
+      Allocator.fill(buffer.cast('B'), type, value)
+    with self.lock:
+      self.active[id(buffer)] = key
+    return buffer
+
+  #Returns an array to the pool, evicting the least recently used idle arrays if needed
+  def release(self, buffer):
+    with self.lock:
+      key = self.active.pop(id(buffer), None)
+      if key is None:
+        raise Exception('Buffer not acquired from this pool')
+      if buffer.nbytes > self.max_bytes:
+        self.evictions += 1
+        return
+      self.idle.setdefault(key, []).append(buffer)
+      self.idle.move_to_end(key)
+      self.idle_bytes += buffer.nbytes
+      while self.idle_bytes > self.max_bytes:
+        old_key, buffers = next(iter(self.idle.items()))
+        self.idle_bytes -= buffers.pop(0).nbytes
+        if len(buffers) == 0:
+          del self.idle[old_key]
+        self.evictions += 1
+
+  #Lends an array for the duration of a with-block
+  @contextlib.contextmanager
+  def get_array(self, type, length, align=32, value=None):
+    buffer = self.acquire(type, length, align, value)
+    try:
+      yield buffer
+    finally:
+      self.release(buffer)
+
+  #Lends several arrays for the duration of a with-block
+  @contextlib.contextmanager
+  def get_arrays(self, num, type, length, align=32, value=None):
+    buffers = [self.acquire(type, length, align, value) for i in range(num)]
+    try:
+      yield buffers
+    finally:
+      for buffer in buffers:
+        self.release(buffer)
+
+  #Drops all idle arrays
+  def clear(self):
+    with self.lock:
+      self.idle.clear()
+      self.idle_bytes = 0
+
+  #Returns usage counters
+  def get_stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'idle_bytes': self.idle_bytes}
+
+#Future for a call started with a generated <name>_submit function
+class KernelFuture(concurrent.futures.Future):
+  def __init__(self, handle):
+    concurrent.futures.Future.__init__(self)
+    self.handle = handle
+    handle.add_done_callback(self.on_done)
+
+  #Stops scheduling new chunks of the call
+  def cancel(self):
+    return self.handle.cancel() and concurrent.futures.Future.cancel(self)
+
+  #Called on a native thread once the call finishes
+  def on_done(self, handle):
+    #A finished call can no longer be cancelled, so this doesn't race with cancel()
+    if self.cancelled():
+      return
+    try:
+      result = handle.result()
+    except Exception as e:
+      self.set_exception(e)
+    else:
+      self.set_result(result)
+
+#Starts a kernel without blocking and returns a concurrent.futures.Future
+def submit(func, *args, **kwargs):
+  return KernelFuture(func(*args, **kwargs))
+
+#Awaitable kernel call; cancelling the awaiting task cancels the call
+async def run_async(func, *args, **kwargs):
+  return await asyncio.wrap_future(submit(func, *args, **kwargs))
+
+#Returns the non-blocking entry point of a kernel (or the argument, if it already is one)
+def get_submit(kernel):
+  if kernel.__name__.endswith('_submit'):
+    return kernel
+  module = sys.modules[kernel.__module__]
+  return getattr(module, kernel.__name__ + '_submit')
+
+#Runs a kernel over a stream of input chunks, yielding the result for every chunk_size elements
+#  Each chunk is a buffer (or a tuple of buffers, one per streamed input) of any length. The
+#  streamed inputs follow args in the kernel call, and outputs that aren't passed are allocated
+#  by the binding. Up to buffers - 1 chunks run on native threads while the next one is filled.
+def stream(kernel, chunks, args=(), kwargs={}, chunk_size=65536, buffers=3):
+  if buffers < 2:
+    raise Exception('At least two buffers are needed')
+  submit = get_submit(kernel)
+  #Aligned input buffers: (raw bytes, typed views), reused once their chunk is done
+  idle = []
+  pending = collections.deque()
+  current = None
+  formats = None
+  filled = 0
+  #Starts the kernel on the current buffers
+  def start(length):
+    views = [typed[:length] for typed in current[1]]
+    pending.append((submit(*args, *views, **kwargs), current))
+  #Waits for the oldest chunk and recycles its buffers
+  def finish():
+    handle, used = pending.popleft()
+    result = handle.result()
+    idle.append(used)
+    return result
+  try:
+    for chunk in chunks:
+      parts = [memoryview(part) for part in (chunk if isinstance(chunk, (tuple, list)) else (chunk,))]
+      if formats is None:
+        formats = [(part.format, part.itemsize) for part in parts]
+      if [(part.format, part.itemsize) for part in parts] != formats:
+        raise Exception('Chunks must have the same number and types of inputs')
+      parts = [part.cast('B') for part in parts]
+      if len(set(len(part) for part in parts)) != 1:
+        raise Exception('Input chunks must have the same length')
+      offset = 0
+      while offset < len(parts[0]):
+        if current is None:
+          if len(idle) > 0:
+            current = idle.pop()
+          else:
+            raw = [Allocator.allocate(chunk_size * size) for (format, size) in formats]
+            current = (raw, [view.cast(format) for (view, (format, size)) in zip(raw, formats)])
+        #Copy as much as fits in the current buffers
+        count = min(chunk_size * formats[0][1] - filled, len(parts[0]) - offset)
+        for (buffer, part) in zip(current[0], parts):
+          Allocator.copy(buffer[filled:filled + count], part[offset:offset + count])
+        filled += count
+        offset += count
+        if filled == chunk_size * formats[0][1]:
+          start(chunk_size)
+          current = None
+          filled = 0
+          if len(pending) >= buffers - 1:
+            yield finish()
+    #Partial last chunk
+    if filled > 0:
+      start(filled // formats[0][1])
+      current = None
+    while len(pending) > 0:
+      yield finish()
+  finally:
+    #The stream was abandoned: stop the remaining chunks
+    for (handle, used) in pending:
+      handle.cancel()
+
+#Runs a kernel over raw binary files, one window of the memory mappings at a time
+#  Inputs are mapped read-only and outputs read-write (created or resized to match the inputs),
+#  so the kernel reads straight from the page cache. Returns the number of elements processed.
+def map_files(kernel, inputs, outputs, uniforms={}, type='f', window=1 << 24):
+  Allocator.check_type(type)
+  size = Allocator.sizes[type]
+  if len(inputs) == 0:
+    raise Exception('At least one input file is needed')
+  #Window offsets must be page-aligned (which also satisfies the SIMD alignment checks)
+  if window <= 0 or (window * size) % mmap.PAGESIZE != 0:
+    raise Exception('Window must be a positive multiple of %d elements'%(mmap.PAGESIZE // size))
+  with contextlib.ExitStack() as stack:
+    maps = {}
+    length = None
+    for (name, path) in inputs.items():
+      file = stack.enter_context(open(path, 'rb'))
+      num_bytes = os.fstat(file.fileno()).st_size
+      if length is None:
+        length = num_bytes
+      if num_bytes != length or num_bytes % size != 0:
+        raise Exception('Input file sizes don\'t match (%s)'%(name))
+      if num_bytes == 0:
+        raise Exception('Input file is empty (%s)'%(name))
+      maps[name] = stack.enter_context(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+    for (name, path) in outputs.items():
+      file = stack.enter_context(open(path, 'a+b'))
+      file.truncate(length)
+      maps[name] = stack.enter_context(mmap.mmap(file.fileno(), length, access=mmap.ACCESS_WRITE))
+    for mapping in maps.values():
+      mapping.madvise(mmap.MADV_SEQUENTIAL)
+    #Run the kernel on each window
+    for offset in range(0, length, window * size):
+      end = min(offset + window * size, length)
+      with contextlib.ExitStack() as views:
+        args = dict(uniforms)
+        for (name, mapping) in maps.items():
+          view = views.enter_context(memoryview(mapping))
+          args[name] = views.enter_context(view[offset:end].cast(type))
+        kernel(**args)
+    for name in outputs:
+      maps[name].flush()
+  return length // size
+
+#Runs a DAG of compiled kernels tile by tile, so intermediate arrays stay in cache
+#  Stages are added in order; string arguments name arrays (passed to run) or temporaries
+#  (declared with temp), and anything else is passed through. A stage depends on every earlier
+#  stage that writes an array it uses or uses an array it writes (a stage writes every array
+#  it uses unless add is given writes). Each worker thread takes one tile through the levels of the
+#  DAG; the stages of a level (independent branches) run concurrently and are joined before the
+#  next level starts, while different tiles run on different workers.
+class Pipeline:
+  #Kernels run tiles smaller than their parallel threshold (Options.parallel_threshold,
+  #16384 by default) on the calling thread
+  max_tile = 16384
+
+  def __init__(self, threads=None, tile=None):
+    self.threads = threads if threads is not None else (os.cpu_count() or 1)
+    self.tile = tile
+    #(kernel, args, kwargs) in order of addition
+    self.stages = []
+    #Names of the arrays each stage writes
+    self.writes = []
+    #Element types of temporaries, by name
+    self.temps = {}
+
+  #Declares a tile-sized temporary array, private to each worker thread
+  def temp(self, name, type='f'):
+    Allocator.check_type(type)
+    self.temps[name] = type
+
+  #Appends a stage
+  #  writes names the arrays the kernel writes (its outputs), so that stages which only read the
+  #  same arrays can run concurrently; by default a stage is assumed to write every array it uses.
+  def add(self, kernel, *args, writes=None, **kwargs):
+    stage = (kernel, args, kwargs)
+    names = Pipeline.get_names(stage)
+    writes = names if writes is None else set([writes] if isinstance(writes, str) else writes)
+    if not writes <= names:
+      raise Exception('Stage writes arrays it doesn\'t use (%s)'%(', '.join(sorted(writes - names))))
+    self.stages.append(stage)
+    self.writes.append(writes)
+
+  #Returns the array names used by a stage
+  def get_names(stage):
+    (kernel, args, kwargs) = stage
+    return set(arg for arg in list(args) + list(kwargs.values()) if isinstance(arg, str))
+
+  #Returns the stages grouped into levels; stages within a level don't depend on each other
+  def get_levels(self):
+    levels = []
+    depths = []
+    for (i, stage) in enumerate(self.stages):
+      names = Pipeline.get_names(stage)
+      depth = 0
+      for j in range(i):
+        if (names & self.writes[j]) or (self.writes[i] & Pipeline.get_names(self.stages[j])):
+          depth = max(depth, depths[j] + 1)
+      depths.append(depth)
+      if depth == len(levels):
+        levels.append([])
+      levels[depth].append(i)
+    return levels
+
+  #Returns the number of elements per tile (sized so a tile of every array fits in L2)
+  def get_tile(self, itemsizes):
+    if self.tile is not None:
+      return self.tile
+    try:
+      cache = os.sysconf('SC_LEVEL2_CACHE_SIZE')
+    except (ValueError, OSError, AttributeError):
+      cache = 0
+    if cache <= 0:
+      cache = 1 << 20
+    tile = min(cache // max(sum(itemsizes), 1), Pipeline.max_tile - 1) // 64 * 64
+    return max(64, tile)
+
+  #Runs every stage over arrays of N elements
+  def run(self, **arrays):
+    views = {name: memoryview(array) for (name, array) in arrays.items()}
+    used = set()
+    for stage in self.stages:
+      used |= Pipeline.get_names(stage)
+    for name in used:
+      if name not in views and name not in self.temps:
+        raise Exception('Missing array (%s)'%(name))
+    lengths = set(len(views[name]) for name in used if name in views)
+    if len(lengths) != 1:
+      raise Exception('Arrays must have the same, nonzero number of elements')
+    N = lengths.pop()
+    tile = self.get_tile([views[name].itemsize for name in used if name in views] + [Allocator.sizes[self.temps[name]] for name in used if name in self.temps])
+    levels = self.get_levels()
+    tiles = iter(range(0, N, tile))
+    lock = threading.Lock()
+    threads = min(self.threads, (N + tile - 1) // tile)
+    #Runs the other stages of a level while the worker runs the first one
+    width = max(len(level) for level in levels)
+    branches = concurrent.futures.ThreadPoolExecutor(max_workers=threads * (width - 1)) if width > 1 else None
+    #Takes tiles through all levels until none are left
+    def work():
+      temps = {name: Allocator.get_array(type, tile) for (name, type) in self.temps.items() if name in used}
+      while True:
+        with lock:
+          start = next(tiles, None)
+        if start is None:
+          return
+        end = min(start + tile, N)
+        slices = {name: view[start:end] for (name, view) in views.items()}
+        slices.update((name, temp[:end - start]) for (name, temp) in temps.items())
+        get = lambda arg: slices[arg] if isinstance(arg, str) else arg
+        def run_stage(i):
+          (kernel, args, kwargs) = self.stages[i]
+          kernel(*[get(arg) for arg in args], **{key: get(arg) for (key, arg) in kwargs.items()})
+        for level in levels:
+          futures = [branches.submit(run_stage, i) for i in level[1:]]
+          try:
+            run_stage(level[0])
+          finally:
+            concurrent.futures.wait(futures)
+          for future in futures:
+            future.result()
+    try:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for future in [pool.submit(work) for i in range(threads)]:
+          future.result()
+    finally:
+      if branches is not None:
+        branches.shutdown()
+    return True
+
+#Runs kernels on a vecpy server (python -m vecpy serve) instead of in this process
+#  Arrays from get_array live in shared memory and are passed without copying (give them
+#  back with release to reuse the space); other buffers are staged through a second segment
+#  (and copied back if writable).
+class Client:
+  def __init__(self, path=default_path, size=64 << 20, align=32):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.connect(path)
+    self.align = align
+    #Arrays handed out by get_array
+    self.arena = shared_memory.SharedMemory(create=True, size=size)
+    self.base = Allocator.get_address(self.arena.buf)
+    #Free (offset, size) blocks of the segment, by offset
+    self.free = [(0, size // align * align)]
+    #Blocks of arrays handed out by get_array, by array identity
+    self.active = {}
+    #Staging area for other buffers, grown as needed
+    self.staging = None
+    self.lock = threading.Lock()
+
+  #Returns an aligned array in shared memory (first fit from the free blocks)
+  #  Every element is set to value; with value=None the contents are uninitialized.
+  def get_array(self, type, length, value=0):
+    Allocator.check_type(type)
+    num_bytes = Allocator.round_up(length * Allocator.sizes[type], self.align)
+    with self.lock:
+      index = next((i for (i, (offset, size)) in enumerate(self.free) if size >= num_bytes), None)
+      if length <= 0 or index is None:
+        raise MemoryError('Shared memory exhausted')
+      (offset, size) = self.free[index]
+      if size == num_bytes:
+        del self.free[index]
+      else:
+        self.free[index] = (offset + num_bytes, size - num_bytes)
+      view = self.arena.buf[offset:offset + length * Allocator.sizes[type]]
+      array = view.cast(type)
+      view.release()
+      self.active[id(array)] = (offset, num_bytes)
+    if value is not None:
+      Allocator.fill(array.cast('B'), type, value)
+    return array
+
+  #Returns an array from get_array to the free blocks (the array is released)
+  def release(self, array):
+    with self.lock:
+      block = self.active.pop(id(array), None)
+      if block is None:
+        raise Exception('Array not allocated by this client')
+      array.release()
+      #Insert by offset, merging with adjacent free blocks
+      (offset, size) = block
+      index = bisect.bisect(self.free, block)
+      if index < len(self.free) and self.free[index][0] == offset + size:
+        size += self.free.pop(index)[1]
+      if index > 0 and self.free[index - 1][0] + self.free[index - 1][1] == offset:
+        index -= 1
+        offset = self.free[index][0]
+        size += self.free.pop(index)[1]
+      self.free.insert(index, (offset, size))
+
+  #Returns the kernel as a function with the normal call signature
+  def get_kernel(self, name):
+    def call(*args, **kwargs):
+      return self.call(name, args, kwargs)
+    call.__name__ = name
+    return call
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return self.get_kernel(name)
+
+  #Describes an argument, staging buffers outside of the arena
+  def get_spec(self, arg, staged):
+    if arg is None or isinstance(arg, (int, float)):
+      return {'value': arg}
+    view = memoryview(arg)
+    if not view.c_contiguous:
+      raise Exception('Arrays must be contiguous')
+    try:
+      address = Allocator.get_address(view.cast('B'))
+    except TypeError:
+      address = None
+    length = view.nbytes
+    if address is not None and self.base <= address and address + length <= self.base + self.arena.size:
+      return {'shm': self.arena.name, 'offset': address - self.base, 'length': length, 'format': view.format}
+    staged.append(view)
+    return {'staged': len(staged) - 1, 'length': length, 'format': view.format}
+
+  #Copies staged buffers into the staging segment and fills in their offsets
+  def stage(self, specs, staged):
+    offsets = []
+    size = 0
+    for view in staged:
+      offsets.append(size)
+      size += Allocator.round_up(max(view.nbytes, 1), self.align)
+    if self.staging is None or self.staging.size < size:
+      self.close_staging()
+      self.staging = shared_memory.SharedMemory(create=True, size=max(size, self.align))
+    for spec in specs:
+      if 'staged' in spec:
+        offset = offsets[spec.pop('staged')]
+        spec.update(shm=self.staging.name, offset=offset)
+    for (view, offset) in zip(staged, offsets):
+      Allocator.copy(self.staging.buf[offset:offset + view.nbytes], view.cast('B'))
+    return offsets
+
+  #Runs a kernel on the server
+  def call(self, name, args, kwargs):
+    with self.lock:
+      staged = []
+      specs = [self.get_spec(arg, staged) for arg in args]
+      named = {key: self.get_spec(arg, staged) for (key, arg) in kwargs.items()}
+      offsets = self.stage(specs + list(named.values()), staged)
+      send_message(self.sock, {'op': 'run', 'kernel': name, 'args': specs, 'kwargs': named})
+      (header, payloads) = recv_message(self.sock)
+      if not header['ok']:
+        raise Exception(header['error'])
+      #Copy back staged buffers that the kernel may have written
+      for (view, offset) in zip(staged, offsets):
+        if not view.readonly:
+          Allocator.copy(view.cast('B'), self.staging.buf[offset:offset + view.nbytes])
+    if len(payloads) == 0:
+      return True
+    return tuple(memoryview(payload).cast(format) for (payload, format) in zip(payloads, header['formats']))
+
+  def close_staging(self):
+    if self.staging is not None:
+      self.staging.close()
+      self.staging.unlink()
+      self.staging = None
+
+  #Disconnects and frees the shared memory (arrays from get_array must be released first)
+  def close(self):
+    self.sock.close()
+    self.close_staging()
+    self.arena.close()
+    self.arena.unlink()
 
 #Calculates kernel runtime and speedup
 def get_speedup(kernel1, kernel2):
@@ -45,3 +698,15 @@ def get_speedup(kernel1, kernel2):
   delta1 = time2 - time1
   delta2 = time3 - time2
   return (delta1, delta2, delta1 / delta2)
+
+#Measures the average time per call (e.g. binding overhead for tiny inputs)
+def get_call_time(func, args=(), kwargs={}, calls=100000):
+  #Warm up
+  for i in range(min(calls, 100)):
+    func(*args, **kwargs)
+  #Time repeated calls
+  time1 = time.perf_counter()
+  for i in range(calls):
+    func(*args, **kwargs)
+  time2 = time.perf_counter()
+  return (time2 - time1) / calls
@@ -0,0 +1,164 @@
+"""
+A long-lived server that loads compiled kernels once and runs the calls of
+many client processes on a single thread pool. Clients connect over a Unix
+socket and pass arrays in shared memory segments that they own (see
+runtime.Client). Only the server's owner can stop it (python -m vecpy stop).
+"""
+
+
+import concurrent.futures
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+from vecpy.distributed import attach, recv_message, send_message
+from vecpy.loader import load
+
+#Default client socket, in a directory only this user can access
+default_path = os.path.join(tempfile.gettempdir(), 'vecpy-%d'%(os.getuid()), 'vecpy.sock')
+
+#Returns the control socket of the server listening on path
+def get_control_path(path):
+  return path + '.ctl'
+
+#Returns a listening Unix socket at path that only this user can connect to
+def listen(path):
+  directory = os.path.dirname(os.path.abspath(path))
+  if not os.path.isdir(directory):
+    os.makedirs(directory, mode=0o700)
+  #Others must not be able to replace the socket (sticky directories like /tmp are fine)
+  info = os.stat(directory)
+  if info.st_uid != os.getuid() and (info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)) and not (info.st_mode & stat.S_ISVTX):
+    raise Exception('Socket directory is writable by other users (%s)'%(directory))
+  if os.path.exists(path):
+    os.unlink(path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(path)
+  #Connections are refused until listen, so nobody else can connect in between
+  os.chmod(path, 0o600)
+  server.listen()
+  return server
+
+#Returns the user ID of the process on the other end of a Unix socket (None if unknown)
+def get_peer_uid(sock):
+  if not hasattr(socket, 'SO_PEERCRED'):
+    return None
+  (pid, uid, gid) = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+  return uid
+
+#Stops the server listening on path (through its control socket)
+def stop(path):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with sock:
+    sock.connect(get_control_path(path))
+    send_message(sock, {'op': 'stop'})
+    (header, payloads) = recv_message(sock)
+  if not header['ok']:
+    raise Exception(header['error'])
+
+#Serves compiled kernels to local clients
+class Server:
+  def __init__(self, names, path=default_path, jobs=1):
+    #Kernels are loaded once, from their compiled modules (see loader.load)
+    self.kernels = {}
+    for name in names:
+      self.kernels[name] = load(name)
+    self.path = path
+    #Each kernel call already runs on its native threads, so few calls should run at once
+    self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+  #Accepts clients until stopped
+  #  Clients can only run kernels; stopping the server goes through a separate control socket
+  #  (see stop), so one client can't take the server down for the others.
+  def serve(self):
+    self.running = True
+    control = listen(get_control_path(self.path))
+    server = listen(self.path)
+    threading.Thread(target=self.control, args=(control,), daemon=True).start()
+    while self.running:
+      (sock, peer) = server.accept()
+      threading.Thread(target=self.handle, args=(sock,), daemon=True).start()
+    server.close()
+    self.pool.shutdown()
+    os.unlink(self.path)
+    os.unlink(get_control_path(self.path))
+
+  #Accepts control requests until stopped
+  def control(self, control):
+    with control:
+      while True:
+        (sock, peer) = control.accept()
+        with sock:
+          try:
+            (header, payloads) = recv_message(sock)
+          except ConnectionError:
+            continue
+          #The socket is private already, but don't take the owner's word for it
+          if get_peer_uid(sock) not in (None, 0, os.getuid()):
+            send_message(sock, {'ok': False, 'error': 'Permission denied'})
+          elif header['op'] != 'stop':
+            send_message(sock, {'ok': False, 'error': 'Unsupported operation (%s)'%(header['op'])})
+          else:
+            self.running = False
+            send_message(sock, {'ok': True})
+            #Wake up the accept loop
+            wake = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            with wake:
+              wake.connect(self.path)
+            return
+
+  #Runs the calls of one client
+  def handle(self, sock):
+    #Segments of this client, attached on first use
+    blocks = {}
+    try:
+      while True:
+        try:
+          (header, payloads) = recv_message(sock)
+        except ConnectionError:
+          return
+        try:
+          self.run(sock, header, blocks)
+        except (ConnectionError, BrokenPipeError):
+          return
+        except Exception as e:
+          send_message(sock, {'ok': False, 'error': str(e)})
+    finally:
+      sock.close()
+      for block in blocks.values():
+        block.close()
+
+  #Returns the argument described by spec
+  def get_arg(self, spec, blocks, views):
+    if 'value' in spec:
+      return spec['value']
+    if spec['shm'] not in blocks:
+      blocks[spec['shm']] = attach(spec['shm'])
+    offset = spec['offset']
+    view = blocks[spec['shm']].buf[offset:offset + spec['length']].cast(spec['format'])
+    views.append(view)
+    return view
+
+  #Runs one call on the pool and replies with its result
+  def run(self, sock, header, blocks):
+    if header['op'] != 'run':
+      raise Exception('Unsupported operation (%s)'%(header['op']))
+    if header['kernel'] not in self.kernels:
+      raise Exception('Unknown kernel (%s)'%(header['kernel']))
+    kernel = self.kernels[header['kernel']]
+    views = []
+    try:
+      args = [self.get_arg(spec, blocks, views) for spec in header['args']]
+      kwargs = {name: self.get_arg(spec, blocks, views) for (name, spec) in header['kwargs'].items()}
+      result = self.pool.submit(kernel, *args, **kwargs).result()
+      #Outputs allocated by the binding are sent back over the socket
+      if result is True:
+        send_message(sock, {'ok': True})
+      else:
+        outputs = [memoryview(output) for output in result]
+        send_message(sock, {'ok': True, 'formats': [output.format for output in outputs]}, outputs)
+    finally:
+      for view in views:
+        view.release()
@@ -0,0 +1,24 @@
+import importlib.util
+import os
+import sys
+import pytest
+
+#The repository is the vecpy package itself; import it under that name when it isn't installed
+try:
+  import vecpy
+except ImportError:
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  spec = importlib.util.spec_from_file_location('vecpy', os.path.join(root, '__init__.py'), submodule_search_locations=[root])
+  module = importlib.util.module_from_spec(spec)
+  sys.modules['vecpy'] = module
+  spec.loader.exec_module(module)
+
+#PYTHONPATH entry that makes the package importable as vecpy in subprocesses
+@pytest.fixture(scope='session')
+def vecpy_path(tmp_path_factory):
+  root = os.path.dirname(os.path.abspath(sys.modules['vecpy'].__file__))
+  if os.path.basename(root) == 'vecpy':
+    return os.path.dirname(root)
+  path = tmp_path_factory.mktemp('site')
+  os.symlink(root, str(path / 'vecpy'))
+  return str(path)
@@ -0,0 +1,85 @@
+import pytest
+from vecpy.allocator import Allocator, Arena
+
+@pytest.mark.parametrize('method', [Allocator.malloc, Allocator.mmap])
+@pytest.mark.parametrize('align', [16, 32, 64, 4096])
+def test_alignment(method, align):
+  array = Allocator.get_array('f', 1000, align, method=method)
+  assert Allocator.get_address(array.cast('B')) % align == 0
+  assert len(array) == 1000 and array.format == 'f' and array.nbytes == 4000
+
+@pytest.mark.parametrize('method', [Allocator.malloc, Allocator.mmap])
+def test_zero_filled(method):
+  assert list(Allocator.get_array('I', 100, method=method)) == [0] * 100
+
+@pytest.mark.parametrize('type, value', [('f', 1.5), ('I', 7), ('f', 0)])
+def test_fill(type, value):
+  #Odd lengths exercise the last partial memcpy of the doubling fill
+  assert list(Allocator.get_array(type, 37, value=value)) == [value] * 37
+
+def test_uninitialized():
+  array = Allocator.get_array('f', 64, value=None)
+  assert len(array) == 64
+  array[63] = 2.0
+  assert array[63] == 2.0
+
+def test_arena_uninitialized():
+  from vecpy.runtime import get_arrays
+  arrays = get_arrays(3, 'f', 16, value=None)
+  assert len(arrays) == 3 and all(len(array) == 16 for array in arrays)
+  arrays[2][15] = 2.0
+  assert arrays[2][15] == 2.0
+
+def test_writable():
+  array = Allocator.get_array('I', 8)
+  array[3] = 42
+  assert list(array) == [0, 0, 0, 42, 0, 0, 0, 0]
+
+@pytest.mark.parametrize('align', [0, 8, 48])
+def test_invalid_alignment(align):
+  with pytest.raises(Exception, match='Alignment'):
+    Allocator.get_array('f', 4, align)
+
+def test_invalid_arguments():
+  with pytest.raises(Exception, match='Invalid type'):
+    Allocator.get_array('d', 4)
+  with pytest.raises(Exception, match='Length'):
+    Allocator.get_array('f', 0)
+  with pytest.raises(Exception, match='Invalid allocation method'):
+    Allocator.get_array('f', 4, method='sbrk')
+
+def test_copy():
+  src = Allocator.get_array('f', 10, value=3.0)
+  dst = Allocator.get_array('f', 10)
+  Allocator.copy(dst.cast('B'), src.cast('B'))
+  assert list(dst) == [3.0] * 10
+  #Read-only sources go through the buffer protocol
+  Allocator.copy(dst.cast('B'), bytes(40))
+  assert list(dst) == [0.0] * 10
+  with pytest.raises(Exception, match='Size mismatch'):
+    Allocator.copy(dst.cast('B'), bytes(4))
+
+def test_arena_layout():
+  size = Arena.get_size(3, 'f', 10, 64)
+  assert size == 3 * 64
+  arena = Arena(size, 64)
+  arrays = arena.get_arrays(3, 'f', 10, value=1.0)
+  addresses = [Allocator.get_address(array.cast('B')) for array in arrays]
+  assert all(address % 64 == 0 for address in addresses)
+  assert [b - a for (a, b) in zip(addresses, addresses[1:])] == [64, 64]
+  #Arrays don't overlap
+  arrays[0][9] = 5.0
+  assert arrays[1][0] == 1.0 and list(arrays[2]) == [1.0] * 10
+
+def test_arena_exhausted():
+  arena = Arena(Arena.get_size(2, 'I', 16), 32)
+  arena.get_arrays(2, 'I', 16)
+  with pytest.raises(MemoryError):
+    arena.get_array('I', 1)
+
+def test_runtime_helpers():
+  from vecpy.runtime import get_array, get_arrays
+  assert list(get_array('f', 5, value=2.0)) == [2.0] * 5
+  arrays = get_arrays(4, 'I', 9, align=64, value=3)
+  assert len(arrays) == 4 and all(list(array) == [3] * 9 for array in arrays)
+  assert all(Allocator.get_address(array.cast('B')) % 64 == 0 for array in arrays)
@@ -0,0 +1,102 @@
+import threading
+import pytest
+from vecpy.allocator import Allocator
+from vecpy.runtime import BufferPool
+
+def test_reuse():
+  pool = BufferPool()
+  a = pool.acquire('f', 100)
+  address = Allocator.get_address(a.cast('B'))
+  pool.release(a)
+  b = pool.acquire('f', 100)
+  assert Allocator.get_address(b.cast('B')) == address
+  assert pool.get_stats() == {'hits': 1, 'misses': 1, 'evictions': 0, 'idle_bytes': 0}
+
+def test_keys():
+  pool = BufferPool()
+  pool.release(pool.acquire('f', 100))
+  #A different type, length or alignment is a miss
+  for (type, length, align) in (('I', 100, 32), ('f', 101, 32), ('f', 100, 64)):
+    pool.acquire(type, length, align)
+  assert pool.get_stats()['misses'] == 4 and pool.get_stats()['hits'] == 0
+
+def test_value():
+  pool = BufferPool()
+  a = pool.acquire('f', 10, value=2.5)
+  assert list(a) == [2.5] * 10
+  a[0] = 9.0
+  pool.release(a)
+  #A value fills reused buffers too
+  assert list(pool.acquire('f', 10, value=0)) == [0.0] * 10
+
+def test_uninitialized():
+  pool = BufferPool()
+  a = pool.acquire('I', 10)
+  a[0] = 123
+  pool.release(a)
+  #Without a value, a reused buffer keeps its contents
+  assert pool.acquire('I', 10)[0] == 123
+
+def test_lru_eviction():
+  pool = BufferPool(max_bytes=2 * 400)
+  buffers = [pool.acquire('f', 100) for i in range(3)]
+  first = Allocator.get_address(buffers[0].cast('B'))
+  for buffer in buffers:
+    pool.release(buffer)
+  #The first buffer released is evicted
+  stats = pool.get_stats()
+  assert stats['evictions'] == 1 and stats['idle_bytes'] == 800
+  reused = [Allocator.get_address(pool.acquire('f', 100).cast('B')) for i in range(2)]
+  assert first not in reused
+  assert pool.get_stats()['hits'] == 2
+
+def test_lru_order():
+  pool = BufferPool(max_bytes=800)
+  (a, b) = (pool.acquire('f', 100), pool.acquire('I', 100))
+  pool.release(a)
+  pool.release(b)
+  #Reusing 'f' makes 'I' the least recently used key
+  pool.release(pool.acquire('f', 100))
+  pool.release(pool.acquire('f', 50, value=0))
+  assert pool.get_stats()['evictions'] == 1
+  pool.acquire('f', 100)
+  pool.acquire('I', 100)
+  assert pool.get_stats()['hits'] == 2
+
+def test_oversized():
+  pool = BufferPool(max_bytes=100)
+  pool.release(pool.acquire('f', 100))
+  assert pool.get_stats()['evictions'] == 1 and pool.get_stats()['idle_bytes'] == 0
+
+def test_foreign_buffer():
+  pool = BufferPool()
+  with pytest.raises(Exception, match='not acquired'):
+    pool.release(Allocator.get_array('f', 10))
+  a = pool.acquire('f', 10)
+  pool.release(a)
+  with pytest.raises(Exception, match='not acquired'):
+    pool.release(a)
+
+def test_context_managers():
+  pool = BufferPool()
+  with pool.get_array('f', 8, value=1.0) as a:
+    assert list(a) == [1.0] * 8
+  with pool.get_arrays(3, 'f', 8) as arrays:
+    assert len(arrays) == 3
+  assert pool.get_stats()['hits'] == 1 and pool.get_stats()['idle_bytes'] == 3 * 32
+  pool.clear()
+  assert pool.get_stats()['idle_bytes'] == 0
+
+def test_threads():
+  pool = BufferPool()
+  def work():
+    for i in range(200):
+      with pool.get_array('f', 64, value=i) as a:
+        assert a[0] == i and a[63] == i
+  threads = [threading.Thread(target=work) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  stats = pool.get_stats()
+  assert stats['hits'] + stats['misses'] == 800 and stats['misses'] <= 4
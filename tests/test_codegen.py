@@ -0,0 +1,221 @@
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+from vecpy.compiler_constants import Architecture, Binding, DataType, Options
+from vecpy.loader import get_cpu_flags
+from vecpy.runtime import get_array, vectorize
+
+#These tests build and run real modules
+pytestmark = pytest.mark.skipif(shutil.which('g++') is None, reason='needs g++')
+np = pytest.importorskip('numpy')
+
+#The same kernel under one name per build (a module can only be imported once)
+def axpy_tiled(a:'uniform', x, z, y):
+  y = a * x + z
+def axpy_plain(a:'uniform', x, z, y):
+  y = a * x + z
+def axpy_cpp(a:'uniform', x, z, y):
+  y = a * x + z
+#Kernels of a library module, with different data types
+def lib_blend(t:'uniform', x, z, y):
+  y = x + t * (z - x)
+def lib_mask(x, m:'uniform', y):
+  y = x & m
+
+#The fastest architecture this CPU supports
+def get_arch():
+  for (flag, arch) in (('avx2', Architecture.avx2), ('sse4_2', Architecture.sse4_2)):
+    if flag in get_cpu_flags():
+      return arch
+  return Architecture.generic
+
+#Builds a module and imports it (C++-only modules can't be imported)
+def build(tmp_path_factory, func, bindings, name=None, **options):
+  path = str(tmp_path_factory.mktemp(name or func.__name__))
+  #Few threads and a low threshold, so that modest inputs run on several threads
+  options = Options(get_arch(), DataType.float, bindings=bindings, threads=3, parallel_threshold=1000, build_dir=path, module_dir=path, **options)
+  vectorize(func, options, name)
+  if bindings == (Binding.cpp,):
+    return (None, path)
+  sys.path.insert(0, path)
+  try:
+    module = importlib.import_module('vecpy_' + (name or func.__name__))
+  finally:
+    sys.path.remove(path)
+  return (module, path)
+
+#Kernels built with and without tiling
+@pytest.fixture(scope='module', params=[(axpy_tiled, True), (axpy_plain, False)], ids=['tiled', 'plain'])
+def kernel(request, tmp_path_factory):
+  (func, tiling) = request.param
+  (module, path) = build(tmp_path_factory, func, (Binding.python, Binding.numpy, Binding.cpp), tiling=tiling)
+  return (module, func.__name__)
+
+def get_inputs(N, seed=0):
+  rng = np.random.default_rng(seed)
+  return (rng.standard_normal(N).astype(np.float32), rng.standard_normal(N).astype(np.float32))
+
+@pytest.mark.parametrize('N', [1, 7, 64, 1003, 100000])
+def test_contiguous(kernel, N):
+  (module, name) = kernel
+  (x, z) = get_inputs(N)
+  y = np.zeros(N, dtype=np.float32)
+  assert getattr(module, name)(1.5, x, z, y) is True
+  assert np.allclose(y, 1.5 * x + z)
+
+def test_aligned_arrays(kernel):
+  (module, name) = kernel
+  (x, z, y) = (get_array('f', 5000, value=2.0), get_array('f', 5000, value=1.0), get_array('f', 5000))
+  getattr(module, name)(3.0, x, z, y)
+  assert list(y) == [7.0] * 5000
+
+@pytest.mark.parametrize('N', [5, 2000])
+def test_strided(kernel, N):
+  (module, name) = kernel
+  (x, z) = get_inputs(3 * N)
+  y = np.zeros(2 * N, dtype=np.float32)
+  #Every third element, a reversed array, and every other element of the output
+  getattr(module, name)(-2.0, x[::3], z[::-1][:N], y[::2])
+  assert np.allclose(y[::2], -2.0 * x[::3] + z[::-1][:N])
+  assert not y[1::2].any()
+  #Unaligned but contiguous
+  y = np.zeros(N + 1, dtype=np.float32)
+  getattr(module, name)(1.0, x[1:N + 1], z[1:N + 1], y[1:])
+  assert np.allclose(y[1:], x[1:N + 1] + z[1:N + 1])
+
+#Exposes an array only through DLPack or __array_interface__
+class DLPackOnly:
+  def __init__(self, array):
+    self.array = array
+  def __dlpack__(self, stream=None, **kwargs):
+    return self.array.__dlpack__()
+  def __dlpack_device__(self):
+    return self.array.__dlpack_device__()
+
+class InterfaceOnly:
+  def __init__(self, array):
+    self.array = array
+    self.__array_interface__ = array.__array_interface__
+
+def test_other_protocols(kernel):
+  (module, name) = kernel
+  (x, z) = get_inputs(3000)
+  y = np.zeros(3000, dtype=np.float32)
+  getattr(module, name)(2.0, DLPackOnly(x), InterfaceOnly(z), InterfaceOnly(y))
+  assert np.allclose(y, 2.0 * x + z)
+  #Arrays of another type are rejected
+  with pytest.raises(Exception):
+    getattr(module, name)(2.0, x.astype(np.float64), z, y)
+
+def test_omitted_outputs(kernel):
+  (module, name) = kernel
+  (x, z) = get_inputs(2500)
+  (y,) = getattr(module, name)(0.5, x, z)
+  assert np.allclose(np.asarray(y), 0.5 * x + z)
+  #Omitted outputs can be named too
+  (y,) = getattr(module, name)(a=0.5, x=x, z=z)
+  assert np.allclose(np.asarray(y), 0.5 * x + z)
+
+def test_batch(kernel):
+  (module, name) = kernel
+  jobs = []
+  for (i, N) in enumerate([10, 4000, 1, 777]):
+    (x, z) = get_inputs(N, i)
+    jobs.append((float(i), x, z, np.zeros(N, dtype=np.float32)))
+  #One result per job
+  assert getattr(module, name + '_batch')(jobs) == [True] * 4
+  for (a, x, z, y) in jobs:
+    assert np.allclose(y, a * x + z)
+  assert getattr(module, name + '_batch')([]) == []
+
+def test_submit(kernel):
+  (module, name) = kernel
+  (x, z) = get_inputs(50000)
+  y = np.zeros(50000, dtype=np.float32)
+  handle = getattr(module, name + '_submit')(2.0, x, z, y)
+  assert handle.result() is True
+  assert handle.done() and not handle.cancelled()
+  assert np.allclose(y, 2.0 * x + z)
+  #Outputs allocated for the call are returned by result
+  (y,) = getattr(module, name + '_submit')(3.0, x, z).result()
+  assert np.allclose(np.asarray(y), 3.0 * x + z)
+
+def test_cancel(kernel):
+  (module, name) = kernel
+  (x, z) = get_inputs(1 << 22)
+  y = np.zeros(1 << 22, dtype=np.float32)
+  handle = getattr(module, name + '_submit')(2.0, x, z, y)
+  if handle.cancel():
+    assert handle.cancelled()
+    with pytest.raises(RuntimeError, match='cancelled'):
+      handle.result()
+  else:
+    #The call finished before it could be cancelled
+    assert handle.result() is True
+  assert handle.done()
+
+def test_ufunc(kernel):
+  (module, name) = kernel
+  ufunc = getattr(module, name + '_ufunc')
+  (x, z) = get_inputs(6000)
+  assert np.allclose(ufunc(2.0, x, z), 2.0 * x + z)
+  #out=, broadcasting, and per-element uniforms
+  out = np.empty((3, 2000), dtype=np.float32)
+  a = np.arange(2000, dtype=np.float32) % 5
+  assert ufunc(a, x.reshape(3, 2000), z[:2000], out=out) is out
+  assert np.allclose(out, a * x.reshape(3, 2000) + z[:2000])
+  #Strided operands and float64 (computed in float32)
+  assert np.allclose(ufunc(1.0, x[::2], z[::-2]), x[::2] + z[::-2])
+  result = ufunc(np.float64(2.0), x.astype(np.float64), z.astype(np.float64))
+  assert result.dtype == np.float64 and np.allclose(result, 2.0 * x + z)
+
+#A C++17 program that uses the generated header
+program = '''
+#include <cstdio>
+#include "vecpy_axpy_cpp.hpp"
+int main() {
+  vecpy::AlignedVector<float> x(3000), z(3000), y(3000);
+  for(size_t i = 0; i < x.size(); i++) {
+    x[i] = i;
+    z[i] = 1;
+  }
+  bool ok = vecpy::axpy_cpp::run(2, x, z, y);
+  auto out = vecpy::axpy_cpp::run(3, x, z);
+  auto future = vecpy::axpy_cpp::runAsync(4, x, z, y);
+  bool done = future.get();
+  bool rejected = false;
+  try {
+    vecpy::axpy_cpp::run(2, x, vecpy::Span<const float>(z.data(), 10), y);
+  } catch(std::invalid_argument& e) {
+    rejected = true;
+  }
+  printf("%d %d %d %g %g\\n", ok, done, rejected, out.y[2999], y[2999]);
+  return 0;
+}
+'''
+
+def test_cpp(tmp_path_factory):
+  (module, path) = build(tmp_path_factory, axpy_cpp, (Binding.cpp,), tiling=True)
+  with open(os.path.join(path, 'main.cpp'), 'w') as file:
+    file.write(program)
+  executable = os.path.join(path, 'main')
+  subprocess.check_call(['g++', '-std=c++17', '-Wall', '-Werror', '-I', path, '-o', executable, os.path.join(path, 'main.cpp'), os.path.join(path, 'vecpy_axpy_cpp.so'), '-Wl,-rpath,' + path, '-pthread'])
+  assert subprocess.check_output([executable]).split() == [b'1', b'1', b'1', b'8998', b'11997']
+
+def test_library(tmp_path_factory):
+  (module, path) = build(tmp_path_factory, [lib_blend, (lib_mask, DataType.uint32)], (Binding.python, Binding.numpy), name='cg_lib')
+  (x, z) = get_inputs(5000)
+  y = np.zeros(5000, dtype=np.float32)
+  assert module.lib_blend(0.25, x, z[::-1], y) is True
+  assert np.allclose(y, x + 0.25 * (z[::-1] - x))
+  assert np.allclose(module.lib_blend_ufunc(0.5, x, z), x + 0.5 * (z - x))
+  #The uint32 kernel of the same module
+  u = np.arange(5000, dtype=np.uint32)
+  (masked,) = module.lib_mask(u, 0xF0)
+  assert np.array_equal(np.asarray(masked), u & 0xF0)
+  jobs = [(u[:100], 1, np.zeros(100, dtype=np.uint32)), (u, 3, np.zeros(5000, dtype=np.uint32))]
+  assert module.lib_mask_batch(jobs) == [True, True]
+  assert all(np.array_equal(y, x & m) for (x, m, y) in jobs)
@@ -0,0 +1,167 @@
+import os
+import socket
+import pytest
+from vecpy import distributed
+from vecpy.allocator import Allocator
+from vecpy.distributed import Coordinator, get_socket, is_local, recv_message, send_message, spawn_workers, start_workers
+
+def test_message_roundtrip():
+  (a, b) = socket.socketpair()
+  with a, b:
+    payloads = [bytes(range(256)) * 100, Allocator.get_array('f', 5, value=1.5), b'']
+    send_message(a, {'op': 'run', 'n': 3}, payloads)
+    (header, received) = recv_message(b)
+    assert header['op'] == 'run' and header['n'] == 3
+    assert header['sizes'] == [25600, 20, 0]
+    assert received[0] == payloads[0]
+    assert list(memoryview(received[1]).cast('f')) == [1.5] * 5
+    assert received[2] == b''
+
+def test_message_sequence():
+  (a, b) = socket.socketpair()
+  with a, b:
+    for i in range(3):
+      send_message(a, {'i': i}, [bytes([i]) * i])
+    assert [recv_message(b)[0]['i'] for i in range(3)] == [0, 1, 2]
+
+def test_message_truncated():
+  (a, b) = socket.socketpair()
+  with a, b:
+    send_message(a, {'op': 'run'}, [bytes(100)])
+    a.shutdown(socket.SHUT_WR)
+    data = b''.join(iter(lambda: b.recv(4096), b''))
+  #The connection closes before the payload ends
+  (a, b) = socket.socketpair()
+  with b:
+    with a:
+      a.sendall(data[:-10])
+    with pytest.raises(ConnectionError):
+      recv_message(b)
+
+def test_closed_connection():
+  (a, b) = socket.socketpair()
+  a.close()
+  with b, pytest.raises(ConnectionError):
+    recv_message(b)
+
+def test_addresses():
+  (sock, target) = get_socket('unix:/tmp/worker.sock')
+  with sock:
+    assert sock.family == socket.AF_UNIX and target == '/tmp/worker.sock'
+  (sock, target) = get_socket('example.com:5000')
+  with sock:
+    assert sock.family == socket.AF_INET and target == ('example.com', 5000)
+  assert is_local('unix:/tmp/worker.sock') and is_local('localhost:5000') and is_local('127.0.0.1:1')
+  assert not is_local('example.com:5000')
+
+def get_coordinator(num):
+  #Only get_shards is used, so no workers are needed
+  coordinator = Coordinator([])
+  coordinator.sockets = [None] * num
+  return coordinator
+
+@pytest.mark.parametrize('N, num', [(1000, 3), (16, 4), (5, 2), (100000, 7)])
+def test_shards(N, num):
+  shards = get_coordinator(num).get_shards(N)
+  assert len(shards) == num
+  assert sum(length for (offset, length) in shards) == N
+  assert all(offset % distributed.shard_align == 0 for (offset, length) in shards)
+  assert all(shards[i][0] + shards[i][1] == shards[i + 1][0] for i in range(num - 1))
+
+#A Python stand-in for a compiled module: y = a * x and m = max(m, x)
+scale_max = '''
+def scale_max(a, x, y, m):
+  for i in range(len(x)):
+    y[i] = a * x[i]
+  m[0] = max([m[0]] + list(x))
+  return True
+'''
+
+@pytest.fixture
+def kernel(tmp_path, monkeypatch, vecpy_path):
+  #Worker processes import the stand-in from PYTHONPATH
+  (tmp_path / 'vecpy_scale_max.py').write_text(scale_max)
+  monkeypatch.setenv('PYTHONPATH', os.pathsep.join([str(tmp_path), vecpy_path]))
+  return 'scale_max'
+
+def get_free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+#Worker processes listening on Unix sockets or on localhost TCP ports
+@pytest.fixture(params=['unix', 'tcp'])
+def workers(kernel, tmp_path, request):
+  if request.param == 'unix':
+    (processes, addresses) = spawn_workers(kernel, 3, str(tmp_path))
+  else:
+    addresses = ['127.0.0.1:%d'%(get_free_port()) for i in range(3)]
+    processes = start_workers(kernel, addresses)
+  yield (processes, addresses)
+  for process in processes:
+    if process.poll() is None:
+      process.kill()
+    process.wait()
+
+def get_data(N):
+  x = Allocator.get_array('f', N)
+  for i in range(N):
+    x[i] = i
+  return x
+
+@pytest.mark.parametrize('shared', [True, False])
+def test_coordinator(kernel, workers, shared):
+  (processes, addresses) = workers
+  coordinator = Coordinator(addresses, shared_memory=shared)
+  N = 1000
+  x = get_data(N)
+  y = Allocator.get_array('f', N)
+  m = Allocator.get_array('f', 1, value=-1)
+  #Staging segments are reused by later calls
+  for a in (2.0, 3.0):
+    assert coordinator.run(kernel, {'x': x, 'y': y, 'm': m}, {'a': a}, outputs=('y',), reductions={'m': max})
+    assert list(y) == [a * i for i in range(N)]
+    assert m[0] == N - 1
+  assert sorted(coordinator.staging) == (['x', 'y'] if shared else [])
+  #Errors in a worker are reported by the coordinator
+  with pytest.raises(Exception, match='serves scale_max'):
+    coordinator.run('other', {'x': x}, {})
+  coordinator.stop()
+  for process in processes:
+    assert process.wait(10) == 0
+  #Workers remove their sockets when they stop
+  assert not any(os.path.exists(address[5:]) for address in addresses if address.startswith('unix:'))
+
+def test_coordinator_arrays(kernel, workers):
+  (processes, addresses) = workers
+  coordinator = Coordinator(addresses)
+  N = 1000
+  x = coordinator.get_array('f', N)
+  x[:] = get_data(N)
+  y = coordinator.get_array('f', N, value=5.0)
+  m = Allocator.get_array('f', 1)
+  #Arrays in the coordinator's segments are used in place, without staging
+  assert coordinator.run(kernel, {'x': x, 'y': y, 'm': m}, {'a': 0.5}, outputs=('y',), reductions={'m': max})
+  assert list(y) == [0.5 * i for i in range(N)] and m[0] == N - 1
+  assert coordinator.staging == {}
+  #Slices of them too
+  assert coordinator.run(kernel, {'x': x[500:], 'y': y[:500], 'm': m}, {'a': 1.0}, outputs=('y',), reductions={'m': max})
+  assert list(y[:500]) == [500.0 + i for i in range(500)]
+  assert coordinator.staging == {}
+  coordinator.release(x)
+  with pytest.raises(Exception, match='not allocated'):
+    coordinator.release(m)
+  coordinator.stop()
+  assert coordinator.arrays == {}
+
+def test_coordinator_checks(kernel, workers):
+  (processes, addresses) = workers
+  coordinator = Coordinator(addresses)
+  x = Allocator.get_array('f', 10)
+  with pytest.raises(Exception, match='Array sizes'):
+    coordinator.run(kernel, {'x': x, 'y': Allocator.get_array('f', 9)})
+  with pytest.raises(Exception, match='Invalid output'):
+    coordinator.run(kernel, {'x': x}, outputs=('y',))
+  with pytest.raises(Exception, match='elementwise'):
+    coordinator.run(kernel, {'m': x}, reductions={'m': max})
+  coordinator.stop()
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from vecpy.compiler_constants import Architecture, DataType, Options
+from vecpy.compiler_numpy import Compiler_NumPy
+from vecpy.fuser import Fuser
+from vecpy.parser import Parser
+
+def normalize(x, lo:'uniform', hi:'uniform', y):
+  y = (x - lo) / (hi - lo)
+
+def clamp(x, lo:'uniform', y):
+  y = x
+  if x < lo:
+    y = lo
+
+def accumulate(x, y):
+  y = y + x
+
+def last(x, s:'fuse'):
+  if x > 0.5:
+    s = x
+
+def fuse(funcs, wiring, name=None):
+  return Fuser.fuse([Parser.parse(func) for func in funcs], wiring, name)
+
+def get_arguments(kernel):
+  return [(arg.name, arg.is_input, arg.is_output, arg.is_uniform) for arg in kernel.get_arguments()]
+
+def test_chain():
+  kernel = fuse([normalize, clamp], {'clamp.x': 'normalize.y'})
+  assert kernel.name == 'normalize_clamp'
+  #The intermediate is gone, and the clashing uniforms are prefixed with their kernel's name
+  assert get_arguments(kernel) == [
+    ('x', True, False, False),
+    ('normalize_lo', True, False, True),
+    ('hi', True, False, True),
+    ('clamp_lo', True, False, True),
+    ('y', False, True, False),
+  ]
+  run = Compiler_NumPy.compile(kernel, Options(Architecture.generic, DataType.float))
+  x = np.linspace(0, 10, 101, dtype=np.float32)
+  (y,) = run(x, 2.0, 7.0, 0.1)
+  ref = np.maximum((x - np.float32(2)) / np.float32(5), np.float32(0.1))
+  np.testing.assert_allclose(y, ref, rtol=1e-6)
+
+def test_shared_arguments():
+  kernel = fuse([normalize, clamp], {'clamp.x': 'normalize.x', 'clamp.lo': 'normalize.lo'}, name='shared')
+  assert kernel.name == 'shared'
+  assert get_arguments(kernel) == [
+    ('x', True, False, False),
+    ('lo', True, False, True),
+    ('hi', True, False, True),
+    ('normalize_y', False, True, False),
+    ('clamp_y', False, True, False),
+  ]
+
+@pytest.mark.parametrize('wiring, message', [
+  ({'clamp': 'normalize.y'}, 'Expected kernel.argument'),
+  ({'clamp.x': 'normalize.y.z'}, 'Expected kernel.argument'),
+  ({'clamp.z': 'normalize.y'}, 'Unknown argument'),
+  ({'other.x': 'normalize.y'}, 'Unknown kernel'),
+  ({'normalize.x': 'clamp.y'}, 'must come from an earlier kernel'),
+  ({'normalize.x': 'normalize.y'}, 'must come from an earlier kernel'),
+  ({'clamp.lo': 'normalize.y'}, 'Only elementwise inputs can be fused'),
+  ({'clamp.lo': 'normalize.x'}, 'Can\'t share arguments of different kinds'),
+])
+def test_wiring_errors(wiring, message):
+  with pytest.raises(Exception, match=message):
+    fuse([normalize, clamp], wiring)
+
+def test_output_kinds():
+  #Outputs that are also inputs, and fuse outputs, can't be passed in registers
+  with pytest.raises(Exception, match='Only elementwise outputs can be fused'):
+    fuse([accumulate, clamp], {'clamp.x': 'accumulate.y'})
+  with pytest.raises(Exception, match='Only elementwise outputs can be fused'):
+    fuse([last, clamp], {'clamp.x': 'last.s'})
+
+def test_kernel_list():
+  with pytest.raises(Exception, match='No kernels'):
+    Fuser.fuse([], {})
+  with pytest.raises(Exception, match='unique'):
+    fuse([clamp, clamp], {})
@@ -0,0 +1,142 @@
+import json
+import shutil
+import sys
+import sysconfig
+import pytest
+from vecpy import loader
+from vecpy.loader import get_arch, load, read_manifest
+
+#Manifest entry of a kernel built for every architecture (see runtime.build_package)
+entry = {'archs': {
+  'generic': {'file': 'generic/vecpy_k.so', 'level': 100, 'requires': None},
+  'sse4_2': {'file': 'sse4_2/vecpy_k.so', 'level': 205, 'requires': 'sse4_2'},
+  'avx2': {'file': 'avx2/vecpy_k.so', 'level': 207, 'requires': 'avx2'},
+}}
+
+@pytest.fixture
+def cpu(monkeypatch):
+  def set_flags(*flags):
+    monkeypatch.setattr(loader, 'cpu_flags', set(flags))
+  return set_flags
+
+@pytest.mark.parametrize('flags, arch', [
+  ((), 'generic'),
+  (('sse4_2',), 'sse4_2'),
+  (('sse4_2', 'avx2', 'fma'), 'avx2'),
+  (('avx2',), 'avx2'),
+])
+def test_fastest_arch(cpu, flags, arch):
+  cpu(*flags)
+  assert get_arch(entry) == arch
+
+def test_arch_override(cpu):
+  cpu()
+  #An explicit architecture is used even if this CPU lacks it
+  assert get_arch(entry, 'avx2') == 'avx2'
+  with pytest.raises(Exception, match='not in package'):
+    get_arch(entry, 'neon')
+
+def test_no_supported_arch(cpu):
+  cpu('sse4_2')
+  with pytest.raises(Exception, match='No architecture'):
+    get_arch({'archs': {'avx2': entry['archs']['avx2']}})
+
+def test_cpu_flags(monkeypatch):
+  monkeypatch.setattr(loader, 'cpu_flags', None)
+  flags = loader.get_cpu_flags()
+  assert isinstance(flags, set)
+  #Read once
+  assert loader.get_cpu_flags() is flags
+
+def write_package(path, soabi=None):
+  manifest = {'kernels': {'k': dict(entry, type='float', bindings=['python'], threads=None)}, 'python': sys.version, 'platform': sys.platform}
+  manifest['soabi'] = soabi if soabi is not None else sysconfig.get_config_var('SOABI')
+  path.mkdir(exist_ok=True)
+  with open(path / loader.manifest_file, 'w') as file:
+    json.dump(manifest, file)
+  for arch in entry['archs']:
+    (path / arch).mkdir(exist_ok=True)
+    (path / arch / 'vecpy_k.so').write_bytes(b'not a shared library')
+  return manifest
+
+def test_read_manifest(tmp_path):
+  assert read_manifest(str(tmp_path)) is None
+  manifest = write_package(tmp_path)
+  assert read_manifest(str(tmp_path)) == manifest
+
+@pytest.mark.parametrize('flags, arch', [((), 'generic'), (('sse4_2', 'avx2'), 'avx2')])
+def test_load_selects_file(tmp_path, cpu, flags, arch):
+  cpu(*flags)
+  write_package(tmp_path)
+  #The stand-in files can't be loaded, but the error names the file that was chosen
+  with pytest.raises(ImportError, match='%s/vecpy_k.so'%(arch)):
+    load('k', str(tmp_path))
+  with pytest.raises(ImportError, match='sse4_2/vecpy_k.so'):
+    load('k', str(tmp_path), arch='sse4_2')
+  assert 'vecpy_k' not in sys.modules
+
+def test_load_soabi(tmp_path):
+  write_package(tmp_path, soabi='cpython-27-x86_64-linux-gnu')
+  with pytest.raises(Exception, match='built for cpython-27'):
+    load('k', str(tmp_path))
+
+@pytest.fixture
+def module(tmp_path, monkeypatch):
+  #A module named like a compiled kernel, found on sys.path
+  (tmp_path / 'vecpy_plain.py').write_text('def plain(x):\n  return x + 1\n')
+  monkeypatch.syspath_prepend(str(tmp_path))
+  yield 'plain'
+  sys.modules.pop('vecpy_plain', None)
+
+def test_load_without_package(tmp_path, module):
+  #Without a manifest (or a manifest without the kernel), vecpy_<name> is imported as usual
+  assert load(module, str(tmp_path / 'missing'))(1) == 2
+  sys.modules.pop('vecpy_plain')
+  write_package(tmp_path / 'dist')
+  assert load(module, str(tmp_path / 'dist'))(2) == 3
+  #Loaded modules are reused
+  assert load(module, str(tmp_path / 'missing')) is sys.modules['vecpy_plain'].plain
+
+def test_load_path(tmp_path, module, monkeypatch):
+  write_package(tmp_path / 'dist', soabi='other')
+  monkeypatch.setenv('VECPY_PATH', str(tmp_path / 'dist'))
+  with pytest.raises(Exception, match='built for other'):
+    load('k')
+  monkeypatch.delenv('VECPY_PATH')
+  monkeypatch.chdir(tmp_path)
+  #The default path is ./vecpy_dist
+  write_package(tmp_path / loader.default_path, soabi='other')
+  with pytest.raises(Exception, match='built for other'):
+    load('k')
+
+def test_load_unknown_arch(tmp_path, module):
+  #Asking for an architecture without a package is an error rather than a plain import
+  with pytest.raises(Exception, match='not in a package'):
+    load(module, str(tmp_path / 'missing'), arch='avx2')
+
+#A kernel for the package built below
+def load_double(x, y):
+  y = x * 2
+
+@pytest.mark.skipif(shutil.which('g++') is None, reason='needs g++')
+def test_load_built_package(tmp_path, cpu):
+  from vecpy.compiler_constants import Architecture, DataType
+  from vecpy.runtime import build_package, get_array
+  path = str(tmp_path / 'dist')
+  build_package([load_double], [Architecture.generic, Architecture.sse4_2], DataType.float, path, threads=1)
+  cpu('sse4_2')
+  try:
+    kernel = load('load_double', path)
+    x = get_array('f', 100, value=1.5)
+    y = get_array('f', 100)
+    assert kernel(x, y) is True
+    assert list(y) == [3.0] * 100
+    assert sys.modules['vecpy_load_double'].__file__.endswith('sse4_2/vecpy_load_double.so')
+    #The loaded module is reused when it matches the request
+    assert load('load_double', path) is kernel
+    assert load('load_double', path, arch='sse4_2') is kernel
+    #Another architecture can't be loaded into the same process
+    with pytest.raises(Exception, match='already loaded'):
+      load('load_double', path, arch='generic')
+  finally:
+    sys.modules.pop('vecpy_load_double', None)
@@ -0,0 +1,125 @@
+import math
+import numpy as np
+import pytest
+from vecpy.compiler_constants import Architecture, DataType, Options
+from vecpy.runtime import vectorize_numpy
+
+float_options = Options(Architecture.generic, DataType.float)
+uint_options = Options(Architecture.generic, DataType.uint32)
+
+def poly(a:'uniform', x, y):
+  y = a * x * x + math.sqrt(x) - 1.0
+
+def branch(x, y):
+  if x > 2.0:
+    y = x * 2.0
+  else:
+    y = -x
+
+def halve(x, n):
+  n = 0.0
+  while x > 1.0:
+    x = x / 2.0
+    n = n + 1.0
+
+def functions(x, y):
+  y = max(math.sin(x), math.exp(-x)) + abs(x - 3.0)
+
+def bits(x, y):
+  y = ((x << 3) ^ (x >> 1)) & 255
+
+def wrap(x, y):
+  y = x - 5
+
+def found(x, s:'fuse'):
+  if x == 7.0:
+    s = x * 3.0
+
+#Chunk sizes smaller than, equal to and larger than the inputs
+chunk_sizes = [1, 5, 16, None]
+
+def get_input(N=16):
+  return np.linspace(0, 10, N, dtype=np.float32)
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_arithmetic(chunk_size):
+  x = get_input()
+  (y,) = vectorize_numpy(poly, float_options, chunk_size)(2.0, x)
+  assert y.dtype == np.float32
+  np.testing.assert_allclose(y, np.float32(2) * x * x + np.sqrt(x) - np.float32(1), rtol=1e-6)
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_branch(chunk_size):
+  x = get_input()
+  (y,) = vectorize_numpy(branch, float_options, chunk_size)(x)
+  np.testing.assert_array_equal(y, np.where(x > 2, x * 2, -x))
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_while(chunk_size):
+  x = get_input(33) * 10
+  ref = x.copy()
+  n = np.zeros_like(x)
+  assert vectorize_numpy(halve, float_options, chunk_size)(x, n) is True
+  #Reference: halve each element until it is at most 1
+  count = np.zeros_like(ref)
+  while np.any(ref > 1):
+    mask = ref > 1
+    ref[mask] /= 2
+    count[mask] += 1
+  np.testing.assert_array_equal(x, ref)
+  np.testing.assert_array_equal(n, count)
+
+def test_functions():
+  x = get_input()
+  (y,) = vectorize_numpy(functions, float_options)(x)
+  np.testing.assert_allclose(y, np.maximum(np.sin(x), np.exp(-x)) + np.abs(x - 3), rtol=1e-6)
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_integer(chunk_size):
+  x = np.arange(1000, dtype=np.uint32) * 7919
+  (y,) = vectorize_numpy(bits, uint_options, chunk_size)(x)
+  assert y.dtype == np.uint32
+  np.testing.assert_array_equal(y, ((x << 3) ^ (x >> 1)) & 255)
+  #Unsigned arithmetic wraps
+  (y,) = vectorize_numpy(wrap, uint_options, chunk_size)(np.arange(10, dtype=np.uint32))
+  np.testing.assert_array_equal(y, np.arange(10, dtype=np.uint32) - np.uint32(5))
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+def test_fuse(chunk_size):
+  s = np.zeros(1, np.float32)
+  assert vectorize_numpy(found, float_options, chunk_size)(np.arange(16, dtype=np.float32), s) is True
+  assert s[0] == 21.0
+  #A fuse that isn't written keeps its value
+  s[0] = -1
+  vectorize_numpy(found, float_options, chunk_size)(np.zeros(16, np.float32), s)
+  assert s[0] == -1
+
+def test_arguments():
+  run = vectorize_numpy(poly, float_options)
+  x = get_input()
+  y = np.zeros_like(x)
+  #Given outputs are written in place; omitted ones are allocated and returned
+  assert run(2.0, x, y) is True
+  np.testing.assert_array_equal(run(a=2.0, x=x)[0], y)
+  np.testing.assert_array_equal(run(2.0, x=x, y=None)[0], y)
+  with pytest.raises(TypeError, match='at most'):
+    run(2.0, x, y, y)
+  with pytest.raises(TypeError, match='Unexpected or repeated'):
+    run(2.0, x, a=1.0)
+  with pytest.raises(TypeError, match='Missing argument'):
+    run(x=x)
+  with pytest.raises(TypeError, match='Expected an array of float32'):
+    run(2.0, x.astype(np.float64))
+  with pytest.raises(TypeError, match='Expected an array of float32'):
+    run(2.0, x.reshape(4, 4))
+  with pytest.raises(TypeError, match='writable'):
+    y.flags.writeable = False
+    run(2.0, x, y)
+  with pytest.raises(ValueError, match='sizes'):
+    run(2.0, x, np.zeros(15, np.float32))
+
+def test_docstring():
+  def documented(x, y):
+    '''Adds one.'''
+    y = x + 1.0
+  assert vectorize_numpy(documented, float_options).__doc__ == 'Adds one.'
@@ -0,0 +1,102 @@
+import threading
+import pytest
+from vecpy.runtime import Pipeline, get_array
+
+#Elementwise stand-ins for compiled kernels (they take and fill memoryviews)
+def add(x, k, y):
+  for i in range(len(x)):
+    y[i] = x[i] + k
+
+def mul(x, w, y):
+  for i in range(len(x)):
+    y[i] = x[i] * w[i]
+
+def get_input(N):
+  x = get_array('f', N)
+  for i in range(N):
+    x[i] = i
+  return x
+
+def test_levels():
+  p = Pipeline()
+  p.add(add, 'x', 1.0, 't')
+  p.add(add, 'x', 2.0, 'u')
+  p.add(mul, 't', 'u', 'y')
+  #Without writes, sharing the input x orders the first two stages
+  assert p.get_levels() == [[0], [1], [2]]
+  p = Pipeline()
+  p.add(add, 'x', 1.0, 't', writes='t')
+  p.add(add, 'x', 2.0, 'u', writes=['u'])
+  p.add(mul, 't', 'u', 'y', writes='y')
+  assert p.get_levels() == [[0, 1], [2]]
+  #A later writer of an array that was read must wait for the reader
+  p.add(add, 'x', 3.0, 't', writes='t')
+  assert p.get_levels() == [[0, 1], [2], [3]]
+
+def test_writes_checked():
+  p = Pipeline()
+  with pytest.raises(Exception, match='doesn\'t use'):
+    p.add(add, 'x', 1.0, 'y', writes='z')
+
+@pytest.mark.parametrize('threads, tile', [(1, 64), (3, 64), (4, 1000), (2, None)])
+def test_run(threads, tile):
+  N = 1000
+  (x, y) = (get_input(N), get_array('f', N))
+  p = Pipeline(threads, tile)
+  p.temp('t')
+  p.temp('u')
+  p.add(add, 'x', 1.0, 't', writes='t')
+  p.add(add, 'x', 2.0, 'u', writes='u')
+  p.add(mul, 't', 'u', 'y', writes='y')
+  assert p.run(x=x, y=y)
+  assert list(y) == [(i + 1.0) * (i + 2.0) for i in range(N)]
+
+def test_branches_overlap():
+  #Both branches must be running at once to get through the barrier
+  barrier = threading.Barrier(2, timeout=10)
+  def branch(x, k, y):
+    barrier.wait()
+    add(x, k, y)
+  N = 256
+  (x, y, z) = (get_input(N), get_array('f', N), get_array('f', N))
+  p = Pipeline(threads=1, tile=64)
+  p.add(branch, 'x', 1.0, 'y', writes='y')
+  p.add(branch, 'x', 2.0, 'z', writes='z')
+  assert p.run(x=x, y=y, z=z)
+  assert y[255] == 256.0 and z[255] == 257.0
+
+def test_levels_joined():
+  #A stage starts only after every stage of the previous level has finished its tile
+  done = []
+  def slow(x, k, y):
+    threading.Event().wait(0.01)
+    add(x, k, y)
+    done.append(k)
+  def check(t, u, y):
+    assert len(done) % 2 == 0
+    mul(t, u, y)
+  N = 128
+  (x, y) = (get_input(N), get_array('f', N))
+  p = Pipeline(threads=1, tile=64)
+  p.temp('t')
+  p.temp('u')
+  p.add(slow, 'x', 1.0, 't', writes='t')
+  p.add(slow, 'x', 2.0, 'u', writes='u')
+  p.add(check, 't', 'u', 'y', writes='y')
+  assert p.run(x=x, y=y)
+  assert y[127] == 128.0 * 129.0
+
+def test_errors():
+  x = get_input(10)
+  p = Pipeline()
+  p.add(add, 'x', 1.0, 'y')
+  with pytest.raises(Exception, match='Missing array'):
+    p.run(x=x)
+  with pytest.raises(Exception, match='same'):
+    p.run(x=x, y=get_array('f', 9))
+  def fail(x, k, y):
+    raise ValueError('Stage failed')
+  p.add(fail, 'x', 1.0, 'z', writes='z')
+  p.add(add, 'x', 1.0, 'w', writes='w')
+  with pytest.raises(ValueError, match='Stage failed'):
+    p.run(x=x, y=get_array('f', 10), z=get_array('f', 10), w=get_array('f', 10))
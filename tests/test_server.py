@@ -0,0 +1,135 @@
+import array
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+import types
+from multiprocessing import shared_memory
+import pytest
+from vecpy import server
+from vecpy.distributed import recv_message, send_message
+from vecpy.runtime import Client
+from vecpy.server import Server, get_control_path, stop
+
+#Python stand-ins for compiled modules: one writes its output in place, one returns new outputs
+def axpy(a, x, y):
+  for i in range(len(x)):
+    y[i] = a * x[i] + y[i]
+  return True
+
+def halves(x):
+  if min(x) < 0:
+    raise ValueError('Negative input')
+  return (array.array('f', [v / 2 for v in x]), array.array('I', [len(x)]))
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+  for func in (axpy, halves):
+    module = types.ModuleType('vecpy_' + func.__name__)
+    setattr(module, func.__name__, func)
+    monkeypatch.setitem(sys.modules, 'vecpy_' + func.__name__, module)
+  #The server runs in this process, so it shares the client's resource tracker
+  monkeypatch.setattr(server, 'attach', lambda name: shared_memory.SharedMemory(name=name))
+  path = str(tmp_path / 'private' / 'vecpy.sock')
+  thread = threading.Thread(target=Server(['axpy', 'halves'], path).serve, daemon=True)
+  thread.start()
+  deadline = time.time() + 10
+  while not os.path.exists(path):
+    assert time.time() < deadline
+    time.sleep(0.01)
+  client = Client(path, size=1 << 20)
+  yield client
+  client.close()
+  stop(path)
+  thread.join(10)
+  assert not thread.is_alive()
+  #The server removes its sockets when it stops
+  assert not os.path.exists(path) and not os.path.exists(get_control_path(path))
+
+def test_shared_arrays(client):
+  x = client.get_array('f', 100, value=2.0)
+  y = client.get_array('f', 100, value=1.0)
+  assert client.axpy(3.0, x, y) is True
+  #Arrays in the client's segment are written in place
+  assert list(y) == [7.0] * 100
+  assert client.axpy(a=1.0, x=x, y=y) is True
+  assert y[99] == 9.0
+  client.release(x)
+  client.release(y)
+
+def test_staged_arrays(client):
+  x = array.array('f', [1.0, 2.0, 3.0])
+  y = array.array('f', [0.0] * 3)
+  #Read-only buffers are staged too
+  client.axpy(2.0, memoryview(bytes(x)).cast('f'), y)
+  #Writable buffers outside the segment are copied back
+  assert list(y) == [2.0, 4.0, 6.0]
+  #The staging segment grows for larger calls
+  x = array.array('f', range(50000))
+  y = array.array('f', [0.0] * 50000)
+  client.axpy(1.0, x, y)
+  assert y[49999] == 49999.0
+
+def test_returned_outputs(client):
+  x = client.get_array('f', 4, value=5.0)
+  (h, n) = client.halves(x)
+  assert h.format == 'f' and list(h) == [2.5] * 4
+  assert n.format == 'I' and list(n) == [4]
+  client.release(x)
+
+def test_errors(client):
+  with pytest.raises(Exception, match='Unknown kernel'):
+    client.scale(array.array('f', [1.0]))
+  with pytest.raises(Exception, match='Negative input'):
+    client.halves(array.array('f', [1.0, -1.0]))
+  with pytest.raises(Exception, match='contiguous'):
+    client.halves(memoryview(array.array('f', [1.0, 2.0, 3.0, 4.0]))[::2])
+  #The connection is still usable after an error
+  assert list(client.halves(array.array('f', [4.0]))[0]) == [2.0]
+
+def test_arena_exhausted(client):
+  with pytest.raises(MemoryError):
+    client.get_array('f', 1 << 20)
+
+def test_arena_reuse(client):
+  #A long-lived client can allocate far more than the segment over time
+  for i in range(100):
+    arrays = [client.get_array('f', 16384, value=None) for j in range(3)]
+    arrays[2][0] = float(i)
+    client.axpy(1.0, arrays[2], arrays[2])
+    assert arrays[2][0] == 2.0 * i
+    for x in arrays:
+      client.release(x)
+  #Freed blocks merge back into one, so the whole segment is available again
+  assert client.free == [(0, 1 << 20)]
+  x = client.get_array('f', (1 << 20) // 4, value=1.0)
+  assert x[0] == 1.0
+  client.release(x)
+  with pytest.raises(Exception, match='not allocated'):
+    client.release(memoryview(array.array('f', [1.0])))
+
+def test_release_out_of_order(client):
+  arrays = [client.get_array('I', 100, value=i) for i in range(4)]
+  for i in (1, 3, 0, 2):
+    client.release(arrays[i])
+  assert client.free == [(0, 1 << 20)]
+  #Reused blocks are refilled
+  assert list(client.get_array('I', 100)) == [0] * 100
+
+def test_private_sockets(client, tmp_path):
+  path = str(tmp_path / 'private' / 'vecpy.sock')
+  assert stat.S_IMODE(os.stat(str(tmp_path / 'private')).st_mode) == 0o700
+  for name in (path, get_control_path(path)):
+    assert stat.S_IMODE(os.stat(name).st_mode) == 0o600
+
+def test_clients_cannot_stop(client, tmp_path):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  with sock:
+    sock.connect(str(tmp_path / 'private' / 'vecpy.sock'))
+    send_message(sock, {'op': 'stop'})
+    (header, payloads) = recv_message(sock)
+  assert not header['ok'] and 'Unsupported operation' in header['error']
+  #The server still runs calls
+  assert list(client.halves(array.array('f', [4.0]))[0]) == [2.0]